@@ -0,0 +1,280 @@
+#!/usr/bin/python
+'''
+Load-tests the web API the way a handful of phones and laptops would use it. Run from the repository root:
+	python -m bench.api_load --records 5 --lines 200000 --clients 8 --duration 10
+Synthetic records (see bench.render.synthetic_record()) are written to a temporary records.DIR, the API is started
+in-process on a free port. Every path is first requested once on its own (the 'cold' scenario, which includes parsing
+and rendering from scratch), then each scenario keeps --clients concurrent clients busy for --duration seconds. Those
+mostly hit warm caches; the render scenario instead touches each record before asking for its image, so every image
+is rendered from scratch while the clocks are running. For every scenario, throughput, p50/p99 latency, errors and
+the RSS of the server (and of its worker processes) are reported.
+With --save, the results are written to a JSON file; with --baseline, they are compared against such a file, and
+the run fails if any scenario got slower than --tolerance allows.
+'''
+
+import http.client
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import numpy
+
+from lib import records
+from lib import catalogue
+from bench import render
+
+# the API is started in-process, so it must be imported after records.DIR has been pointed at the synthetic records
+server = None
+cherrypy = None
+
+def write_records(count, lines, text = False):
+	"""Writes count synthetic records of the given number of lines to records.DIR and returns their IDs"""
+	record_ids = []
+	for i in range(count):
+		record_id = '2019-06-%02d_0'%(i % 28 + 1) if i < 28 else '2019-07-%02d_%d'%(i % 28 + 1, i // 28)
+		record = render.synthetic_record(lines, seed = i)
+		if text:
+			with open(os.path.join(records.DIR, record_id + records.EXT), 'w') as file:
+				record.write(file)
+		else:
+			records.write_binary(os.path.join(records.DIR, record_id + records.BIN_EXT), record.data)
+		record_ids.append(record_id)
+	return record_ids
+
+def start_server(port):
+	global server
+	global cherrypy
+	import cherrypy
+	import server
+	# same thread pool as the real thing, but only listening locally
+	cherrypy.config.update(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server.conf'))
+	cherrypy.config.update({ 'server.socket_host': '127.0.0.1', 'server.socket_port': port, 'log.screen': False,
+		'engine.autoreload.on': False, 'checker.on': False })
+	server.reserve_control_threads()
+	cherrypy.tree.mount(server.API(), '/api', { '/': { 'request.dispatch': cherrypy.dispatch.MethodDispatcher() } })
+	cherrypy.engine.subscribe('stop', server._workers.shutdown)
+	# the real server catalogues the records in the background once it has started - do it up front here, so the
+	# listings see every record from the first request
+	catalogue.reconcile()
+	cherrypy.engine.start()
+	cherrypy.engine.wait(cherrypy.engine.states.STARTED)
+
+def _rss(pid):
+	"""Returns the resident set size of a process in bytes (0 if it is gone)"""
+	try:
+		with open('/proc/%d/status'%(pid)) as file:
+			for line in file:
+				if line.startswith('VmRSS:'):
+					return int(line.split()[1]) * 1024
+	except OSError:
+		pass
+	return 0
+
+def _children(pid):
+	children = []
+	for entry in os.listdir('/proc'):
+		if entry.isdigit():
+			try:
+				with open('/proc/%s/stat'%(entry)) as file:
+					# the command name is in parentheses and may contain spaces, so split after it
+					if int(file.read().rpartition(')')[2].split()[1]) == pid:
+						children.append(int(entry))
+			except (OSError, ValueError, IndexError):
+				pass
+	return children
+
+class MemorySampler:
+	"""Samples the RSS of this process and of its child processes (the worker pool) in the background, keeping the peak"""
+	def __init__(self, interval = 0.1):
+		self.interval = interval
+		self.peak_server = 0
+		self.peak_workers = 0
+		self.stopped = threading.Event()
+		self.thread = threading.Thread(target = self._run, daemon = True)
+	def _run(self):
+		while not self.stopped.is_set():
+			self.peak_server = max(self.peak_server, _rss(os.getpid()))
+			self.peak_workers = max(self.peak_workers, sum(_rss(child) for child in _children(os.getpid())))
+			self.stopped.wait(self.interval)
+	def __enter__(self):
+		self.thread.start()
+		return self
+	def __exit__(self, *args):
+		self.stopped.set()
+		self.thread.join()
+
+def _touch(path):
+	"""Changes the modification time of the record that an /api/records/<id>/image path is for, so no cache in the
+	server has an image of this version of it and the request has to render it again"""
+	now = time.time_ns()
+	os.utime(records.get_path(path.split('/')[3]), ns = (now, now))
+
+def _client(port, paths, deadline, latencies, errors, once = False, before = None):
+	"""Requests random paths over one keep-alive connection (as a browser would) until the deadline, or just one if
+	once is set. before(path), if given, is called before each request (and isn't timed)."""
+	connection = http.client.HTTPConnection('127.0.0.1', port, timeout = 60)
+	rng = random.Random(threading.get_ident())
+	while once or time.monotonic() < deadline:
+		once = False
+		path = rng.choice(paths)
+		if before is not None:
+			before(path)
+		t0 = time.perf_counter()
+		try:
+			connection.request('GET', path)
+			response = connection.getresponse()
+			response.read()
+			if response.status >= 400:
+				errors.append(response.status)
+		except (OSError, http.client.HTTPException) as ex:
+			errors.append(type(ex).__name__)
+			connection.close()
+			connection = http.client.HTTPConnection('127.0.0.1', port, timeout = 60)
+			continue
+		latencies.append(time.perf_counter() - t0)
+	connection.close()
+
+def run_scenario(port, clients, duration):
+	"""Runs one scenario. clients maps the name of each group of clients to (number of clients, paths they pick from)
+	or (number of clients, paths, function to call before each request - see _client()). Returns a summary of the
+	results of each group."""
+	deadline = time.monotonic() + duration
+	results = { name: ([], []) for name in clients }
+	threads = []
+	for name, group in clients.items():
+		count, paths = group[:2]
+		before = group[2] if len(group) > 2 else None
+		for _ in range(count):
+			threads.append(threading.Thread(target = _client, args = (port, paths, deadline) + results[name], \
+				kwargs = { 'before': before }))
+	with MemorySampler() as memory:
+		start = time.monotonic()
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		elapsed = time.monotonic() - start
+	return { name: _summarize(latencies, errors, elapsed, memory) for name, (latencies, errors) in results.items() }
+
+def _summarize(latencies, errors, elapsed, memory):
+	latencies = numpy.array(latencies) * 1000
+	return {
+		'requests': len(latencies),
+		'throughput': len(latencies) / elapsed,
+		'p50_ms': float(numpy.percentile(latencies, 50)) if len(latencies) != 0 else None,
+		'p99_ms': float(numpy.percentile(latencies, 99)) if len(latencies) != 0 else None,
+		'errors': len(errors),
+		'server_rss_mb': memory.peak_server / (1 << 20),
+		'worker_rss_mb': memory.peak_workers / (1 << 20),
+	}
+
+def warm_up(port, clients):
+	"""Requests every path of every scenario once, one at a time, so the timed scenarios all see warm caches whichever
+	of them are run. Returns the timings of these first requests (parsing and rendering from scratch) as a scenario of
+	its own, grouped like clients."""
+	paths = {}
+	for groups in clients.values():
+		for name, group in groups.items():
+			if len(group) > 2:
+				continue # renders from scratch every time anyway
+			paths.setdefault(name, set()).update(group[1])
+	results = {}
+	with MemorySampler() as memory:
+		for name, group_paths in paths.items():
+			latencies, errors = [], []
+			start = time.monotonic()
+			for path in sorted(group_paths):
+				_client(port, [path], 0, latencies, errors, once = True)
+			results[name] = _summarize(latencies, errors, time.monotonic() - start, memory)
+	return results
+
+def scenarios(record_ids, clients):
+	"""Returns { scenario: { client group: (number of clients, paths[, before]) } } (see run_scenario()). The mixed
+	scenario has most clients fetching record images - from the caches, after the warm-up - alongside one polling
+	the machine state; the render scenario does the same, but with every image rendered from scratch, to check that
+	machine state requests stay fast while renders are actually running."""
+	images = ['/api/records/%s/image'%(record_id) for record_id in record_ids]
+	return {
+		'list': { 'list': (clients, ['/api/records']) },
+		'summary': { 'summary': (clients, ['/api/records/%s'%(record_id) for record_id in record_ids]) },
+		'image': { 'image': (clients, images) },
+		'machineState': { 'machineState': (clients, ['/api/machineState']) },
+		'mixed': { 'image': (max(clients - 1, 1), images), 'machineState': (1, ['/api/machineState']) },
+		'render': { 'coldImage': (max(clients - 1, 1), images, _touch), 'machineState': (1, ['/api/machineState']) },
+	}
+
+def compare(results, baseline, tolerance):
+	"""Prints how the results differ from the baseline, and returns the list of regressions. The cold scenario only
+	has a handful of requests (the first of which also starts the worker pool), so only its median is compared."""
+	regressions = []
+	slower = lambda new, old: new > old * (1 + tolerance)
+	for scenario, groups in results.items():
+		checks = (('p50_ms', slower),) if scenario == 'cold' else \
+			(('throughput', lambda new, old: new < old / (1 + tolerance)), ('p99_ms', slower))
+		for name, result in groups.items():
+			base = baseline.get(scenario, {}).get(name)
+			if base is None:
+				continue
+			for key, worse in checks:
+				if result[key] is None or base[key] is None:
+					continue
+				change = (result[key] - base[key]) / base[key] * 100 if base[key] != 0 else 0.0
+				flag = worse(result[key], base[key])
+				print('%-14s %-14s %-10s %10.1f -> %10.1f (%+.0f%%)%s'%(scenario, name, key, base[key], result[key], change, \
+					'  REGRESSION' if flag else ''))
+				if flag:
+					regressions.append((scenario, name, key))
+	return regressions
+
+if __name__ == '__main__':
+	import argparse
+	import socket
+	parser = argparse.ArgumentParser(description = 'Load-test the web API with concurrent clients')
+	parser.add_argument('-r', '--records', type = int, default = 5, help = 'number of synthetic records. The default is 5.')
+	parser.add_argument('-l', '--lines', type = int, default = 100_000, help = 'lines per record. The default is 100000.')
+	parser.add_argument('-t', '--text', action = 'store_true', help = 'write the records in the text format instead of binary')
+	parser.add_argument('-c', '--clients', type = int, default = 8, help = 'concurrent clients per scenario. The default is 8.')
+	parser.add_argument('-d', '--duration', type = float, default = 10.0, help = 'seconds per scenario. The default is 10.')
+	parser.add_argument('-s', '--scenario', action = 'append', help = 'run only this scenario (may be repeated)')
+	parser.add_argument('--save', help = 'write the results to this JSON file, e.g. to use as a baseline later')
+	parser.add_argument('--baseline', help = 'compare the results with those saved in this JSON file')
+	parser.add_argument('--tolerance', type = float, default = 0.2, help = 'fraction by which throughput or p99 latency may get worse before it counts as a regression. The default is 0.2.')
+	args = parser.parse_args()
+	records.DIR = tempfile.mkdtemp(prefix = 'agbot-bench-')
+	try:
+		t0 = time.perf_counter()
+		record_ids = write_records(args.records, args.lines, args.text)
+		print('Wrote %d records of %d lines to %s in %.1f s'%(args.records, args.lines, records.DIR, time.perf_counter() - t0))
+		with socket.socket() as sock:
+			sock.bind(('127.0.0.1', 0))
+			port = sock.getsockname()[1]
+		start_server(port)
+		try:
+			selected = { scenario: clients for scenario, clients in scenarios(record_ids, args.clients).items() \
+				if not args.scenario or scenario in args.scenario }
+			results = { 'cold': warm_up(port, selected) }
+			for scenario, clients in selected.items():
+				results[scenario] = run_scenario(port, clients, args.duration)
+			for scenario in results:
+				for name, result in results[scenario].items():
+					print('%-14s %-14s %7d req %8.1f req/s  p50 %8.1f ms  p99 %8.1f ms  %d errors  RSS %6.1f MB (+%.1f MB workers)'%( \
+						scenario, name, result['requests'], result['throughput'], result['p50_ms'] or 0, result['p99_ms'] or 0, \
+						result['errors'], result['server_rss_mb'], result['worker_rss_mb']))
+		finally:
+			cherrypy.engine.exit()
+	finally:
+		shutil.rmtree(records.DIR, ignore_errors = True)
+	results['parameters'] = { 'records': args.records, 'lines': args.lines, 'text': args.text, 'clients': args.clients, 'duration': args.duration }
+	if args.save:
+		with open(args.save, 'w') as file:
+			json.dump(results, file, indent = '\t')
+	if args.baseline:
+		with open(args.baseline) as file:
+			baseline = json.load(file)
+		if baseline.get('parameters') != results['parameters']:
+			print('Warning: the baseline was run with different parameters: %s'%(baseline.get('parameters')))
+		if compare({ key: value for key, value in results.items() if key != 'parameters' }, baseline, args.tolerance):
+			raise SystemExit(1)
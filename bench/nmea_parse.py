@@ -0,0 +1,57 @@
+#!/usr/bin/python
+'''
+Compares the fast-path NMEA parser in lib/nmea.py against pynmea2 on a captured log.
+Run from the repository root:
+	python -m bench.nmea_parse /path/to/trimble.log
+The log should contain one NMEA sentence per line. Lines prefixed with a receive timestamp (as written by the NMEA
+listener) are accepted too.
+'''
+
+import time
+import pynmea2
+
+from lib import nmea
+
+def load_sentences(path):
+	sentences = []
+	with open(path, 'r', encoding = 'latin-1') as file:
+		for line in file:
+			line = line.strip()
+			if len(line) != 0 and not line.startswith('$'):
+				line = line.partition(' ')[2]
+			if line.startswith('$'):
+				sentences.append(line)
+	return sentences
+
+def time_parser(parse, sentences, repeat):
+	"""Returns the best time (in seconds) out of `repeat` passes over all the sentences"""
+	best = None
+	for _ in range(repeat):
+		errors = 0
+		t0 = time.perf_counter()
+		for sentence in sentences:
+			try:
+				parse(sentence)
+			except pynmea2.ParseError:
+				errors += 1
+		elapsed = time.perf_counter() - t0
+		best = elapsed if best is None else min(best, elapsed)
+	return best, errors
+
+if __name__ == '__main__':
+	import argparse
+	import collections
+	parser = argparse.ArgumentParser(description = 'Benchmark the fast-path NMEA parser against pynmea2')
+	parser.add_argument('log', help = 'a file of NMEA sentences, one per line')
+	parser.add_argument('-r', '--repeat', type = int, default = 5, help = 'number of timed passes; the best is reported. The default is 5.')
+	args = parser.parse_args()
+	sentences = load_sentences(args.log)
+	if len(sentences) == 0:
+		raise ValueError('No NMEA sentences found in %s'%(args.log))
+	types = collections.Counter(sentence[3:6] for sentence in sentences)
+	print('%d sentences: %s'%(len(sentences), ', '.join('%s=%d'%(type, count) for type, count in types.most_common())))
+	slow, slow_errors = time_parser(pynmea2.parse, sentences, args.repeat)
+	fast, fast_errors = time_parser(nmea.parse, sentences, args.repeat)
+	print('pynmea2.parse: %8.2f us/sentence (%d errors)'%(slow / len(sentences) * 1e6, slow_errors))
+	print('nmea.parse:    %8.2f us/sentence (%d errors)'%(fast / len(sentences) * 1e6, fast_errors))
+	print('speedup:       %8.2fx'%(slow / fast))
@@ -0,0 +1,44 @@
+#!/usr/bin/python
+'''
+Times Record.render() on a synthetic record. Run from the repository root:
+	python -m bench.render --lines 100000
+The record is a serpentine pass over a field, with a random mix of plants in each row.
+'''
+
+import time
+import numpy
+
+from lib import records
+
+def synthetic_record(lines, seed = 0):
+	"""Builds an in-memory binary-style Record with the given number of lines"""
+	rng = numpy.random.default_rng(seed)
+	array = numpy.zeros(lines, records.RECORD_DTYPE)
+	i = numpy.arange(lines)
+	pass_length = 2000 # lines per pass up or down the field
+	passes, step = numpy.divmod(i, pass_length)
+	# alternate directions every pass, shifting one bot-width (about 5ft) east each time
+	along = numpy.where(passes % 2 == 0, step, pass_length - 1 - step)
+	array['timestamp'] = records.to_timestamp(records._EPOCH.replace(year = 2019, month = 6, day = 1)) + i * 200_000
+	array['latitude'] = 40.42 + along * 2e-6
+	array['longitude'] = -86.92 + passes * 2e-5
+	array['rows'] = rng.choice([0, 0, 0, 0, 1, 2, 4, 8, 9], size = (lines, len(records.ROW_DIST)))
+	record = records.Record('bench', 'bench')
+	record.data = array
+	return record
+
+if __name__ == '__main__':
+	import argparse
+	parser = argparse.ArgumentParser(description = 'Benchmark Record.render()')
+	parser.add_argument('-l', '--lines', type = int, default = 100_000, help = 'number of lines in the record. The default is 100000.')
+	parser.add_argument('-r', '--repeat', type = int, default = 5, help = 'number of timed renders; the best is reported. The default is 5.')
+	args = parser.parse_args()
+	record = synthetic_record(args.lines)
+	best = None
+	for _ in range(args.repeat):
+		record.summary = None
+		t0 = time.perf_counter()
+		img = record.render()
+		elapsed = time.perf_counter() - t0
+		best = elapsed if best is None else min(best, elapsed)
+	print('%d lines rendered to %dx%d in %.1f ms'%(args.lines, img.shape[1], img.shape[0], best * 1000))
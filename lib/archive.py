@@ -0,0 +1,264 @@
+#!/usr/bin/python
+'''
+Compresses old records and enforces how many are kept. Run it from cron, or leave it running as a daemon; either way it
+drops its own priority first, so it never competes with the processor or the web server:
+	python -m lib.archive --compress-after 7 --max-age 365 --max-size 20G --daemon
+Archived records are moved out of records.DIR into per-month subdirectories (see records.get_archive_path()), and
+records.Record reads them like any other record.
+'''
+
+import bisect
+import lzma
+import os
+import struct
+import time
+import zlib
+import numpy
+
+from lib import records
+from lib import catalogue
+from lib import loghelper
+
+# Archive format: a HEADER_SIZE-byte header (magic, format version, number of rows, codec, lines per block, zero
+# padding), then the blocks, each one a compressed run of record_dtype() entries, then an index with one entry per
+# block, then a footer pointing at the index. Every block can be decompressed on its own, so a reader only has to
+# decompress the blocks holding the lines it wants.
+ARCHIVE_MAGIC = b'AGBOTARC'
+ARCHIVE_VERSION = 1
+HEADER_SIZE = 64
+_HEADER = struct.Struct('<8sHHBxI')
+_INDEX_ENTRY = struct.Struct('<QIIqq') # offset, compressed size, lines, first and last timestamp
+_FOOTER = struct.Struct('<QI8s') # index offset, number of blocks, magic
+BLOCK_LINES = 16384
+
+ZLIB = 0
+LZMA = 1
+CODECS = { 'zlib': ZLIB, 'lzma': LZMA }
+
+def _compress(codec, data):
+	return lzma.compress(data, preset = 6) if codec == LZMA else zlib.compress(data, 9)
+def _decompress(codec, data):
+	return lzma.decompress(data) if codec == LZMA else zlib.decompress(data)
+
+def write_archive(path, array, codec = LZMA, block_lines = BLOCK_LINES):
+	"""Writes a record array (see records.record_dtype()) to a compressed archive. Like records.write_binary(), the
+	file is written under a temporary name and then renamed."""
+	temp = path + '.tmp'
+	with open(temp, 'wb') as file:
+		header = _HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, array.dtype['rows'].shape[0], codec, block_lines)
+		file.write(header + bytes(HEADER_SIZE - len(header)))
+		index = []
+		for start in range(0, len(array), block_lines):
+			block = numpy.ascontiguousarray(array[start:start + block_lines])
+			data = _compress(codec, block.tobytes())
+			index.append(_INDEX_ENTRY.pack(file.tell(), len(data), len(block), int(block['timestamp'][0]), int(block['timestamp'][-1])))
+			file.write(data)
+		index_offset = file.tell()
+		file.write(b''.join(index))
+		file.write(_FOOTER.pack(index_offset, len(index), ARCHIVE_MAGIC))
+		file.flush()
+		os.fsync(file.fileno())
+	os.rename(temp, path)
+
+class ArchiveReader:
+	"""Random access to the lines of an archive. Only the index is read up front; blocks are decompressed when lines
+	in them are asked for, and the most recently used one is kept."""
+	def __init__(self, path):
+		self.path = path
+		self.file = open(path, 'rb')
+		try:
+			magic, version, rows, self.codec, self.block_lines = _HEADER.unpack(self.file.read(_HEADER.size))
+			if magic != ARCHIVE_MAGIC or version != ARCHIVE_VERSION:
+				raise ValueError('%s is not a version %d record archive'%(path, ARCHIVE_VERSION))
+			self.dtype = records.record_dtype(rows)
+			self.file.seek(-_FOOTER.size, os.SEEK_END)
+			index_offset, count, magic = _FOOTER.unpack(self.file.read(_FOOTER.size))
+			if magic != ARCHIVE_MAGIC:
+				raise ValueError('%s is truncated'%(path))
+			self.file.seek(index_offset)
+			data = self.file.read(count * _INDEX_ENTRY.size)
+		except:
+			self.file.close()
+			raise
+		self.index = [_INDEX_ENTRY.unpack_from(data, i * _INDEX_ENTRY.size) for i in range(count)]
+		# line number of the first line of each block, plus the total number of lines at the end
+		self.starts = [0]
+		for entry in self.index:
+			self.starts.append(self.starts[-1] + entry[2])
+		self.cached = (None, None)
+	def __len__(self):
+		return self.starts[-1]
+	def __enter__(self):
+		return self
+	def __exit__(self, *args):
+		self.close()
+	def close(self):
+		self.file.close()
+	def block(self, i):
+		"""Returns the i-th block as a record array"""
+		if self.cached[0] == i:
+			return self.cached[1]
+		offset, size, lines, first, last = self.index[i]
+		self.file.seek(offset)
+		array = numpy.frombuffer(_decompress(self.codec, self.file.read(size)), self.dtype)
+		self.cached = (i, array)
+		return array
+	def blocks(self):
+		for i in range(len(self.index)):
+			yield self.block(i)
+	def read(self, start, stop):
+		"""Returns lines start to stop (exclusive) as a record array, decompressing only the blocks they are in"""
+		start, stop = max(start, 0), min(stop, len(self))
+		if start >= stop:
+			return numpy.zeros(0, self.dtype)
+		first, last = bisect.bisect_right(self.starts, start) - 1, bisect.bisect_right(self.starts, stop - 1) - 1
+		parts = [self.block(i) for i in range(first, last + 1)]
+		array = parts[0] if len(parts) == 1 else numpy.concatenate(parts)
+		return array[start - self.starts[first]:stop - self.starts[first]]
+	def find_time(self, timestamp):
+		"""Returns the number of the first line at or after the given timestamp (see records.to_timestamp()), assuming
+		lines are in time order. Only the one block that could hold it is decompressed."""
+		i = bisect.bisect_left([entry[4] for entry in self.index], timestamp)
+		if i == len(self.index):
+			return len(self)
+		return self.starts[i] + int(numpy.searchsorted(self.block(i)['timestamp'], timestamp))
+	def array(self):
+		"""Decompresses the whole archive"""
+		return self.read(0, len(self))
+
+def read_archive(path):
+	with ArchiveReader(path) as reader:
+		return reader.array()
+
+def compress(record_id, codec = LZMA, block_lines = BLOCK_LINES):
+	"""Moves a finished record into the archive, compressed. The archive is read back and compared before the
+	original file(s) are deleted. Returns the path of the archive."""
+	if record_id == records.CURRENT:
+		raise ValueError('Cannot archive the record that is being written')
+	path = records.get_path(record_id)
+	if path.endswith(records.ARCHIVE_EXT):
+		return path
+	stat = os.stat(path)
+	array = records.Record.read(record_id).array()
+	archive_path = records.get_archive_path(record_id)
+	os.makedirs(os.path.dirname(archive_path), exist_ok = True)
+	write_archive(archive_path, array, codec, block_lines)
+	# keep the original modification time, which is what retention goes by
+	os.utime(archive_path, ns = (stat.st_atime_ns, stat.st_mtime_ns))
+	if not numpy.array_equal(read_archive(archive_path), array):
+		os.remove(archive_path)
+		raise ValueError('Archive of %s does not match the original - leaving it uncompressed'%(record_id))
+	for ext in (records.EXT, records.BIN_EXT):
+		try:
+			os.remove(os.path.join(records.DIR, os.path.basename(record_id) + ext))
+		except FileNotFoundError:
+			pass
+	return archive_path
+
+def _finished_records():
+	"""Returns (modification time, size, record_id) for every finished record, oldest first"""
+	found = []
+	for record_id, name in records.get_records():
+		if record_id == records.CURRENT:
+			continue
+		try:
+			stat = os.stat(records.get_path(record_id))
+		except FileNotFoundError:
+			continue # deleted while we were looking
+		found.append((stat.st_mtime, stat.st_size, record_id))
+	return sorted(found)
+
+def delete(record_id):
+	"""Deletes every file of a finished record"""
+	for path in (os.path.join(records.DIR, os.path.basename(record_id) + records.EXT), \
+			os.path.join(records.DIR, os.path.basename(record_id) + records.BIN_EXT), records.get_archive_path(record_id)):
+		try:
+			os.remove(path)
+		except FileNotFoundError:
+			pass
+
+def _uncatalogue(record_id, log):
+	try:
+		catalogue.remove(record_id)
+	except Exception:
+		log.exception('Could not remove %s from the catalogue', record_id)
+
+def _retire(record_id, log):
+	"""Deletes a record for retention and takes it out of the catalogue. Returns whether it was deleted."""
+	try:
+		delete(record_id)
+	except OSError:
+		log.exception('Could not delete %s', record_id)
+		return False
+	_uncatalogue(record_id, log)
+	return True
+
+def run(compress_after = None, max_age = None, max_size = None, codec = LZMA):
+	"""Does one pass of archiving: compresses finished records older than compress_after days, then deletes records
+	older than max_age days, then deletes the oldest records until they take up no more than max_size bytes. Any of
+	the limits can be None to skip it. A record that can't be compressed or deleted is logged and skipped, so one bad
+	file never holds up the rest of the pass."""
+	log = loghelper.get_logger(__file__)
+	now = time.time()
+	if compress_after is not None:
+		for mtime, size, record_id in _finished_records():
+			if now - mtime > compress_after * 86400 and not records.get_path(record_id).endswith(records.ARCHIVE_EXT):
+				try:
+					path = compress(record_id, codec)
+					log.info('Archived %s to %s (%d -> %d bytes)', record_id, path, size, os.path.getsize(path))
+				except Exception:
+					log.exception('Could not archive %s', record_id)
+	found = _finished_records()
+	if max_age is not None:
+		for mtime, size, record_id in list(found):
+			if now - mtime > max_age * 86400:
+				log.info('Deleting %s: older than %g days', record_id, max_age)
+				if _retire(record_id, log):
+					found.remove((mtime, size, record_id))
+	if max_size is not None:
+		total = sum(size for mtime, size, record_id in found)
+		for mtime, size, record_id in found:
+			if total <= max_size:
+				break
+			log.info('Deleting %s: records take up %d bytes, more than %d', record_id, total, max_size)
+			if _retire(record_id, log):
+				total -= size
+
+def lower_priority():
+	"""Makes this process as unobtrusive as possible: lowest CPU priority, and idle I/O scheduling where available"""
+	os.nice(19)
+	if hasattr(os, 'sched_setscheduler') and hasattr(os, 'SCHED_IDLE'):
+		try:
+			os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+		except OSError:
+			pass
+
+def _size(string):
+	"""Parses a size in bytes, with an optional K, M or G suffix"""
+	units = { 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30 }
+	if string[-1:].upper() in units:
+		return int(float(string[:-1]) * units[string[-1:].upper()])
+	return int(string)
+
+if __name__ == '__main__':
+	import argparse
+	parser = argparse.ArgumentParser(description = 'Compress old records and delete the oldest ones')
+	parser.add_argument('-c', '--compress-after', type = float, help = 'Compress records older than this many days')
+	parser.add_argument('-a', '--max-age', type = float, help = 'Delete records older than this many days')
+	parser.add_argument('-s', '--max-size', type = _size, help = 'Delete the oldest records while all of them take up more than this (e.g. 20G)')
+	parser.add_argument('--codec', choices = CODECS.keys(), default = 'lzma', help = 'Compression to use (default: lzma)')
+	parser.add_argument('-d', '--daemon', action = 'store_true', help = 'Keep running, doing a pass every --interval seconds')
+	parser.add_argument('-i', '--interval', type = float, default = 3600.0, help = 'Seconds between passes with --daemon (default: 3600)')
+	args = parser.parse_args()
+	lower_priority()
+	log = loghelper.get_logger(__file__)
+	while True:
+		if not args.daemon:
+			run(args.compress_after, args.max_age, args.max_size, CODECS[args.codec])
+			break
+		try:
+			run(args.compress_after, args.max_age, args.max_size, CODECS[args.codec])
+		except Exception:
+			# e.g. a permission problem or a record still being written - try again next time rather than giving up
+			log.exception('Archiving pass failed')
+		time.sleep(args.interval)
@@ -0,0 +1,201 @@
+'''
+Saves camera frames, and what was detected in them, for retraining the network - without slowing down whoever
+captured them. offer() decides on the spot whether a frame is wanted (see SamplingPolicy) and, if so, queues it;
+a few background threads do the JPEG encoding and writing. (OpenCV lets go of the GIL while it encodes, so threads are
+enough, and the frames don't have to be copied to another process.) If the workers fall behind and the queue fills
+up, frames are dropped rather than making the caller wait.
+
+Frames are saved as DIR/<date>/<camera>/<time>-<camera>.jpg, each with a .json sidecar holding its capture time, camera,
+position, detections (in pixels of the saved frame) and why it was kept. Once the archive reaches its quota - or the
+disk gets down to MIN_FREE_BYTES free, whatever the quota - no more frames are saved: nothing already archived is ever
+deleted to make room. The space used and free are looked at again every FULL_RECHECK seconds, so saving picks up
+again once the frames have been collected or the disk has been cleared.
+'''
+
+import datetime
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+import cv2
+
+from lib import loghelper
+
+DIR = '/home/agbot/images'
+QUEUE_SIZE = 32 # frames waiting to be encoded - any more are dropped
+WORKERS = 2
+QUALITY = 95 # JPEG quality
+QUOTA_BYTES = 20 * 1024 * 1024 * 1024
+MIN_FREE_BYTES = 1024 * 1024 * 1024 # so the processor can still write its records
+FULL_RECHECK = 60.0 # seconds
+
+class SamplingPolicy:
+	"""Decides which frames are worth keeping. A frame is kept if it is the every_n-th from its camera, if detections
+	is set and anything was detected in it, or if anything in it was detected with less than low_confidence confidence
+	(the cases the network is least sure about, and so has the most to learn from). Whatever the rules say, at most one
+	frame is kept from each camera every interval seconds."""
+	def __init__(self, every_n = None, detections = False, low_confidence = None, interval = 0.0):
+		self.every_n = every_n
+		self.detections = detections
+		self.low_confidence = low_confidence
+		self.interval = interval
+		self.counts = {} # camera ID -> frames seen
+		self.kept = {} # camera ID -> time.monotonic() a frame was last kept
+	def reason(self, camera_id, detections, now):
+		"""Returns why the frame should be kept ('low_confidence', 'detections' or 'every_n'), or None if it shouldn't.
+		detections is a list of (class, confidence, box), or None if detection wasn't run."""
+		count = self.counts[camera_id] = self.counts.get(camera_id, 0) + 1
+		last = self.kept.get(camera_id)
+		if last is not None and now - last < self.interval:
+			return None
+		detections = detections or []
+		reason = None
+		if self.low_confidence is not None and any(confidence < self.low_confidence for cls, confidence, box in detections):
+			reason = 'low_confidence'
+		elif self.detections and len(detections) != 0:
+			reason = 'detections'
+		elif self.every_n and count % self.every_n == 0:
+			reason = 'every_n'
+		if reason is not None:
+			self.kept[camera_id] = now
+		return reason
+
+def _usage(directory):
+	"""Returns the number of bytes taken up by the files under directory"""
+	used = 0
+	for path, directories, files in os.walk(directory):
+		for file in files:
+			try:
+				used += os.path.getsize(os.path.join(path, file))
+			except OSError:
+				pass # deleted while we were looking
+	return used
+
+def _write(path, data):
+	# written under another name first, so whoever is collecting the images never sees half a file
+	with open(path + '.tmp', 'wb') as file:
+		file.write(data)
+	os.rename(path + '.tmp', path)
+
+class Archiver:
+	def __init__(self, directory = DIR, policy = None, workers = WORKERS, queue_size = QUEUE_SIZE, quota_bytes = QUOTA_BYTES, \
+			min_free_bytes = MIN_FREE_BYTES, quality = QUALITY):
+		self.directory = directory
+		self.policy = policy if policy is not None else SamplingPolicy(every_n = 1)
+		self.quota_bytes = quota_bytes
+		self.min_free_bytes = min_free_bytes
+		self.quality = quality
+		self.log = loghelper.get_logger(__file__)
+		os.makedirs(directory, exist_ok = True)
+		self.used = _usage(directory)
+		self.full = False
+		self.recheck = 0.0 # time.monotonic() at which to see whether a full archive has room again
+		self.lock = threading.Lock()
+		self.saved = 0
+		self.dropped = 0 # queue was full
+		self.over_quota = 0
+		self.failed = 0
+		self.queue = queue.Queue(queue_size)
+		self.threads = [threading.Thread(target = self._work, name = 'Archiver-%d'%(i), daemon = True) for i in range(workers)]
+		for thread in self.threads:
+			thread.start()
+		self.log.info('Archiving frames to %s (%d MB of %d MB quota used)', directory, self.used >> 20, quota_bytes >> 20)
+	def offer(self, camera_id, image, capture_time, detections = None, position = None, scale = 1.0):
+		"""Queues a frame to be saved if the sampling policy wants it, without ever waiting. image must not be modified
+		afterwards. capture_time is the time.monotonic() it was captured at, detections a list of (class, confidence,
+		(x, y, w, h)) or None and position (longitude, latitude) or None. If detection was run on a copy of image
+		shrunk by scale, the boxes are scaled back up to match image. Returns whether the frame was queued."""
+		now = time.monotonic()
+		reason = self.policy.reason(camera_id, detections, now)
+		if reason is None:
+			return False
+		if self.full and now < self.recheck:
+			self.over_quota += 1
+			return False
+		if detections is not None and scale != 1.0:
+			detections = [(cls, confidence, tuple(value / scale for value in box)) for cls, confidence, box in detections]
+		timestamp = datetime.datetime.now() - datetime.timedelta(seconds = now - capture_time)
+		try:
+			self.queue.put_nowait((camera_id, image, timestamp, detections, position, reason))
+		except queue.Full:
+			self.dropped += 1
+			return False
+		return True
+	def _work(self):
+		while True:
+			frame = self.queue.get()
+			if frame is None:
+				return
+			try:
+				self._save(*frame)
+			except Exception:
+				self.failed += 1
+				self.log.exception('Could not archive frame from camera %s', frame[0])
+	def _save(self, camera_id, image, timestamp, detections, position, reason):
+		ret, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+		if not ret:
+			raise ValueError('Could not encode %dx%d image'%(image.shape[1], image.shape[0]))
+		sidecar = json.dumps({
+			'camera': camera_id,
+			'time': timestamp.isoformat(),
+			'reason': reason,
+			'width': image.shape[1],
+			'height': image.shape[0],
+			'longitude': float(position[0]) if position is not None else None,
+			'latitude': float(position[1]) if position is not None else None,
+			'detections': [{ 'class': cls, 'confidence': confidence, 'bbox': list(box) } for cls, confidence, box in detections] \
+				if detections is not None else None,
+		}).encode('utf-8')
+		size = len(jpeg) + len(sidecar)
+		with self.lock:
+			if not self._room(size):
+				self.over_quota += 1
+				return
+			self.used += size
+		directory = os.path.join(self.directory, timestamp.strftime('%Y-%m-%d'), camera_id)
+		os.makedirs(directory, exist_ok = True)
+		path = os.path.join(directory, '%s-%s'%(timestamp.strftime('%H%M%S.%f'), camera_id))
+		_write(path + '.jpg', jpeg.tobytes())
+		_write(path + '.json', sidecar)
+		with self.lock:
+			self.saved += 1
+	def _room(self, size):
+		"""Returns whether there is room for size more bytes. Called with the lock held. Once the archive is full, this
+		only looks again every FULL_RECHECK seconds - counting up what is still there, in case frames were collected."""
+		now = time.monotonic()
+		if self.full:
+			if now < self.recheck:
+				return False
+			self.used = _usage(self.directory)
+		free = shutil.disk_usage(self.directory).free
+		if self.used + size <= self.quota_bytes and free - size >= self.min_free_bytes:
+			if self.full:
+				self.full = False
+				self.log.info('Frame archive has room again (%d MB of %d MB quota used, %d MB free on disk)', \
+					self.used >> 20, self.quota_bytes >> 20, free >> 20)
+			return True
+		if not self.full:
+			self.full = True
+			self.log.warning('Frame archive is full (%d MB of %d MB quota used, %d MB free on disk) - no frames will be saved until ' \
+				'there is room', self.used >> 20, self.quota_bytes >> 20, free >> 20)
+		self.recheck = now + FULL_RECHECK
+		return False
+	def close(self):
+		"""Saves the frames still queued, then stops the workers"""
+		for thread in self.threads:
+			self.queue.put(None)
+		for thread in self.threads:
+			thread.join()
+		self.log.info('Archiver stopped: %d frames saved, %d dropped (queue full), %d over quota, %d failed', \
+			self.saved, self.dropped, self.over_quota, self.failed)
+	def stats(self):
+		return {
+			'saved': self.saved,
+			'dropped': self.dropped,
+			'overQuota': self.over_quota,
+			'failed': self.failed,
+			'usedBytes': self.used,
+			'full': self.full,
+		}
@@ -0,0 +1,342 @@
+#!/usr/bin/python
+'''
+Only one process can open a /dev/videoX device, so instead of each program opening the cameras itself, the camera bus
+daemon opens all of them and publishes every frame to a ring buffer in shared memory, one per camera. Any number of
+local processes can then read the frames at the same time, without copying them:
+	python -m lib.camera_bus
+	python processor.py --camera-bus
+	python -m lib.cameras --bus
+open_cameras() here returns BusCameras, which have the same read()/release() interface as cameras.VideoCamera.
+The writer never waits for readers: each frame goes into the next slot of the ring whether or not anyone has read
+the one it replaces, so a slow reader only misses frames (and skips ahead to the newest) rather than holding back the
+daemon or the other readers.
+
+Only one daemon can publish a camera: a ring whose daemon is still running is never replaced. Readers reattach by
+themselves when the daemon is restarted and publishes a new ring.
+
+Each ring is a POSIX shared memory segment (/dev/shm/agbot-camera-<id>) laid out as a header - magic, version, number
+of slots, frame height, width and channels, then the sequence number of the newest frame, the daemon's PID and the
+time.monotonic() it last captured a frame - followed by the slots. Each slot holds the frame's sequence number, its
+capture time and the frame itself. A slot's sequence number is zeroed while the frame in it is being replaced, so
+readers can tell whether what they read is still the frame they think it is.
+'''
+
+import fnmatch
+import os
+import signal
+import struct
+import threading
+import time
+import numpy
+from multiprocessing import shared_memory
+from multiprocessing import resource_tracker
+
+from lib import cameras
+from lib import loghelper
+
+PREFIX = 'agbot-camera-'
+SHM_DIR = '/dev/shm'
+MAGIC = b'AGCB'
+VERSION = 1
+SLOTS = 8
+READ_TIMEOUT = 1.0 # seconds without a new frame before read() gives up
+POLL_INTERVAL = 0.002 # seconds between checks for a new frame
+_HEADER = struct.Struct('<4sIIIII') # magic, version, slots, height, width, channels
+_LATEST = 32 # offsets of the 8-byte fields after it
+_PID = 40
+_HEARTBEAT = 48
+_HEADER_SIZE = 64
+_SLOT_HEADER = 16 # sequence number, capture time
+_ALIGN = 64
+
+def _align(size):
+	return (size + _ALIGN - 1) // _ALIGN * _ALIGN
+
+def _attach(name):
+	try:
+		return shared_memory.SharedMemory(name, track = False)
+	except TypeError: # before Python 3.13
+		shm = shared_memory.SharedMemory(name)
+		# attaching registered the segment with our resource tracker, which would unlink it when we exit - out from
+		# under the daemon and every other reader
+		resource_tracker.unregister(shm._name, 'shared_memory')
+		return shm
+
+def _alive(pid):
+	"""Returns whether a process with the given PID is running"""
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		pass # running as another user
+	return True
+
+def _owner(name):
+	"""Returns the PID of the daemon that published the named ring, or None if it isn't a ring we can read"""
+	try:
+		shm = _attach(name)
+	except (OSError, ValueError):
+		return None
+	try:
+		if shm.size < _HEADER_SIZE or _HEADER.unpack_from(shm.buf, 0)[:2] != (MAGIC, VERSION):
+			return None
+		return struct.unpack_from('<Q', shm.buf, _PID)[0]
+	finally:
+		shm.close()
+
+class _Ring:
+	"""numpy views of the fields of a ring buffer in shared memory"""
+	def __init__(self, shm, writeable = False):
+		self.shm = shm
+		magic, version, self.slots, height, width, channels = _HEADER.unpack_from(shm.buf, 0)
+		if magic != MAGIC or version != VERSION:
+			raise cameras.CameraException('%s is not a version %d camera bus ring'%(shm.name, VERSION))
+		self.shape = (height, width, channels)
+		self.latest = numpy.ndarray((1,), numpy.uint64, shm.buf, _LATEST)
+		self.pid = numpy.ndarray((1,), numpy.uint64, shm.buf, _PID)
+		self.heartbeat = numpy.ndarray((1,), numpy.float64, shm.buf, _HEARTBEAT)
+		slot_size = _align(_SLOT_HEADER + height * width * channels)
+		self.sequences = []
+		self.times = []
+		self.frames = []
+		for i in range(self.slots):
+			offset = _HEADER_SIZE + i * slot_size
+			self.sequences.append(numpy.ndarray((1,), numpy.uint64, shm.buf, offset))
+			self.times.append(numpy.ndarray((1,), numpy.float64, shm.buf, offset + 8))
+			frame = numpy.ndarray(self.shape, numpy.uint8, shm.buf, offset + _SLOT_HEADER)
+			frame.flags.writeable = writeable
+			self.frames.append(frame)
+	@staticmethod
+	def size(shape, slots):
+		return _HEADER_SIZE + slots * _align(_SLOT_HEADER + shape[0] * shape[1] * shape[2])
+	def close(self):
+		# the views have to go before the memory they point into can be unmapped
+		self.latest = self.pid = self.heartbeat = None
+		self.sequences, self.times, self.frames = [], [], []
+		self.shm.close()
+
+class RingWriter:
+	"""Publishes the frames of one camera, all of the given (height, width, channels) shape"""
+	def __init__(self, camera_id, shape, slots = SLOTS):
+		name = PREFIX + camera_id
+		size = _Ring.size(shape, slots)
+		try:
+			shm = shared_memory.SharedMemory(name, create = True, size = size)
+		except FileExistsError:
+			pid = _owner(name)
+			if pid and pid != os.getpid() and _alive(pid):
+				raise cameras.CameraException('Camera %s is already being published by PID %d'%(camera_id, pid))
+			# left behind by a daemon that didn't get to clean up
+			stale = shared_memory.SharedMemory(name)
+			stale.close()
+			stale.unlink()
+			shm = shared_memory.SharedMemory(name, create = True, size = size)
+		_HEADER.pack_into(shm.buf, 0, MAGIC, VERSION, slots, *shape)
+		self.ring = _Ring(shm, writeable = True)
+		self.ring.pid[0] = os.getpid()
+		self.shape = tuple(shape)
+		self.sequence = 0
+	def write(self, frame, capture_time):
+		self.sequence += 1
+		slot = self.sequence % self.ring.slots
+		self.ring.sequences[slot][0] = 0
+		self.ring.frames[slot][...] = frame
+		self.ring.times[slot][0] = capture_time
+		self.ring.sequences[slot][0] = self.sequence
+		self.ring.latest[0] = self.sequence
+		self.ring.heartbeat[0] = capture_time
+	def close(self):
+		"""Removes the ring. Readers still attached keep their mapping, but get no more frames."""
+		shm = self.ring.shm
+		self.ring.close()
+		shm.unlink()
+
+class BusCamera:
+	"""Reads one camera's frames off the bus. Has the same interface as cameras.VideoCamera; timestamp is the
+	time.monotonic() the last frame read() returned was captured at, and dropped counts the frames that were
+	published but never returned because newer ones were already waiting. If the daemon is restarted, read()
+	moves over to the ring it publishes next."""
+	def __init__(self, camera_id):
+		self.id = camera_id
+		self.inode = self._inode()
+		self.ring = _Ring(_attach(PREFIX + camera_id))
+		self.sequence = 0
+		self.timestamp = None
+		self.dropped = 0
+	def _inode(self):
+		try:
+			return os.stat(os.path.join(SHM_DIR, PREFIX + self.id)).st_ino
+		except FileNotFoundError:
+			return None
+	def reattach(self):
+		"""Attaches to the camera's ring again if the daemon has published a new one since we attached (i.e. it was
+		restarted). Returns whether it did."""
+		inode = self._inode()
+		if inode is None or inode == self.inode:
+			return False
+		try:
+			ring = _Ring(_attach(PREFIX + self.id))
+		except (OSError, ValueError, cameras.CameraException):
+			return False # not set up yet - try again next time
+		self.ring.close()
+		self.ring = ring
+		self.inode = inode
+		self.sequence = 0
+		loghelper.get_logger(__file__).info('Reattached to camera %s on the camera bus', self.id)
+		return True
+	def latest(self, timeout = READ_TIMEOUT):
+		"""Waits for a frame newer than the last one returned, and returns (sequence number, capture time, frame) - or
+		None if none is published within timeout seconds. frame is a read-only view into shared memory that the daemon
+		will overwrite SLOTS - 1 frames later, so it is only good as long as valid(sequence number) is true: check
+		after using it, or copy it."""
+		deadline = time.monotonic() + timeout
+		while True:
+			sequence = int(self.ring.latest[0])
+			if sequence > self.sequence:
+				slot = sequence % self.ring.slots
+				capture_time = float(self.ring.times[slot][0])
+				if int(self.ring.sequences[slot][0]) == sequence:
+					if self.sequence != 0:
+						self.dropped += sequence - self.sequence - 1
+					self.sequence = sequence
+					return sequence, capture_time, self.ring.frames[slot]
+				continue # replaced between reading latest and the slot - look again
+			if time.monotonic() >= deadline:
+				return None
+			time.sleep(POLL_INTERVAL)
+	def valid(self, sequence):
+		"""Returns whether the frame with the given sequence number is still in its slot"""
+		return int(self.ring.sequences[sequence % self.ring.slots][0]) == sequence
+	def read(self, timeout = READ_TIMEOUT):
+		"""Like cv2.VideoCapture.read(): waits for the next frame and returns (True, a copy of it), or (False, None)
+		if the daemon hasn't published one within timeout seconds"""
+		reattached = False
+		while True:
+			frame = self.latest(timeout)
+			if frame is None:
+				# nothing new for a while: if the daemon was restarted, wait for a frame from its new ring instead
+				if not reattached and self.reattach():
+					reattached = True
+					continue
+				return False, None
+			sequence, capture_time, view = frame
+			image = view.copy()
+			if self.valid(sequence):
+				self.timestamp = capture_time
+				return True, image
+			# the daemon lapped us while we were copying - take the newest frame instead
+	def writer_alive(self):
+		"""Returns whether the daemon that published this ring is still running"""
+		return _alive(int(self.ring.pid[0]))
+	def release(self):
+		if self.ring is not None:
+			self.ring.close()
+			self.ring = None
+	def __str__(self):
+		return 'Camera ' + str(self.id)
+	def __repr__(self):
+		return 'Camera {} on the camera bus - frame {}'.format(self.id, self.sequence)
+
+def camera_ids():
+	"""Returns the IDs of the cameras on the bus, whether or not the daemon publishing them is still running"""
+	try:
+		files = os.listdir(SHM_DIR)
+	except FileNotFoundError:
+		return []
+	return sorted(file[len(PREFIX):] for file in files if file.startswith(PREFIX))
+
+def open_cameras(*patterns):
+	"""Like cameras.open_cameras(), but attaches to the cameras published on the bus instead of opening the devices"""
+	log = loghelper.get_logger(__file__)
+	if len(patterns) == 0:
+		patterns = ('*',)
+	opened = []
+	for camera_id in camera_ids():
+		if not any(fnmatch.fnmatch(camera_id, pattern) for pattern in patterns):
+			continue
+		try:
+			camera = BusCamera(camera_id)
+		except (OSError, cameras.CameraException):
+			log.exception('Could not attach to camera %s on the camera bus', camera_id)
+			continue
+		if not camera.writer_alive():
+			log.warning('Camera %s on the camera bus was left behind by a daemon that is no longer running. Skipping it.', camera_id)
+			camera.release()
+			continue
+		opened.append(camera)
+	log.debug('Attached to %d cameras on the camera bus', len(opened))
+	return opened
+
+class CameraBus:
+	"""The daemon side: captures from each camera in a thread of its own and publishes the frames"""
+	def __init__(self, video_cameras, slots = SLOTS):
+		self.cameras = video_cameras
+		self.slots = slots
+		self.stopped = threading.Event()
+		self.threads = []
+		self.log = loghelper.get_logger(__file__)
+	def _capture(self, camera):
+		writer = None
+		failing = False
+		try:
+			while not self.stopped.is_set():
+				ret, image = camera.read() # (OpenCV lets go of the GIL while it waits for the frame)
+				capture_time = time.monotonic()
+				if not ret:
+					if not failing:
+						self.log.error('Could not read image from camera %s', camera.id)
+					failing = True
+					self.stopped.wait(0.1)
+					continue
+				if failing:
+					self.log.info('Camera %s is delivering images again', camera.id)
+					failing = False
+				if writer is None:
+					try:
+						writer = RingWriter(camera.id, image.shape, self.slots)
+					except cameras.CameraException as ex:
+						self.log.error('%s', ex)
+						return
+					self.log.info('Publishing camera %s (%dx%d) on the camera bus', camera.id, image.shape[1], image.shape[0])
+				elif image.shape != writer.shape:
+					self.log.error('Camera %s changed resolution to %dx%d - dropping the frame', camera.id, image.shape[1], image.shape[0])
+					continue
+				writer.write(image, capture_time)
+		finally:
+			if writer is not None:
+				writer.close()
+			camera.release()
+	def start(self):
+		for camera in self.cameras:
+			thread = threading.Thread(target = self._capture, args = (camera,), name = 'Camera-%s'%(camera.id))
+			thread.start()
+			self.threads.append(thread)
+	def stop(self):
+		self.stopped.set()
+		for thread in self.threads:
+			thread.join()
+
+if __name__ == '__main__':
+	import argparse
+	import setproctitle
+	from lib import profiler
+	parser = argparse.ArgumentParser(description = 'Publish the camera feeds to shared memory for any number of local readers')
+	parser.add_argument('--filter', '-f', default = 'id*', help = 'which cameras to open - the default is \'id*\'')
+	parser.add_argument('--slots', type = int, default = SLOTS, help = 'frames kept per camera. The default is %d.'%(SLOTS))
+	args = parser.parse_args()
+	setproctitle.setproctitle('camera_bus')
+	log = loghelper.get_logger(__file__)
+	profiler.install('camera_bus')
+	bus = CameraBus(cameras.open_cameras(args.filter), args.slots)
+	if len(bus.cameras) == 0:
+		raise SystemExit('No cameras found')
+	signal.signal(signal.SIGTERM, lambda sig, frame: bus.stopped.set())
+	bus.start()
+	try:
+		while not bus.stopped.wait(1.0):
+			pass
+	except KeyboardInterrupt:
+		pass
+	bus.stop()
+	log.info('Camera bus stopped')
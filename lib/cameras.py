@@ -2,6 +2,7 @@
 
 import cv2
 import re
+import time
 import subprocess
 import fnmatch
 
@@ -16,17 +17,21 @@ class VideoCamera:
 		id is the value referred to by the agBot software to identify the camera based on its position
 		serial is a string with the serial number of the camera and will usually consist only of hexadecimal digits
 		port is the /dev/videoX port number used by the OS to identify the camera
+		timestamp is the time.monotonic() the last frame read() returned was captured at (roughly - the driver doesn't say)
 		"""
 		self.stream = stream
 		self.serial = serial
 		self.port = port
 		self.id = id
+		self.timestamp = None
 	def release(self):
 		if self.stream is not None:
 			self.stream.release()
 			self.stream = None
 	def read(self):
-		return self.stream.read()
+		ret, image = self.stream.read()
+		self.timestamp = time.monotonic()
+		return ret, image
 	def __str__(self):
 		return "Camera " + str(self.id)
 	def __repr__(self):
@@ -108,17 +113,21 @@ def open_cameras(*patterns):
 
 if __name__ == "__main__":
 	import argparse
-	import os
-	import datetime
-	import time
+	from lib import archiver
 	parser = argparse.ArgumentParser(description = "View live feed from the weed camera(s)")
 	parser.add_argument('-s', '--store', action = 'store_true', help='Select this option to store the images taken to /home/agbot/images')
 	parser.add_argument('--filter', '-f', default='*', \
 						help='Specify a filter for which cameras to open - the default is \'*\'', required=False)
+	parser.add_argument('-b', '--bus', action = 'store_true', help='Read the cameras from the camera bus (see lib/camera_bus.py) instead of opening them, so this can run alongside the processor')
 	args = parser.parse_args()
 	log.debug('Starting camera diagnostics program')
-	cameras = open_cameras(args.filter)
-	last_store_times = [datetime.datetime(1970,1,1)] * len(cameras)
+	if args.bus:
+		from lib import camera_bus
+		cameras = camera_bus.open_cameras(args.filter)
+	else:
+		cameras = open_cameras(args.filter)
+	# frames are saved in the background, so storing them doesn't slow down capture. Min delay between frames is 0.1 sec
+	frame_archive = archiver.Archiver(policy = archiver.SamplingPolicy(every_n = 1, interval = 0.1)) if args.store else None
 	try:
 		while True:
 			for i in range(0, len(cameras)):
@@ -128,10 +137,8 @@ if __name__ == "__main__":
 					cameras.remove(cameras[i])
 				else:
 					cv2.imshow(str(cameras[i]), img)
-					now = datetime.datetime.now()
-					if args.store and (now - last_store_times[i]).total_seconds() > 0.1: # min delay between frames is 0.1 sec
-						cv2.imwrite('/home/agbot/images/%s-%s.jpg'%(datetime.datetime.now().isoformat(), str(cameras[i])), img)
-						last_store_times[i] = now
+					if frame_archive is not None:
+						frame_archive.offer(cameras[i].id, img, cameras[i].timestamp)
 			if len(cameras) == 0 or (cv2.waitKey(1) & 0xFF == ord('q')):
 				break
 	except KeyboardInterrupt:
@@ -139,4 +146,6 @@ if __name__ == "__main__":
 	finally:
 		for camera in cameras:
 			camera.release()
+		if frame_archive is not None:
+			frame_archive.close()
 		cv2.destroyAllWindows()
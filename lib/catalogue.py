@@ -0,0 +1,202 @@
+#!/usr/bin/python
+'''
+A small SQLite index of every finished record, with a summary of each, so listing and summarizing records doesn't
+require parsing record files - or even looking at them. The processor adds each record as it finishes it; records
+that turn up any other way (offline.py, conversion, archiving, copying by hand) or disappear are caught up with by
+reconcile(), which compares the catalogue with a stat() of every record file. The server runs it in a worker process
+(see server.py), never while answering a request. A new catalogue starts out empty until it has been reconciled. It
+can also be rebuilt from scratch with
+	python -m lib.catalogue --rebuild
+'''
+
+import os
+import sqlite3
+import threading
+import contextlib
+import numpy
+
+from lib import records
+from lib import plants
+from lib import loghelper
+
+FILE_NAME = 'catalogue.db'
+
+# plant counts are stored in one column per kind of plant
+_PLANT_COLUMNS = [(plant, plant.name.lower()) for plant in plants.Plants if plant != plants.Plants.NONE]
+
+_SCHEMA = '''CREATE TABLE IF NOT EXISTS records (
+	record_id TEXT PRIMARY KEY,
+	name TEXT NOT NULL,
+	start_time TEXT,
+	end_time TEXT,
+	longitude REAL,
+	latitude REAL,
+	line_count INTEGER NOT NULL,
+	%s,
+	min_longitude REAL,
+	min_latitude REAL,
+	max_longitude REAL,
+	max_latitude REAL,
+	size INTEGER NOT NULL,
+	mtime_ns INTEGER NOT NULL
+)'''%(',\n\t'.join('%s INTEGER NOT NULL'%(column) for _, column in _PLANT_COLUMNS))
+
+# columns that listings may be sorted by
+SORT_COLUMNS = ('record_id', 'name', 'start_time', 'end_time', 'line_count')
+
+_lock = threading.Lock()
+_initialized = set()
+_unreadable = {} # record ID -> (size, mtime_ns) of a file that couldn't be read, so it isn't tried again until it changes
+
+def _path():
+	return os.path.join(records.DIR, FILE_NAME)
+
+def _connect():
+	path = _path()
+	connection = sqlite3.connect(path, timeout = 5.0)
+	connection.row_factory = sqlite3.Row
+	with _lock:
+		if path not in _initialized:
+			connection.execute(_SCHEMA)
+			connection.commit()
+			_initialized.add(path)
+	return connection
+
+@contextlib.contextmanager
+def _open():
+	connection = _connect()
+	try:
+		yield connection
+	finally:
+		connection.close()
+
+def summarize(record):
+	"""Returns a dict with the catalogue entry for a Record (every column except size and mtime_ns)"""
+	array = record.array()
+	entry = { 'record_id': record.record_id, 'name': record.name, 'line_count': len(array) }
+	for plant, column in _PLANT_COLUMNS:
+		entry[column] = int(numpy.count_nonzero(numpy.asarray(array['rows']) & int(plant)))
+	if len(array) == 0:
+		for column in ('start_time', 'end_time', 'longitude', 'latitude', 'min_longitude', 'min_latitude', 'max_longitude', 'max_latitude'):
+			entry[column] = None
+		return entry
+	summary = record.get_summary()
+	entry.update({
+		'start_time': summary.start_time.isoformat(),
+		'end_time': summary.end_time.isoformat(),
+		'longitude': summary.longitude,
+		'latitude': summary.latitude,
+		'min_longitude': float(array['longitude'].min()),
+		'min_latitude': float(array['latitude'].min()),
+		'max_longitude': float(array['longitude'].max()),
+		'max_latitude': float(array['latitude'].max()),
+	})
+	return entry
+
+def plant_counts(entry):
+	"""Returns { plant column: number of lines with that plant } for a catalogue entry"""
+	return { column: entry[column] for _, column in _PLANT_COLUMNS }
+
+def _add(connection, record_id):
+	stat = os.stat(records.get_path(record_id))
+	entry = summarize(records.Record.read(record_id))
+	entry['size'] = stat.st_size
+	entry['mtime_ns'] = stat.st_mtime_ns
+	columns = list(entry.keys())
+	connection.execute('INSERT OR REPLACE INTO records (%s) VALUES (%s)'%(', '.join(columns), ', '.join('?' * len(columns))), \
+		[entry[column] for column in columns])
+	connection.commit()
+	return entry
+
+def add(record_id):
+	"""Adds (or updates) the catalogue entry for a record, and returns it"""
+	with _open() as connection:
+		return _add(connection, record_id)
+
+def remove(record_id):
+	with _open() as connection:
+		connection.execute('DELETE FROM records WHERE record_id = ?', (record_id,))
+		connection.commit()
+
+def get(record_id):
+	"""Returns the catalogue entry for a record as a dict. Records that aren't in the catalogue yet, or whose file
+	has changed since they were added, are (re-)added first. Raises a FileNotFoundError if there is no such record."""
+	stat = os.stat(records.get_path(record_id))
+	with _open() as connection:
+		row = connection.execute('SELECT * FROM records WHERE record_id = ?', (record_id,)).fetchone()
+		if row is not None and row['size'] == stat.st_size and row['mtime_ns'] == stat.st_mtime_ns:
+			return dict(row)
+		return _add(connection, record_id)
+
+def _try_add(connection, record_id):
+	"""Like _add(), but logs and returns None if the record can't be read, rather than losing the rest of a rebuild
+	or reconcile to one bad file"""
+	try:
+		return _add(connection, record_id)
+	except Exception:
+		loghelper.get_logger(__file__).exception('Could not add record %s to the catalogue - leaving it out', record_id)
+		return None
+
+def reconcile():
+	"""Brings the catalogue up to date with the record files: (re-)adds the records whose files aren't in the
+	catalogue or have changed since they were added, and drops the entries whose files are gone. Only the new and
+	changed records are read, and a file that can't be read isn't tried again until it changes."""
+	with _open() as connection:
+		_reconcile(connection)
+
+def _reconcile(connection):
+	known = { row['record_id']: (row['size'], row['mtime_ns']) for row in connection.execute('SELECT record_id, size, mtime_ns FROM records') }
+	for record_id, name in records.get_records():
+		if record_id == records.CURRENT:
+			continue
+		try:
+			stat = os.stat(records.get_path(record_id))
+		except FileNotFoundError:
+			continue # deleted while we were looking
+		version = (stat.st_size, stat.st_mtime_ns)
+		if known.pop(record_id, None) == version or _unreadable.get(record_id) == version:
+			continue
+		if _try_add(connection, record_id) is None:
+			_unreadable[record_id] = version
+		else:
+			_unreadable.pop(record_id, None)
+	for record_id in known:
+		connection.execute('DELETE FROM records WHERE record_id = ?', (record_id,))
+	connection.commit()
+
+def list_records(sort = 'start_time', descending = False, offset = 0, limit = None):
+	"""Returns a page of catalogue entries (as dicts), sorted by one of SORT_COLUMNS"""
+	if sort not in SORT_COLUMNS:
+		raise ValueError('Cannot sort records by %s'%(sort))
+	with _open() as connection:
+		rows = connection.execute('SELECT * FROM records ORDER BY %s %s, record_id LIMIT ? OFFSET ?'%(sort, 'DESC' if descending else 'ASC'), \
+			(limit if limit is not None else -1, offset)).fetchall()
+		return [dict(row) for row in rows]
+
+def count():
+	with _open() as connection:
+		return connection.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+
+def _rebuild(connection):
+	connection.execute('DELETE FROM records')
+	for record_id, name in records.get_records():
+		if record_id != records.CURRENT:
+			_try_add(connection, record_id)
+	connection.commit()
+
+def rebuild():
+	"""Throws away the catalogue and re-creates it from the record files"""
+	with _open() as connection:
+		_rebuild(connection)
+
+if __name__ == '__main__':
+	import argparse
+	parser = argparse.ArgumentParser(description = 'Maintain the catalogue of records')
+	parser.add_argument('--rebuild', action = 'store_true', help = 'Re-create the catalogue from the record files')
+	args = parser.parse_args()
+	if args.rebuild:
+		rebuild()
+	else:
+		reconcile()
+	for entry in list_records():
+		print('%s\t%s\t%s\t%d lines'%(entry['record_id'], entry['start_time'], entry['end_time'], entry['line_count']))
@@ -0,0 +1,132 @@
+import json
+import os
+import queue
+import socket
+import threading
+import time
+
+# The processor publishes events as JSON datagrams on a local socket, and the server relays them to web browsers.
+# Datagrams either arrive whole or not at all, and sending never waits for the server - if it isn't listening (or
+# can't keep up), events are simply dropped, which is fine for a live display.
+SOCKET_PATH = '/tmp/agbot-events.sock'
+MAX_DATAGRAM = 64 * 1024
+QUEUE_SIZE = 256 # events waiting to be sent to one client before the oldest are dropped
+
+class Publisher:
+	"""Sends events to whoever is listening on SOCKET_PATH"""
+	def __init__(self, path = SOCKET_PATH):
+		self.path = path
+		self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+		self.socket.setblocking(False)
+	def publish(self, type, **data):
+		"""Sends one event. data must be JSON-serializable. Returns whether the event was sent."""
+		data['type'] = type
+		data.setdefault('time', time.time())
+		try:
+			self.socket.sendto(json.dumps(data).encode('utf-8'), self.path)
+			return True
+		except (FileNotFoundError, ConnectionRefusedError, BlockingIOError):
+			return False # nobody listening, or the listener is behind
+	def close(self):
+		self.socket.close()
+
+class Subscription:
+	"""A bounded queue of the events for one client. If the client falls behind, the oldest events are dropped."""
+	def __init__(self, size = QUEUE_SIZE):
+		self.events = queue.Queue(size)
+		self.dropped = 0
+	def put(self, event):
+		while True:
+			try:
+				self.events.put_nowait(event)
+				return
+			except queue.Full:
+				try:
+					self.events.get_nowait()
+					self.dropped += 1
+				except queue.Empty:
+					pass
+	def get(self, timeout = None):
+		"""Returns the next event (a dict), None if the hub was closed, or raises queue.Empty after timeout seconds"""
+		return self.events.get(timeout = timeout)
+
+class EventHub:
+	"""Listens on SOCKET_PATH in a background thread and hands every event to each current Subscription. The most
+	recent event of each type is kept too, so new subscribers can be brought up to date straight away."""
+	def __init__(self, path = SOCKET_PATH):
+		self.path = path
+		self.socket = None
+		self.thread = None
+		self.lock = threading.Lock()
+		self.subscriptions = set()
+		self.latest = {}
+	def start(self):
+		try:
+			os.remove(self.path) # left over from a previous run
+		except FileNotFoundError:
+			pass
+		self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+		self.socket.bind(self.path)
+		self.thread = threading.Thread(target = self._run, name = 'EventHub', daemon = True)
+		self.thread.start()
+	def stop(self):
+		if self.socket is None:
+			return
+		# wakes up the thread, which then sees the socket is gone
+		self.socket.shutdown(socket.SHUT_RDWR)
+		self.thread.join()
+		self.socket.close()
+		self.socket = None
+		try:
+			os.remove(self.path)
+		except FileNotFoundError:
+			pass
+		with self.lock:
+			for subscription in self.subscriptions:
+				subscription.put(None)
+	def _run(self):
+		while True:
+			try:
+				data = self.socket.recv(MAX_DATAGRAM)
+			except OSError:
+				return
+			if len(data) == 0:
+				return # shut down
+			try:
+				event = json.loads(data.decode('utf-8'))
+			except ValueError:
+				continue
+			self.publish(event)
+	def publish(self, event):
+		"""Hands an event (a dict with at least a 'type') to every subscriber"""
+		with self.lock:
+			self.latest[event.get('type')] = event
+			for subscription in self.subscriptions:
+				subscription.put(event)
+	def subscribe(self):
+		"""Returns a new Subscription, along with the latest event of each type"""
+		subscription = Subscription()
+		with self.lock:
+			self.subscriptions.add(subscription)
+			return subscription, list(self.latest.values())
+	def last(self, type):
+		"""Returns the most recent event of the given type, or None if there hasn't been one"""
+		with self.lock:
+			return self.latest.get(type)
+	def unsubscribe(self, subscription):
+		with self.lock:
+			self.subscriptions.discard(subscription)
+
+if __name__ == '__main__':
+	import argparse
+	parser = argparse.ArgumentParser(description = 'Print the events published by the processor')
+	parser.add_argument('-s', '--socket', default = SOCKET_PATH, help = 'Socket to listen on (default: %s)'%(SOCKET_PATH))
+	args = parser.parse_args()
+	hub = EventHub(args.socket)
+	subscription, _ = hub.subscribe()
+	hub.start()
+	try:
+		while True:
+			print(json.dumps(subscription.get()))
+	except KeyboardInterrupt:
+		hub.stop()
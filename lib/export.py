@@ -0,0 +1,73 @@
+import numpy
+
+from lib import records
+from lib import plants
+from lib import positioning
+
+FORMATS = ('geojson', 'csv')
+CONTENT_TYPES = { 'geojson': 'application/geo+json', 'csv': 'text/csv' }
+
+_KINDS = [plant for plant in plants.Plants if plant != plants.Plants.NONE]
+
+def detections(record_id, chunk_lines = records.CHUNK_LINES):
+	"""Reads a record a chunk at a time (see records.iter_chunks()) and yields, for each chunk and kind of plant, a tuple
+	(times, longitudes, latitudes, row numbers, plant) of arrays with one entry per plant found. Positions are those of the
+	plants themselves: each row's offset from ROW_DIST is applied at right angles to the direction of travel."""
+	previous = None # last line of the previous chunk, for the heading of the first line of the next one
+	for chunk in records.iter_chunks(record_id, chunk_lines):
+		if len(chunk) == 0:
+			continue
+		longitudes, latitudes = numpy.asarray(chunk['longitude']), numpy.asarray(chunk['latitude'])
+		if previous is not None:
+			longitudes, latitudes = numpy.concatenate(([previous[0]], longitudes)), numpy.concatenate(([previous[1]], latitudes))
+		east, north = records.project(longitudes, latitudes, longitudes[0], latitudes[0])
+		offsets = records.row_positions(east, north) - numpy.stack((east, north), axis = 1)[:, None, :]
+		if previous is not None:
+			offsets = offsets[1:]
+		previous = (float(chunk['longitude'][-1]), float(chunk['latitude'][-1]))
+		rows = numpy.asarray(chunk['rows'])
+		times = numpy.datetime_as_string(numpy.asarray(chunk['timestamp']).astype('datetime64[us]'))
+		for plant in _KINDS:
+			line, row = numpy.nonzero(rows & int(plant))
+			if len(line) == 0:
+				continue
+			longitude, latitude = positioning.offset_position(chunk['longitude'][line], chunk['latitude'][line], \
+				offsets[line, row, 0], offsets[line, row, 1])
+			yield times[line], longitude, latitude, row, plant
+
+def geojson(record_id):
+	"""Yields a record as a GeoJSON FeatureCollection, with one Point feature per plant found, in pieces of bytes"""
+	yield b'{"type": "FeatureCollection", "features": ['
+	first = True
+	for times, longitudes, latitudes, rows, plant in detections(record_id):
+		features = ',\n'.join('{"type": "Feature", "geometry": {"type": "Point", "coordinates": [%.8f, %.8f]}, ' \
+			'"properties": {"time": "%s", "plant": "%s", "row": %d}}'%(longitude, latitude, time, plant.name, row) \
+			for time, longitude, latitude, row in zip(times, longitudes, latitudes, rows))
+		yield (('\n' if first else ',\n') + features).encode('utf-8')
+		first = False
+	yield b'\n]}\n'
+
+def csv(record_id):
+	"""Yields a record as CSV, with one line per plant found, in pieces of bytes"""
+	yield b'time,longitude,latitude,plant,row\n'
+	for times, longitudes, latitudes, rows, plant in detections(record_id):
+		yield ''.join('%s,%.8f,%.8f,%s,%d\n'%(time, longitude, latitude, plant.name, row) \
+			for time, longitude, latitude, row in zip(times, longitudes, latitudes, rows)).encode('utf-8')
+
+def export(record_id, format):
+	"""Returns a generator of the record in the given format (one of FORMATS). Raises a FileNotFoundError right away
+	(rather than on the first read) if there is no such record."""
+	if format not in FORMATS:
+		raise ValueError('Unknown export format %s'%(format))
+	records.get_path(record_id)
+	return geojson(record_id) if format == 'geojson' else csv(record_id)
+
+if __name__ == '__main__':
+	import argparse
+	import sys
+	parser = argparse.ArgumentParser(description = 'Export the plants found in a record')
+	parser.add_argument('record_id', help = 'Record to export')
+	parser.add_argument('-f', '--format', choices = FORMATS, default = 'csv', help = 'Output format (default: csv)')
+	args = parser.parse_args()
+	for data in export(args.record_id, args.format):
+		sys.stdout.buffer.write(data)
@@ -0,0 +1,114 @@
+import json
+import socket
+import threading
+import time
+import datetime
+
+from lib import loghelper
+from lib import procs
+from lib import nmea
+from lib import multivator
+from lib import speed_ctrl
+
+# the processor reports its loop rate and camera frames in a 'health' event about once a second (see processor.py);
+# a report older than this means the processor has stalled
+REPORT_STALE = 5.0 # seconds
+# how long to wait for the multivator or speed controller to accept a connection before calling it unreachable
+DEVICE_TIMEOUT = 0.5 # seconds
+
+def _number(value, type):
+	try:
+		return type(value)
+	except (TypeError, ValueError):
+		return None
+
+def _ping(ip, port, timeout = DEVICE_TIMEOUT):
+	"""Checks that a device accepts TCP connections, and times how long connecting takes. Nothing is sent: the devices
+	treat any message as a keep-alive, and a health check mustn't keep a device alive that has lost its real client."""
+	start = time.monotonic()
+	try:
+		with socket.create_connection((ip, port), timeout):
+			pass
+	except OSError as ex:
+		return { 'reachable': False, 'rtt': None, 'error': str(ex) }
+	return { 'reachable': True, 'rtt': time.monotonic() - start }
+
+def gps_status():
+	"""Returns the age (seconds since the NMEA listener received it) and quality of the latest GPS fix"""
+	try:
+		received, gga = nmea.read_timestamped(nmea.GGA)
+	except Exception as ex: # not set up, no data yet, or a garbled sentence
+		return { 'fixAge': None, 'quality': None, 'error': str(ex) }
+	return {
+		'fixAge': time.monotonic() - received if received is not None else None,
+		'quality': _number(gga.gps_qual, int), # 0 = no fix, 1 = GPS, 2 = DGPS, 4 = RTK fixed, 5 = RTK float
+		'satellites': _number(gga.num_sats, int),
+		'hdop': _number(gga.horizontal_dil, float),
+	}
+
+def processor_status(report, now = None):
+	"""Returns the status of the processor and its cameras, given the latest 'health' event it published (or None)"""
+	now = time.time() if now is None else now
+	pid = procs.processor_pid()
+	age = now - report['time'] if report is not None else None
+	fresh = pid is not None and age is not None and age < REPORT_STALE
+	status = {
+		'running': pid is not None,
+		'pid': pid,
+		'reportAge': age,
+		'loopRate': report.get('loopRate') if fresh else None,
+		'inRow': report.get('inRow') if fresh else None,
+		# frames processed, deadline misses, coverage gaps etc. since the processor started - see lib/scheduler.py
+		'scheduler': report.get('scheduler') if fresh else None,
+		'archive': report.get('archive') if fresh else None, # see lib/archiver.py
+	}
+	# frame ages were measured when the report was sent, so add on how long ago that was
+	cameras = {}
+	if pid is not None and report is not None:
+		for camera, frame_age in report.get('cameras', {}).items():
+			cameras[camera] = { 'lastFrameAge': frame_age + age if frame_age is not None else None }
+	return status, cameras
+
+class HealthCollector:
+	"""Puts together one health document for the whole system - processor, cameras, GPS and devices - and keeps it,
+	so answering a request for it never waits on a device. refresh() does the slow part (running pidof, reading the
+	NMEA files, connecting to the devices) and is meant to be called from a background thread on a schedule of its
+	own. hub is the events.EventHub that receives the processor's 'health' events (or None)."""
+	def __init__(self, hub = None):
+		self.hub = hub
+		self.lock = threading.Lock()
+		self.document = None
+		self.encoded = None
+	def collect(self):
+		"""Gathers the health document from scratch"""
+		now = time.time()
+		processor, cameras = processor_status(self.hub.last('health') if self.hub is not None else None, now)
+		return {
+			'time': datetime.datetime.fromtimestamp(now).isoformat(),
+			'processor': processor,
+			'cameras': cameras,
+			'gps': gps_status(),
+			'multivator': _ping(multivator.DEFAULT_IP, multivator.DEFAULT_PORT),
+			'speedController': _ping(speed_ctrl.DEFAULT_IP, speed_ctrl.DEFAULT_PORT),
+		}
+	def refresh(self):
+		"""Collects a new health document. If that fails, the previous one is kept (and the error logged) - a
+		background task that raises is stopped for good."""
+		try:
+			document = self.collect()
+		except Exception:
+			loghelper.get_logger(__file__).exception('Could not collect health')
+			return
+		encoded = json.dumps(document).encode('utf-8')
+		with self.lock:
+			self.document, self.encoded = document, encoded
+	def get(self):
+		"""Returns the latest health document as JSON-encoded bytes, or None if refresh() hasn't finished yet"""
+		with self.lock:
+			return self.encoded
+
+if __name__ == '__main__':
+	import argparse
+	parser = argparse.ArgumentParser(description = 'Print the health of the processor, GPS and devices')
+	args = parser.parse_args()
+	print(json.dumps(HealthCollector().collect(), indent = '\t'))
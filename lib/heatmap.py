@@ -0,0 +1,163 @@
+import hashlib
+import math
+import os
+import cv2
+import numpy
+
+from lib import records
+from lib import plants
+from lib import export
+
+# Every record is binned into the same grid of CELL_DEGREES x CELL_DEGREES cells, anchored at longitude/latitude 0,
+# so counts from different records (and different days) line up and can simply be added. A cell is about 10ft
+# north-south; east-west it is narrower by the cosine of the latitude.
+CELL_DEGREES = 3e-5
+BACKGROUND = 200
+
+KINDS = [plant for plant in plants.Plants if plant != plants.Plants.NONE]
+
+class Aggregate:
+	"""Plant counts per grid cell, stored sparsely: cols and rows are the integer cell indices (longitude and latitude
+	divided by CELL_DEGREES) of every cell with at least one plant, and counts has one column per kind in KINDS"""
+	def __init__(self, cols, rows, counts):
+		self.cols = cols
+		self.rows = rows
+		self.counts = counts
+	def __len__(self):
+		return len(self.cols)
+	@classmethod
+	def empty(cls):
+		return Aggregate(numpy.zeros(0, numpy.int64), numpy.zeros(0, numpy.int64), numpy.zeros((0, len(KINDS)), numpy.int64))
+	@classmethod
+	def combine(cls, aggregates):
+		"""Adds up a list of Aggregates"""
+		aggregates = [aggregate for aggregate in aggregates if len(aggregate) != 0]
+		if len(aggregates) == 0:
+			return cls.empty()
+		cols = numpy.concatenate([aggregate.cols for aggregate in aggregates])
+		rows = numpy.concatenate([aggregate.rows for aggregate in aggregates])
+		counts = numpy.concatenate([aggregate.counts for aggregate in aggregates])
+		# number the cells row by row across the bounding box of all of them, then add up the counts per number
+		min_col, min_row = cols.min(), rows.min()
+		height = rows.max() - min_row + 1
+		keys, inverse = numpy.unique((cols - min_col) * height + (rows - min_row), return_inverse = True)
+		total = numpy.stack([numpy.bincount(inverse, weights = counts[:, k], minlength = len(keys)) for k in range(len(KINDS))], axis = 1)
+		return Aggregate(keys // height + min_col, keys % height + min_row, total.astype(numpy.int64))
+	def save(self, path):
+		temp = path + '.tmp.npz'
+		numpy.savez(temp, cols = self.cols, rows = self.rows, counts = self.counts)
+		os.rename(temp, path)
+	@classmethod
+	def load(cls, path):
+		with numpy.load(path) as data:
+			return Aggregate(data['cols'], data['rows'], data['counts'])
+	def to_json(self):
+		"""Returns the aggregate as a dict of parallel lists: the longitude and latitude of the center of each cell,
+		and the number of each kind of plant in it"""
+		result = {
+			'cellDegrees': CELL_DEGREES,
+			'longitude': ((self.cols + 0.5) * CELL_DEGREES).tolist(),
+			'latitude': ((self.rows + 0.5) * CELL_DEGREES).tolist(),
+		}
+		for k, plant in enumerate(KINDS):
+			result[plant.name] = self.counts[:, k].tolist()
+		return result
+	def render(self, plant_types = plants.Plants.NONE, width = records.MAX_IMG_WIDTH, height = records.MAX_IMG_HEIGHT):
+		"""Draws the counts of the given plant types (all of them, by default) as a heatmap no bigger than width x
+		height pixels. Cells are colored from blue (few plants) to red (the most plants in any cell)."""
+		if len(self) == 0:
+			return numpy.full((height, width, 3), BACKGROUND, numpy.uint8)
+		selected = [k for k, plant in enumerate(KINDS) if plant_types == plants.Plants.NONE or plant & plant_types]
+		counts = self.counts[:, selected].sum(axis = 1)
+		# east-west cells are narrower than north-south ones, so stretch the grid to keep the map's proportions
+		aspect = math.cos(math.radians(float(self.rows.mean()) * CELL_DEGREES))
+		west, south = int(self.cols.min()), int(self.rows.min())
+		columns, rows = int(self.cols.max()) - west + 1, int(self.rows.max()) - south + 1
+		# merge cells if there are more of them than pixels
+		factor = max(1, math.ceil(max(columns * aspect / width, rows / height)))
+		columns, rows = (columns + factor - 1) // factor, (rows + factor - 1) // factor
+		grid = numpy.zeros((rows, columns), numpy.int64)
+		numpy.add.at(grid, (rows - 1 - (self.rows - south) // factor, (self.cols - west) // factor), counts)
+		scale = min(width / (columns * aspect), height / rows)
+		size = (max(1, round(columns * aspect * scale)), max(1, round(rows * scale)))
+		level = numpy.log1p(grid) / max(math.log1p(grid.max()), 1e-9)
+		img = cv2.applyColorMap((255 * level).astype(numpy.uint8), cv2.COLORMAP_JET)
+		img[grid == 0] = BACKGROUND
+		return cv2.resize(img, size, interpolation = cv2.INTER_NEAREST)
+
+def aggregate_record(record_id):
+	"""Bins every plant found in a record into the shared grid. This reads the whole record; see partial() for the
+	cached version."""
+	parts = []
+	for times, longitudes, latitudes, rows, plant in export.detections(record_id):
+		k = KINDS.index(plant)
+		counts = numpy.zeros((len(longitudes), len(KINDS)), numpy.int64)
+		counts[:, k] = 1
+		parts.append(Aggregate(numpy.floor(longitudes / CELL_DEGREES).astype(numpy.int64), \
+			numpy.floor(latitudes / CELL_DEGREES).astype(numpy.int64), counts))
+	return Aggregate.combine(parts)
+
+def _cache_dir():
+	return os.path.join(records.DIR, '.cache', 'heatmap')
+
+def _version(record_id):
+	stat = os.stat(records.get_path(record_id))
+	return '%s-%x-%x'%(os.path.basename(record_id), stat.st_size, stat.st_mtime_ns)
+
+def partial(record_id):
+	"""Returns the Aggregate of one record, from the cache if it is there and the record hasn't changed since.
+	Raises a FileNotFoundError if there is no such record."""
+	version = _version(record_id)
+	path = os.path.join(_cache_dir(), version + '.npz')
+	try:
+		return Aggregate.load(path)
+	except (OSError, ValueError, KeyError):
+		pass
+	aggregate = aggregate_record(record_id)
+	if record_id == records.CURRENT:
+		return aggregate # still growing - not worth caching
+	try:
+		os.makedirs(_cache_dir(), exist_ok = True)
+		# throw away aggregates of older versions of the same record
+		prefix = os.path.basename(record_id) + '-'
+		for file in os.listdir(_cache_dir()):
+			if file.startswith(prefix) and file.endswith('.npz'):
+				os.remove(os.path.join(_cache_dir(), file))
+		aggregate.save(path)
+	except OSError:
+		pass # the cache is only an optimization
+	return aggregate
+
+def aggregate(record_ids):
+	"""Returns the combined Aggregate of the given records. Records that don't exist are skipped."""
+	parts = []
+	for record_id in record_ids:
+		try:
+			parts.append(partial(record_id))
+		except FileNotFoundError:
+			pass
+	return Aggregate.combine(parts)
+
+def version(record_ids):
+	"""Returns a string that changes whenever the heatmap of the given records would"""
+	digest = hashlib.sha1()
+	for record_id in sorted(record_ids):
+		try:
+			digest.update(_version(record_id).encode('utf-8'))
+		except FileNotFoundError:
+			pass
+		digest.update(b'\0')
+	return digest.hexdigest()
+
+if __name__ == '__main__':
+	import argparse
+	parser = argparse.ArgumentParser(description = 'Draw a heatmap of the plants found in a set of records')
+	parser.add_argument('record_ids', nargs = '*', help = 'Records to include (default: all finished records)')
+	parser.add_argument('-p', '--plants', help = 'Plant types to count, e.g. Foxtail,Ragweed (default: all)')
+	parser.add_argument('-o', '--output', default = 'heatmap.png', help = 'Image file to write')
+	args = parser.parse_args()
+	record_ids = args.record_ids or [record_id for record_id, name in records.get_records() if record_id != records.CURRENT]
+	plant_types = plants.Plants.deserialize(args.plants.replace(',', '|')) if args.plants else plants.Plants.NONE
+	heatmap = aggregate(record_ids)
+	print('%d records, %d cells, %d plants'%(len(record_ids), len(heatmap), int(heatmap.counts.sum())))
+	cv2.imwrite(args.output, heatmap.render(plant_types))
@@ -0,0 +1,102 @@
+import math
+import threading
+import cv2
+import numpy
+
+from lib import records
+
+# the live map starts out showing this many feet across, and zooms out by ZOOM_STEP whenever the BOT leaves it
+INITIAL_WIDTH_FT = 100.0
+ZOOM_STEP = 2
+BACKGROUND = 200
+
+class LiveMap:
+	"""Renders a record that is still growing (i.e. CURRENT) onto a persistent canvas, drawing only the lines that
+	were appended since the last update. The canvas has a fixed size in pixels; when the BOT drives off the edge, the
+	existing picture is shrunk by a factor of ZOOM_STEP (or a power of it) and the map zooms out, so re-projecting
+	happens rarely and the cost of an update depends on the amount of new data, not the length of the run.
+	After each update, jpeg holds the encoded image and version identifies it."""
+	def __init__(self, width = records.MAX_IMG_WIDTH, height = records.MAX_IMG_HEIGHT):
+		self.width = width
+		self.height = height
+		self.lock = threading.Lock()
+		self.generation = -1
+		self._reset(None)
+	@staticmethod
+	def _key(record):
+		if record is not None and record.generation is not None:
+			return (record.record_id, record.generation)
+		return id(record)
+	def _reset(self, record):
+		self.record = record
+		self.count = 0
+		self.origin = None # (longitude, latitude) that all positions are projected around
+		self.last = None # projected (east, north) of the last line drawn, for working out the next heading
+		self.scale = self.width / INITIAL_WIDTH_FT # pixels per foot
+		self.west = -INITIAL_WIDTH_FT / 2 # feet east of the origin at the left edge of the canvas
+		self.north = self.height / self.scale / 2 # feet north of the origin at the top edge of the canvas
+		self.canvas = numpy.full((self.height, self.width, 3), BACKGROUND, numpy.uint8)
+		self.generation += 1
+		self.jpeg = None
+		self.version = None
+	def update(self, record):
+		"""Draws any lines of record that haven't been drawn yet and re-encodes the image if anything changed.
+		Passing a different record - another Record object, unless both are snapshots of the same run of a live record
+		(see records.RecordTail) - or one that got shorter starts the map over."""
+		with self.lock:
+			if self._key(record) != self._key(self.record) or len(record) < self.count:
+				self._reset(record)
+			array = record.array()
+			new = array[self.count:]
+			if len(new) == 0 and self.jpeg is not None:
+				return False
+			if len(new) != 0:
+				if self.origin is None:
+					self.origin = (float(new['longitude'][0]), float(new['latitude'][0]))
+				east, north = records.project(new['longitude'], new['latitude'], *self.origin)
+				if self.last is not None:
+					# include the previous line so the first new line gets a proper heading
+					posns = records.row_positions(numpy.concatenate(([self.last[0]], east)), numpy.concatenate(([self.last[1]], north)))[1:]
+				else:
+					posns = records.row_positions(east, north)
+				self._fit(posns)
+				radius_px = math.ceil(self.scale * records.PLANT_RADIUS_FT)
+				xs = (self.scale * (posns[:, :, 0] - self.west)).astype(numpy.intp)
+				ys = (self.scale * (self.north - posns[:, :, 1])).astype(numpy.intp)
+				records.draw_plants(self.canvas, xs.ravel(), ys.ravel(), numpy.asarray(new['rows']).ravel(), radius_px)
+				self.last = (float(east[-1]), float(north[-1]))
+				self.count = len(array)
+			retval, stream = cv2.imencode('.jpeg', self.canvas)
+			if retval:
+				self.jpeg = stream.tobytes()
+				self.version = '%s-live-%x-%x'%(record.record_id, self.generation, self.count)
+			return True
+	def _fit(self, posns):
+		"""Zooms out until every position in posns (plus a margin) is on the canvas"""
+		margin = records.ROW_DIST[-1] + records.PLANT_RADIUS_FT + 3
+		min_east, max_east = float(posns[:, :, 0].min()) - margin, float(posns[:, :, 0].max()) + margin
+		min_north, max_north = float(posns[:, :, 1].min()) - margin, float(posns[:, :, 1].max()) + margin
+		width_ft, height_ft = self.width / self.scale, self.height / self.scale
+		east_edge, south_edge = self.west + width_ft, self.north - height_ft
+		if min_east >= self.west and max_east <= east_edge and min_north >= south_edge and max_north <= self.north:
+			return
+		# the new view has to cover both what's on the canvas already and the new positions
+		min_east, max_east = min(min_east, self.west), max(max_east, east_edge)
+		min_north, max_north = min(min_north, south_edge), max(max_north, self.north)
+		factor = ZOOM_STEP
+		while self.width / (self.scale / factor) < max_east - min_east or self.height / (self.scale / factor) < max_north - min_north:
+			factor *= ZOOM_STEP
+		scale = self.scale / factor
+		# center the covered area, then snap so the old canvas lands on whole pixels
+		offset_x = int(round((self.west - ((min_east + max_east) / 2 - self.width / scale / 2)) * scale))
+		offset_y = int(round((((min_north + max_north) / 2 + self.height / scale / 2) - self.north) * scale))
+		old_width, old_height = self.width // factor, self.height // factor
+		offset_x = min(max(offset_x, 0), self.width - old_width)
+		offset_y = min(max(offset_y, 0), self.height - old_height)
+		canvas = numpy.full((self.height, self.width, 3), BACKGROUND, numpy.uint8)
+		canvas[offset_y:offset_y + old_height, offset_x:offset_x + old_width] = \
+			cv2.resize(self.canvas, (old_width, old_height), interpolation = cv2.INTER_AREA)
+		self.canvas = canvas
+		self.west -= offset_x / scale
+		self.north += offset_y / scale
+		self.scale = scale
@@ -1,16 +1,156 @@
 # For logging API documentation see https://docs.python.org/3/library/logging.html
 
+import atexit
+import datetime
+import json
 import logging
 from logging import handlers
 import os
+import queue
+import threading
+
+LOG_PATH = '/var/log/agbot.log'
+# Log records are handed to a background thread through a bounded queue, so logging never does file I/O (or midnight
+# rotation) on the caller's thread. If the writer falls behind and the queue fills up, records are dropped rather than
+# making the caller wait, and a warning saying how many were lost is logged once there is room again.
+QUEUE_SIZE = 10000
+# The same message (same logger, level and text) logged again within REPEAT_INTERVAL seconds of the first time is
+# counted instead of written, and a single '(repeated N times)' line is written for it when the interval is up.
+REPEAT_INTERVAL = 10.0 # seconds
+MAX_REPEATS_TRACKED = 1000
+# set AGBOT_LOG_JSON=1 to write one JSON object per line instead of tab-separated text
+JSON_ENV = 'AGBOT_LOG_JSON'
+
+class JSONFormatter(logging.Formatter):
+	"""Formats each record as a compact JSON object on one line"""
+	def format(self, record):
+		entry = {
+			'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec = 'milliseconds'),
+			'name': record.name,
+			'level': record.levelname,
+			'message': record.getMessage(),
+		}
+		# (by the time records get here, AsyncHandler has already appended any traceback to the message)
+		if getattr(record, 'repeated', None):
+			entry['repeated'] = record.repeated
+		return json.dumps(entry)
+
+class RepeatSuppressor:
+	"""Decides which records get written: the first of a run of identical messages is, then later copies are only
+	counted, and every REPEAT_INTERVAL a summary record stands in for the copies since"""
+	def __init__(self, interval = REPEAT_INTERVAL, max_tracked = MAX_REPEATS_TRACKED):
+		self.interval = interval
+		self.max_tracked = max_tracked
+		self.lock = threading.Lock()
+		self.windows = {} # (name, level, message) -> [time the message was last written, copies since, last copy]
+		self.next_sweep = 0.0
+	def check(self, record):
+		"""Returns (whether to write record, summary records that are now due)"""
+		now = record.created
+		key = (record.name, record.levelno, record.getMessage())
+		with self.lock:
+			due = self._sweep(now, key) if now >= self.next_sweep else []
+			window = self.windows.get(key)
+			if window is None or (window[1] == 0 and now - window[0] >= self.interval):
+				if window is None and len(self.windows) >= self.max_tracked:
+					due.extend(self._expire(next(iter(self.windows))))
+				self.windows[key] = [now, 0, None]
+				return True, due
+			window[1] += 1
+			window[2] = record
+			if now - window[0] >= self.interval:
+				# still repeating - summarize what we have, and keep counting
+				due.append(self._summary(window))
+				self.windows[key] = [now, 0, None]
+			return False, due
+	def _sweep(self, now, skip):
+		"""Ends every window (other than skip's) that is over, returning the summaries of those that had repeats"""
+		self.next_sweep = now + 1.0
+		due = []
+		for key in [key for key, window in self.windows.items() if key != skip and now - window[0] >= self.interval]:
+			due.extend(self._expire(key))
+		return due
+	def _expire(self, key):
+		window = self.windows.pop(key)
+		return [self._summary(window)] if window[1] != 0 else []
+	def _summary(self, window):
+		start, count, last = window
+		summary = logging.makeLogRecord(last.__dict__)
+		summary.msg = '%s (repeated %d times in %.0f seconds)'
+		summary.args = (last.getMessage(), count, last.created - start)
+		summary.exc_info, summary.exc_text = None, None
+		summary.repeated = count
+		return summary
+	def flush(self):
+		"""Returns the summaries of every window with repeats, ending them all"""
+		with self.lock:
+			due = []
+			for key in list(self.windows):
+				due.extend(self._expire(key))
+			return due
+
+class AsyncHandler(handlers.QueueHandler):
+	"""Puts records on a bounded queue without ever waiting, suppressing repeats (see RepeatSuppressor) on the way"""
+	def __init__(self, queue, repeats = None):
+		super().__init__(queue)
+		self.repeats = repeats if repeats is not None else RepeatSuppressor()
+		self.dropped = 0
+	def enqueue(self, record):
+		if self.dropped != 0:
+			warning = logging.makeLogRecord({ 'name': 'agbot.loghelper', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+				'msg': 'Log queue was full - dropped %d messages', 'args': (self.dropped,) })
+			try:
+				self.queue.put_nowait(warning)
+				self.dropped = 0
+			except queue.Full:
+				pass
+		try:
+			self.queue.put_nowait(record)
+		except queue.Full:
+			self.dropped += 1
+	def emit(self, record):
+		try:
+			write, due = self.repeats.check(record)
+			for summary in due:
+				self.enqueue(self.prepare(summary))
+			if write:
+				self.enqueue(self.prepare(record))
+		except Exception:
+			self.handleError(record)
+	def flush_repeats(self):
+		for summary in self.repeats.flush():
+			self.enqueue(self.prepare(summary))
+
+class _Listener(handlers.QueueListener):
+	def enqueue_sentinel(self):
+		# only done when stopping, when waiting for the writer to catch up is what we want
+		self.queue.put(self._sentinel)
+
+def _stop(handler, listener):
+	handler.flush_repeats()
+	listener.stop()
+
+_setup_lock = threading.Lock()
+
+def _add_handler(logger):
+	file_handler = handlers.TimedRotatingFileHandler(LOG_PATH, when = 'midnight', backupCount = 31)
+	if os.environ.get(JSON_ENV, '') not in ('', '0'):
+		file_handler.setFormatter(JSONFormatter())
+	else:
+		file_handler.setFormatter(logging.Formatter('%(asctime)s\t%(name)s\t%(levelname)s\t%(message)s'))
+	records = queue.Queue(QUEUE_SIZE)
+	handler = AsyncHandler(records)
+	listener = _Listener(records, file_handler)
+	listener.start()
+	atexit.register(_stop, handler, listener)
+	logger.addHandler(handler)
 
 def get_logger(file):
 	logger = logging.getLogger('agbot')
 	logger.setLevel(logging.DEBUG)
-	if not logger.hasHandlers():
-		handler = handlers.TimedRotatingFileHandler('/var/log/agbot.log', when = 'midnight', backupCount = 31)
-		handler.setFormatter(logging.Formatter('%(asctime)s\t%(name)s\t%(levelname)s\t%(message)s'))
-		logger.addHandler(handler)
+	with _setup_lock:
+		if not logger.hasHandlers():
+			_add_handler(logger)
 	if file is not None:
 		name = os.path.splitext(os.path.relpath(file))[0]
 		child = logging.getLogger('agbot.%s'%(name))
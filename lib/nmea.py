@@ -3,8 +3,18 @@
 import pynmea2
 import subprocess
 import datetime
+import functools
+import operator
 import sys
 import os
+import time
+import signal
+import struct
+
+from lib import loghelper
+from lib import procs
+from lib import profiler
+
 DIR = '/home/agbot/nmea'
 
 # The Trimble supports the following messages:
@@ -26,13 +36,119 @@ _files = {
 	RMC: None,
 }
 
-def _processor_pid():
-	try:
-		# runs 'pidof processor.py' in a shell and returns the output (a list
-		# of PIDs), or raises a CalledProcessError upon a nonzero exit code.
-		return int(subprocess.check_output(['pidof', 'processor.py']).split()[0])
-	except subprocess.CalledProcessError:
+def _checksum(body):
+	return functools.reduce(operator.xor, body.encode('latin-1'), 0)
+
+def _float(field):
+	return float(field) if field else None
+
+def _int(field):
+	return int(field) if field else None
+
+def _degrees(field, hemisphere):
+	"""Converts an NMEA ddmm.mmmm / dddmm.mmmm field to signed decimal degrees"""
+	if not field:
 		return None
+	value = float(field)
+	degrees = int(value // 100)
+	degrees += (value - degrees * 100) / 60
+	return -degrees if hemisphere in ('S', 'W') else degrees
+
+def _time(field):
+	if len(field) < 6:
+		return None
+	seconds = float(field[4:])
+	return datetime.time(int(field[0:2]), int(field[2:4]), int(seconds), int(round((seconds % 1) * 1_000_000)) % 1_000_000)
+
+class GGAFix:
+	"""A parsed GGA (position fix) sentence. Attribute names match pynmea2's, so the two can be used interchangeably."""
+	__slots__ = ('raw', 'talker', 'timestamp', 'latitude', 'longitude', 'gps_qual', 'num_sats', 'horizontal_dil', 'altitude')
+	sentence_type = GGA
+	def __init__(self, raw, talker, fields):
+		self.raw = raw
+		self.talker = talker
+		self.timestamp = _time(fields[1])
+		self.latitude = _degrees(fields[2], fields[3])
+		self.longitude = _degrees(fields[4], fields[5])
+		self.gps_qual = _int(fields[6])
+		self.num_sats = fields[7]
+		self.horizontal_dil = fields[8]
+		self.altitude = _float(fields[9])
+	def __str__(self):
+		return self.raw
+	def __repr__(self):
+		return 'GGAFix(timestamp=%s, latitude=%s, longitude=%s, gps_qual=%s)'%(self.timestamp, self.latitude, self.longitude, self.gps_qual)
+
+class VTGFix:
+	"""A parsed VTG (ground speed) sentence. Attribute names match pynmea2's."""
+	__slots__ = ('raw', 'talker', 'true_track', 'mag_track', 'spd_over_grnd_kts', 'spd_over_grnd_kmph')
+	sentence_type = VTG
+	def __init__(self, raw, talker, fields):
+		self.raw = raw
+		self.talker = talker
+		self.true_track = _float(fields[1])
+		self.mag_track = _float(fields[3])
+		self.spd_over_grnd_kts = _float(fields[5])
+		self.spd_over_grnd_kmph = _float(fields[7])
+	def __str__(self):
+		return self.raw
+	def __repr__(self):
+		return 'VTGFix(true_track=%s, spd_over_grnd_kmph=%s)'%(self.true_track, self.spd_over_grnd_kmph)
+
+class RMCFix:
+	"""A parsed RMC (position, velocity, time) sentence. Attribute names match pynmea2's."""
+	__slots__ = ('raw', 'talker', 'timestamp', 'status', 'latitude', 'longitude', 'spd_over_grnd', 'true_course', 'datestamp')
+	sentence_type = RMC
+	def __init__(self, raw, talker, fields):
+		self.raw = raw
+		self.talker = talker
+		self.timestamp = _time(fields[1])
+		self.status = fields[2]
+		self.latitude = _degrees(fields[3], fields[4])
+		self.longitude = _degrees(fields[5], fields[6])
+		self.spd_over_grnd = _float(fields[7])
+		self.true_course = _float(fields[8])
+		self.datestamp = datetime.datetime.strptime(fields[9], '%d%m%y').date() if len(fields[9]) == 6 else None
+	def __str__(self):
+		return self.raw
+	def __repr__(self):
+		return 'RMCFix(timestamp=%s, status=%s, latitude=%s, longitude=%s)'%(self.timestamp, self.status, self.latitude, self.longitude)
+
+# minimum number of fields (including the address field) each fast-path sentence needs
+_FAST_TYPES = {
+	GGA: (GGAFix, 10),
+	VTG: (VTGFix, 8),
+	RMC: (RMCFix, 10),
+}
+
+def parse(line, check = False):
+	"""Parses an NMEA sentence. GGA, VTG and RMC sentences - the ones we receive many times a second - are handled by
+	a specialized parser that returns a GGAFix, VTGFix or RMCFix; anything else falls back to pynmea2.parse(). Either
+	way, the result has a sentence_type attribute and str() returns the sentence. As with pynmea2, a bad checksum
+	raises a pynmea2.ChecksumError, and check = True additionally rejects sentences without one."""
+	if len(line) < 7 or line[0] != '$' or line[3:6] not in _FAST_TYPES:
+		return pynmea2.parse(line, check = check)
+	star = line.find('*')
+	if star >= 0:
+		try:
+			checksum = int(line[star + 1:], 16)
+		except ValueError:
+			raise pynmea2.ParseError('Invalid checksum field', line)
+		if checksum != _checksum(line[1:star]):
+			raise pynmea2.ChecksumError('Checksum does not match: %02X != %02X'%(checksum, _checksum(line[1:star])), line)
+		body = line[1:star]
+	elif check:
+		raise pynmea2.ChecksumError('No checksum found', line)
+	else:
+		body = line[1:]
+	fields = body.split(',')
+	cls, min_fields = _FAST_TYPES[line[3:6]]
+	if len(fields) < min_fields:
+		raise pynmea2.ParseError('Expected at least %d fields but found %d'%(min_fields, len(fields)), line)
+	try:
+		return cls(line, fields[0][:2], fields)
+	except ValueError as ex:
+		raise pynmea2.ParseError('Invalid field value: %s'%(str(ex)), line)
 
 # TODO: fine tune through testing
 _MAX_EOR_INTERVAL = 2.0 # only remember velocity data from the last two seconds
@@ -42,27 +158,31 @@ _TURN_SPEED_CUTOFF = 5.0 # if we average 5 degrees/sec for 2 seconds, assume we'
 _TURN_DEBOUNCE_TIME = 2.0 # prevent turning/not turning signals from being generated twice inside 2 seconds
 _vtg_history = []
 
-def is_turning(vtg_msg):
-	now = datetime.datetime.now()
+def is_turning(vtg_msg, now = None):
+	"""Returns True if the VTG history indicates the BOT is turning, False if it isn't, or None if we can't tell yet.
+	now is the time.monotonic() value at which vtg_msg was received, and defaults to the current time."""
+	global _vtg_history
+	if now is None:
+		now = time.monotonic()
 	if vtg_msg.spd_over_grnd_kmph >= _MIN_SPD_KPH:  
 		_vtg_history.append((now, vtg_msg))
 	# remove queue elements older than _EOR_INTERVAL seconds old
-	for date, msg in _vtg_history:
-		if (now - date).total_seconds() >= _MAX_EOR_INTERVAL:
-			_vtg_history.remove((date,msg))
+	_vtg_history = [(t, msg) for t, msg in _vtg_history if now - t < _MAX_EOR_INTERVAL]
 	# add current element to history
 	_vtg_history.append((now, vtg_msg))
 	if len(_vtg_history) < 2: return None # insufficient data: we don't know if we're turning
 	# compute change in heading (dh) / change in time (dt)
 	time0, msg0 = _vtg_history[0]
 	time1, msg1 = _vtg_history[-1]
-	dt = (time1 - time0).total_seconds()
+	dt = time1 - time0
 	if dt < _MIN_EOR_INTERVAL: return None # insufficient data: we don't know if we're turning
 	dh = msg1.true_track - msg0.true_track
 	abs_dh = min(abs(dh), abs(dh - 360.0))
 	return abs_dh/dt > _TURN_SPEED_CUTOFF
 
-def read_data(type):
+def read_timestamped(type):
+	"""Returns a tuple (timestamp, data) with the most recent message of the given type and the time.monotonic()
+	value at which the NMEA listener received it. The timestamp is None if the listener didn't record one."""
 	global _files
 	if type not in _files.keys():
 		raise ValueError("Unsupported message type: '%s'"%(type))
@@ -74,10 +194,18 @@ def read_data(type):
 	for line in _files[type]:
 		if len(line) < 2:
 			raise ValueError('No %s data received yet. Make sure the Trimble is working.'%(type))
-		data = pynmea2.parse(line, check = True)
+		# lines are written as '[monotonic receive time] [sentence]'
+		timestamp = None
+		if not line.startswith('$'):
+			stamp, _, line = line.partition(' ')
+			timestamp = float(stamp)
+		data = parse(line.strip(), check = True)
 		break # only read the first line
 	_files[type].seek(0)
-	return data
+	return timestamp, data
+
+def read_data(type):
+	return read_timestamped(type)[1]
 
 def close():
 	for type in _files:
@@ -85,73 +213,229 @@ def close():
 			_files[type].close()
 			_files[type] = None
 
+# Capture files start with a header (magic, time.time() and time.monotonic() at the start of the capture), followed
+# by one frame per sentence: the monotonic time it was received, its length, and the raw bytes without the line ending
+CAPTURE_MAGIC = b'AGNMEA01'
+_CAPTURE_HEADER = struct.Struct('<8sdd')
+_CAPTURE_FRAME = struct.Struct('<dH')
+CAPTURE_FLUSH_INTERVAL = 1.0 # seconds
+CAPTURE_FLUSH_BYTES = 16 * 1024
+
+class CaptureWriter:
+	"""Logs raw NMEA sentences, along with the monotonic time each was received, to a compact binary file. The file is
+	flushed and fsynced every CAPTURE_FLUSH_INTERVAL seconds or CAPTURE_FLUSH_BYTES bytes, so a killed listener or a
+	power cut only loses the last moments of the capture."""
+	def __init__(self, path, flush_interval = CAPTURE_FLUSH_INTERVAL, flush_bytes = CAPTURE_FLUSH_BYTES):
+		self.flush_interval = flush_interval
+		self.flush_bytes = flush_bytes
+		self.file = open(path, 'wb')
+		self.file.write(_CAPTURE_HEADER.pack(CAPTURE_MAGIC, time.time(), time.monotonic()))
+		self.flushed = time.monotonic()
+		self.pending = 0
+	def write(self, received, sentence):
+		self.file.write(_CAPTURE_FRAME.pack(received, len(sentence)))
+		self.file.write(sentence)
+		self.pending += _CAPTURE_FRAME.size + len(sentence)
+		if self.pending >= self.flush_bytes or time.monotonic() - self.flushed >= self.flush_interval:
+			self.flush()
+	def flush(self):
+		self.file.flush()
+		os.fsync(self.file.fileno())
+		self.flushed = time.monotonic()
+		self.pending = 0
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+
+class CaptureReader:
+	"""Reads a file written by CaptureWriter. Iterating over it yields (received, sentence) tuples, where sentence is
+	the raw bytes. wall_time(received) converts a receive time to a time.time() value."""
+	def __init__(self, path):
+		self.path = path
+		with open(path, 'rb') as file:
+			magic, self.wall_start, self.monotonic_start = _CAPTURE_HEADER.unpack(file.read(_CAPTURE_HEADER.size))
+		if magic != CAPTURE_MAGIC:
+			raise ValueError('%s is not an NMEA capture file'%(path))
+	def wall_time(self, received):
+		return self.wall_start + (received - self.monotonic_start)
+	def __iter__(self):
+		with open(self.path, 'rb') as file:
+			file.seek(_CAPTURE_HEADER.size)
+			while True:
+				header = file.read(_CAPTURE_FRAME.size)
+				if len(header) < _CAPTURE_FRAME.size:
+					break
+				received, length = _CAPTURE_FRAME.unpack(header)
+				sentence = file.read(length)
+				if len(sentence) < length:
+					break # the capture was cut off mid-frame
+				yield received, sentence
+
+class Listener:
+	"""Publishes NMEA sentences to the files in DIR, where read_data() can find them, and signals processor.py at the
+	start and end of each row. Sentences can come from a serial port (or pseudo-terminal) through listen(), or from
+	anywhere else - a capture file, for instance - through handle()."""
+	def __init__(self, ignore_turn = False, signal_processor = True, capture = None):
+		self.log = loghelper.get_logger(__file__)
+		self.ignore_turn = ignore_turn
+		self.signal_processor = signal_processor
+		self.capture = capture
+		self.was_turning = None
+		self.turning_last_edge = None
+		self.edges = [] # list of (time, turning) for every start/end of row signaled
+		self.count = 0
+	def open(self):
+		for type in _files:
+			path = os.path.join(DIR, type + '.txt')
+			_files[type] = open(path, 'w+')
+			# This script will run as root, so this should make sure everyone else permission to read the files we create
+			os.chmod(path, 0o644)
+	def close(self):
+		close()
+		if self.capture is not None:
+			self.capture.close()
+		# delete all the files, so the next person to call read_data hits an error instead of reading stale data
+		for type in _files:
+			try:
+				os.remove(os.path.join(DIR, type + '.txt'))
+			except OSError:
+				pass # oh well - we tried. Probably this just means the file didn't exist
+	def handle(self, sentence, received = None, now = None):
+		"""Handles one raw NMEA sentence (as bytes). received is the time.monotonic() value that readers will see it
+		stamped with, and now is the time used for turn detection; both default to the current time. They only differ
+		when replaying a capture faster or slower than real time."""
+		if received is None:
+			received = time.monotonic()
+		if now is None:
+			now = received
+		sentence = sentence.strip()
+		if len(sentence) == 0: return # skip blank lines
+		if self.capture is not None:
+			self.capture.write(received, sentence)
+		self.count += 1
+		try:
+			line = sentence.decode('ascii')
+			data = parse(line)
+			type = getattr(data, 'sentence_type', data.__class__.__name__)
+			if type in _files.keys():
+				# use os.write() to auto-synchronize things for us. This makes all writes (effectively) atomic
+				# stamp each message with the time it arrived, so readers can tell exactly how old the data is
+				os.write(_files[type].fileno(), ('%f %s\n'%(received, str(data))).encode('utf-8'))
+				# NOTE: if a longer message is followed by a shorter one, this will leave garbage left over after the first line.
+				# It shouldn't be a big deal as read_data() only reads the first line, but it's something to keep in mind.
+				_files[type].seek(0)
+				if type == VTG and not self.ignore_turn:
+					self._check_turn(data, now)
+			else:
+				self.log.warning('Received unrecognized message type %s', type)
+		except pynmea2.ChecksumError:
+			self.log.error("Invalid NMEA checksum on the following message: '%s'. Skipping this message...", line)
+		except pynmea2.ParseError:
+			self.log.error("Could not parse NMEA message: '%s'. Skipping this message...", line)
+		except UnicodeDecodeError:
+			# this may happen if the baud rate is wrong, or if the Trimble stops unexpectedly, or if the serial
+			# transmission begins in the middle of a byte, or possibly other issues. If the baud rate is wrong,
+			# this will flood the logs at an alarming rate. Otherwise, the issue can probably be ignored
+			self.log.warning('Received Unicode decode error - check your baud rate if this message appears repeatedly.')
+	def _check_turn(self, vtg, now):
+		turning = is_turning(vtg, now)
+		if turning is not None and turning != self.was_turning and \
+				(self.was_turning is None or now - self.turning_last_edge >= _TURN_DEBOUNCE_TIME):
+			self.was_turning = turning
+			self.turning_last_edge = now
+			self.edges.append((now, turning))
+			self.log.info('%s detected', 'End of row' if turning else 'Start of row')
+			if self.signal_processor:
+				pid = procs.processor_pid()
+				if pid is not None:
+					os.kill(pid, signal.SIGUSR2 if turning else signal.SIGUSR1)
+	def listen(self, port):
+		"""Handles every sentence received on the given serial port (or pseudo-terminal) until it closes"""
+		with open(port, 'rb') as nmea_port:
+			for sentence in nmea_port:
+				self.handle(sentence)
+
+def _pace(capture, speed):
+	"""Yields (received, sentence) from a CaptureReader, sleeping so they come out speed times faster than they were
+	captured. A speed of None means as fast as possible."""
+	start = time.monotonic()
+	t0 = None
+	for received, sentence in capture:
+		if t0 is None:
+			t0 = received
+		if speed is not None:
+			delay = start + (received - t0) / speed - time.monotonic()
+			if delay > 0:
+				time.sleep(delay)
+		yield received, sentence
+
+def replay(path, listener, speed = 1.0):
+	"""Feeds a capture file through listener at speed times real time (or as fast as possible if speed is None).
+	Returns the number of sentences handled per second."""
+	t0 = time.monotonic()
+	count = 0
+	for received, sentence in _pace(CaptureReader(path), speed):
+		# stamp the output with the current time, so the processor sees fresh data, but detect turns against the
+		# original timeline so the results don't depend on the replay speed
+		listener.handle(sentence, time.monotonic(), received)
+		count += 1
+	elapsed = time.monotonic() - t0
+	return count / elapsed if elapsed > 0 else float('inf')
+
+def replay_to_pty(path, speed = 1.0, ready = None):
+	"""Writes a capture file to a new pseudo-terminal at speed times real time, so it can be read by a listener
+	started with --port. ready is called with the name of the terminal before anything is written."""
+	import pty
+	master, slave = pty.openpty()
+	try:
+		if ready is not None:
+			ready(os.ttyname(slave))
+		for received, sentence in _pace(CaptureReader(path), speed):
+			os.write(master, sentence + b'\r\n')
+	finally:
+		os.close(master)
+		os.close(slave)
+
 if __name__ == '__main__':
 	import argparse
-	import os
-	import signal
 	parser = argparse.ArgumentParser()
 	parser.add_argument('-p', '--port', default = '/dev/ttyS0', required = False, help = 'The serial port on which to listen. The default is /dev/ttyS0')
 	parser.add_argument('-t', '--ignore-turn', action = 'store_true', help = 'Use this flag to suppress end-of-row detection')
 	parser.add_argument('-b', '--baud-rate', default=38400, type=int, choices = [4800, 9600, 19200, 38400, 57600, 115200], help = 'The serial baud rate. The default is 38400.')
+	parser.add_argument('-c', '--capture', default = None, help = 'Log every sentence received, with its receive time, to this file for later replay')
+	parser.add_argument('-r', '--replay', default = None, help = 'Replay a capture file instead of listening on the serial port')
+	parser.add_argument('--speed', default = '1', help = "Replay speed, as a multiple of real time, or 'max' to replay as fast as possible. The default is 1.")
+	parser.add_argument('--pty', action = 'store_true', help = 'With --replay, write the capture to a new pseudo-terminal (for a listener started with --port) instead of handling it here')
+	parser.add_argument('--no-signal', action = 'store_true', help = 'Detect turns, but do not signal processor.py')
 	args = parser.parse_args()
-	from lib import loghelper
 	log = loghelper.get_logger(__file__)
-	log.info('Starting up NMEA listener on serial port %s. Baud rate = %d', args.port, args.baud_rate)
+	profiler.install('nmea')
+	speed = None if args.speed == 'max' else float(args.speed)
+	if args.replay is not None and args.pty:
+		replay_to_pty(args.replay, speed, lambda name: print('Replaying %s on %s'%(args.replay, name), flush = True))
+		sys.exit(0)
+	listener = Listener(args.ignore_turn, not args.no_signal, CaptureWriter(args.capture) if args.capture is not None else None)
+	if args.replay is None:
+		log.info('Starting up NMEA listener on serial port %s. Baud rate = %d', args.port, args.baud_rate)
+		try:
+			subprocess.run(['stty', '-F', args.port, str(args.baud_rate)], check=True)
+		except subprocess.CalledProcessError as ex:
+			log.error('Could not set baud rate - %s', repr(ex))
+			raise
+	else:
+		log.info('Starting up NMEA listener replaying %s at speed %s', args.replay, args.speed)
 	try:
-		subprocess.run(['stty', '-F', args.port, str(args.baud_rate)], check=True)
-	except subprocess.CalledProcessError as ex:
-		log.error('Could not set baud rate - %s', repr(ex))
-		raise
-	try:
-		for type in _files:
-			path = os.path.join(DIR, type + '.txt')
-			_files[type] = open(path, 'w+')
-			# This script will run as root, so this should make sure everyone else permission to read the files we create
-			os.chmod(path, 0o644)
-		with open(args.port, 'r') as nmea_port:
-			if not args.ignore_turn:
-				was_turning = None
-				turning_last_edge = None
-			for line in nmea_port:
-				try:
-					line = line.strip()
-					if len(line) == 0: continue # skip blank lines
-					data = pynmea2.parse(line)
-					type = data.__class__.__name__
-					if type in _files.keys():
-						# use os.write() to auto-synchronize things for us. This makes all writes (effectively) atomic
-						os.write(_files[type].fileno(), (str(data) + '\n').encode('utf-8'))
-						# NOTE: if a longer message is followed by a shorter one, this will leave garbage left over after the first line.
-						# It shouldn't be a big deal as read_data() only reads the first line, but it's something to keep in mind.
-						_files[type].seek(0)
-						if type == VTG and not args.ignore_turn:
-							turning = is_turning(data)
-							if turning is not None and turning != was_turning and \
-									(was_turning is None or (datetime.datetime.now() - turning_last_edge).total_seconds() >= _TURN_DEBOUNCE_TIME):
-								was_turning = turning
-								turning_last_edge = datetime.datetime.now()
-								pid = _processor_pid()
-								if pid is not None:
-									os.kill(pid, signal.SIGUSR2 if turning else signal.SIGUSR1)
-					else:
-						log.warning('Received unrecognized message type %s', type)
-				except pynmea2.ChecksumError:
-					log.error("Invalid NMEA checksum on the following message: '%s'. Skipping this message...", line.strip())
-				except pynmea2.ParseError:
-					log.error("Could not parse NMEA message: '%s'. Skipping this message...", line.strip())
-				except UnicodeDecodeError:
-					# this may happen if the baud rate is wrong, or if the Trimble stops unexpectedly, or if the serial
-					# transmission begins in the middle of a byte, or possibly other issues. If the baud rate is wrong,
-					# this will flood the logs at an alarming rate. Otherwise, the issue can probably be ignored
-					log.warning('Received Unicode decode error - check your baud rate if this message appears repeatedly.')
+		listener.open()
+		if args.replay is None:
+			listener.listen(args.port)
+		else:
+			rate = replay(args.replay, listener, speed)
+			print('Replayed %d sentences (%.0f sentences/sec)'%(listener.count, rate))
+			for t, turning in listener.edges:
+				print('%10.3f %s'%(t, 'end of row' if turning else 'start of row'))
 	except KeyboardInterrupt:
 		pass # suppress exception, but exit gracefully through finally
 	finally:
 		log.info('Shutting down NMEA service')
-		close()
-		# delete all the files, so the next person to call read_data hits an error instead of reading stale data
-		for type in _files:
-			try:
-				os.remove(os.path.join(DIR, type + '.txt'))
-			except OSError:
-				pass # oh well - we tried. Probably this just means the file didn't exist
+		listener.close()
@@ -0,0 +1,137 @@
+import bisect
+import collections
+import math
+import numpy
+
+from lib import records
+
+# only remember fixes from the last few seconds - anything older is useless for interpolation
+_HISTORY_SECONDS = 5.0
+# don't extrapolate further than this past the newest fix (or before the oldest one)
+_MAX_EXTRAPOLATION = 1.0
+# below this speed the VTG track is mostly noise, so headings are taken from the GGA fixes instead
+_MIN_SPD_KPH = 0.5
+_KPH_TO_FPS = 3280.84 / 3600
+
+def offset_position(longitude, latitude, east_ft, north_ft):
+	"""Returns the (longitude, latitude) reached by moving east_ft feet east and north_ft feet north of the given
+	position. This uses a flat-earth approximation, which is more than accurate enough over the width of a field.
+	The arguments may also be numpy arrays, to offset many positions at once."""
+	dlat = numpy.degrees(north_ft / records.EARTH_RADIUS)
+	dlon = numpy.degrees(east_ft / (records.EARTH_RADIUS * numpy.cos(numpy.radians(latitude))))
+	return longitude + dlon, latitude + dlat
+
+def distance_ft(lon0, lat0, lon1, lat1):
+	"""Returns the (east, north) distance in feet from the first position to the second, using the same flat-earth
+	approximation as offset_position()"""
+	east = math.radians(lon1 - lon0) * records.EARTH_RADIUS * math.cos(math.radians((lat0 + lat1) / 2))
+	north = math.radians(lat1 - lat0) * records.EARTH_RADIUS
+	return east, north
+
+class FixHistory:
+	"""Keeps a short history of timestamped GGA (position) and VTG (velocity) fixes, so the position of the BOT can
+	be estimated at any instant - in particular, at the moment a camera frame was captured rather than the moment
+	the processor got around to asking for it. Timestamps are time.monotonic() values."""
+	def __init__(self, max_age = _HISTORY_SECONDS):
+		self.max_age = max_age
+		self.times = []
+		self.fixes = [] # list of (longitude, latitude), parallel to self.times
+		self.velocities = collections.deque() # list of (time, speed_fps, track_degrees)
+	def __len__(self):
+		return len(self.times)
+	def add_gga(self, t, gga):
+		"""Adds a GGA message received at monotonic time t. Messages without a valid fix are ignored."""
+		if gga.latitude is None or gga.longitude is None or (gga.latitude == 0 and gga.longitude == 0):
+			return
+		if len(self.times) != 0 and t <= self.times[-1]:
+			return # already seen this one
+		self.times.append(t)
+		self.fixes.append((gga.longitude, gga.latitude))
+		self._trim(t)
+	def add_vtg(self, t, vtg):
+		"""Adds a VTG message received at monotonic time t"""
+		if vtg.spd_over_grnd_kmph is None or (len(self.velocities) != 0 and t <= self.velocities[-1][0]):
+			return
+		self.velocities.append((t, vtg.spd_over_grnd_kmph * _KPH_TO_FPS, vtg.true_track if vtg.spd_over_grnd_kmph >= _MIN_SPD_KPH else None))
+		self._trim(t)
+	def _trim(self, now):
+		cutoff = now - self.max_age
+		# always keep at least two fixes around, so we can still extrapolate if the GPS drops out for a moment
+		drop = min(bisect.bisect_left(self.times, cutoff), len(self.times) - 2)
+		if drop > 0:
+			del self.times[:drop]
+			del self.fixes[:drop]
+		while len(self.velocities) > 1 and self.velocities[0][0] < cutoff:
+			self.velocities.popleft()
+	def _velocity(self, t):
+		"""Returns the most recent (speed_fps, track_degrees) reported at or before t (or the oldest one we have, if
+		t predates all of them), or None if no VTG data has been received"""
+		velocity = None
+		for vt, speed, track in self.velocities:
+			if vt > t and velocity is not None:
+				break
+			velocity = (speed, track)
+		return velocity
+	def speed(self, t):
+		"""Returns the estimated ground speed (feet per second) at time t, or None if it is unknown"""
+		velocity = self._velocity(t)
+		if velocity is not None:
+			return velocity[0]
+		if len(self.times) < 2:
+			return None
+		i = min(max(bisect.bisect_left(self.times, t), 1), len(self.times) - 1)
+		east, north = distance_ft(*self.fixes[i - 1], *self.fixes[i])
+		return math.hypot(east, north) / (self.times[i] - self.times[i - 1])
+	def heading(self, t):
+		"""Returns the estimated heading (degrees clockwise from north) at time t, or None if it is unknown"""
+		velocity = self._velocity(t)
+		if velocity is not None and velocity[1] is not None:
+			return velocity[1]
+		if len(self.times) < 2:
+			return None
+		i = min(max(bisect.bisect_left(self.times, t), 1), len(self.times) - 1)
+		east, north = distance_ft(*self.fixes[i - 1], *self.fixes[i])
+		if east == 0 and north == 0:
+			return None
+		return math.degrees(math.atan2(east, north)) % 360.0
+	def position(self, t, forward_ft = 0.0, right_ft = 0.0):
+		"""Returns the estimated (longitude, latitude) at monotonic time t of a point forward_ft ahead of and right_ft
+		to the right of the GPS antenna, or None if there isn't enough data. Positions between two fixes are linearly
+		interpolated; positions slightly outside the history are extrapolated from the reported ground speed and
+		track (or from the last two fixes, if VTG data isn't available)."""
+		if len(self.times) == 0:
+			return None
+		i = bisect.bisect_left(self.times, t)
+		if i < len(self.times) and self.times[i] == t:
+			longitude, latitude = self.fixes[i]
+		elif 0 < i < len(self.times):
+			t0, t1 = self.times[i - 1], self.times[i]
+			(lon0, lat0), (lon1, lat1) = self.fixes[i - 1], self.fixes[i]
+			alpha = (t - t0) / (t1 - t0)
+			longitude, latitude = lon0 + alpha * (lon1 - lon0), lat0 + alpha * (lat1 - lat0)
+		else:
+			# extrapolate from whichever end of the history is closest
+			j = 0 if i == 0 else len(self.times) - 1
+			dt = t - self.times[j]
+			if abs(dt) > _MAX_EXTRAPOLATION:
+				return None
+			longitude, latitude = self.fixes[j]
+			velocity = self._velocity(t)
+			if velocity is not None and velocity[1] is not None:
+				speed, track = velocity
+				east, north = speed * math.sin(math.radians(track)), speed * math.cos(math.radians(track))
+				longitude, latitude = offset_position(longitude, latitude, east * dt, north * dt)
+			elif len(self.times) >= 2:
+				k = 1 if j == 0 else j - 1
+				lon_k, lat_k = self.fixes[k]
+				alpha = dt / (self.times[j] - self.times[k])
+				longitude, latitude = longitude + alpha * (longitude - lon_k), latitude + alpha * (latitude - lat_k)
+		if forward_ft != 0 or right_ft != 0:
+			heading = self.heading(t)
+			if heading is None:
+				return longitude, latitude
+			h = math.radians(heading)
+			east = forward_ft * math.sin(h) + right_ft * math.cos(h)
+			north = forward_ft * math.cos(h) - right_ft * math.sin(h)
+			longitude, latitude = offset_position(longitude, latitude, east, north)
+		return longitude, latitude
@@ -0,0 +1,10 @@
+import subprocess
+
+def processor_pid():
+	"""Returns the PID of the running processor.py, or None if it isn't running"""
+	try:
+		# runs 'pidof processor.py' in a shell and returns the output (a list
+		# of PIDs), or raises a CalledProcessError upon a nonzero exit code.
+		return int(subprocess.check_output(['pidof', 'processor.py']).split()[0])
+	except subprocess.CalledProcessError:
+		return None
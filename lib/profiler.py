@@ -0,0 +1,213 @@
+#!/usr/bin/python
+'''
+A sampling profiler that can be switched on in a running process, for when something gets slow in the field and
+restarting it would lose the state worth looking at. Processes call install() at startup, which costs nothing until a
+profile is asked for: then the stacks of all threads are sampled RATE times a second for a while, and written out in
+collapsed-stack form (one 'thread;outer frame;...;inner frame count' line per distinct stack) next to the logs, ready
+for flamegraph.pl or speedscope. To profile the processor for 30 seconds:
+	python -m lib.profiler processor --seconds 30
+The server can also be asked, through /api/profile.
+Whoever can write to RUN_DIR can choose which process gets signaled, so it has to belong to the service (e.g. systemd's
+RuntimeDirectory=agbot) - install() won't use it if anyone can write to it.
+'''
+
+import atexit
+import collections
+import datetime
+import json
+import os
+import signal
+import stat
+import sys
+import threading
+import time
+
+from lib import loghelper
+
+# The default action for SIGURG is to ignore it, so signaling a process that doesn't have the hook installed is harmless
+PROFILE_SIGNAL = signal.SIGURG
+# where processes that have the hook installed leave their PID, and where requests for them are left
+RUN_DIR = '/run/agbot/profile'
+OUTPUT_DIR = os.path.dirname(loghelper.LOG_PATH)
+OUTPUT_EXT = '.folded'
+RATE = 100 # samples per second
+DEFAULT_SECONDS = 10.0
+MAX_SECONDS = 300.0
+
+class Sampler:
+	"""Counts the distinct stacks of every thread (but its own) at a fixed rate"""
+	def __init__(self, rate = RATE):
+		self.rate = rate
+		self.counts = collections.Counter()
+		self.samples = 0
+	def sample(self):
+		names = { thread.ident: thread.name for thread in threading.enumerate() }
+		me = threading.get_ident()
+		for ident, frame in sys._current_frames().items():
+			if ident == me:
+				continue
+			stack = []
+			while frame is not None:
+				code = frame.f_code
+				stack.append('%s (%s:%d)'%(code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+				frame = frame.f_back
+			stack.append(names.get(ident, 'thread-%d'%(ident)))
+			self.counts[';'.join(reversed(stack))] += 1
+		self.samples += 1
+	def run(self, seconds):
+		"""Samples for the given number of seconds. Samples are taken on a fixed schedule, skipping any that are missed
+		(e.g. when another thread holds the GIL for a long time) rather than catching up."""
+		interval = 1.0 / self.rate
+		start = time.monotonic()
+		next = start
+		while next < start + seconds:
+			self.sample()
+			next += interval
+			now = time.monotonic()
+			if next < now:
+				next = now
+			time.sleep(next - now)
+	def write(self, path):
+		temp = path + '.tmp'
+		with open(temp, 'w') as file:
+			for stack, count in sorted(self.counts.items()):
+				file.write('%s %d\n'%(stack, count))
+		os.rename(temp, path)
+
+def output_path(name, when = None):
+	"""Returns the path to write a profile of the named process, asked for at the given datetime (now by default), to"""
+	when = when or datetime.datetime.now()
+	return os.path.join(OUTPUT_DIR, 'agbot-profile-%s-%s%s'%(name, when.strftime('%Y%m%d-%H%M%S'), OUTPUT_EXT))
+
+def list_profiles():
+	"""Returns the file names of the profiles written so far, newest first"""
+	try:
+		files = [file for file in os.listdir(OUTPUT_DIR) if file.startswith('agbot-profile-') and file.endswith(OUTPUT_EXT)]
+	except FileNotFoundError:
+		return []
+	return sorted(files, key = lambda file: os.path.getmtime(os.path.join(OUTPUT_DIR, file)), reverse = True)
+
+_busy = threading.Lock()
+
+def profile(seconds, path, rate = RATE):
+	"""Profiles this process for the given number of seconds and writes the result to path. Returns False (without
+	profiling) if a profile is already being taken."""
+	if not _busy.acquire(blocking = False):
+		return False
+	_profile(seconds, path, rate)
+	return True
+
+def _profile(seconds, path, rate):
+	# called with _busy held
+	log = loghelper.get_logger(__file__)
+	try:
+		log.info('Profiling for %g seconds at %d samples/sec', seconds, rate)
+		sampler = Sampler(rate)
+		sampler.run(min(seconds, MAX_SECONDS))
+		sampler.write(path)
+		log.info('Wrote %d samples of %d distinct stacks to %s', sampler.samples, len(sampler.counts), path)
+	except OSError:
+		log.exception('Could not write profile to %s', path)
+	finally:
+		_busy.release()
+
+def start(seconds, path, rate = RATE):
+	"""Like profile(), but in a background thread. Returns False if a profile is already being taken."""
+	if not _busy.acquire(blocking = False):
+		return False
+	threading.Thread(target = _profile, args = (seconds, path, rate), name = 'Profiler', daemon = True).start()
+	return True
+
+def _pid_path(name):
+	return os.path.join(RUN_DIR, name + '.pid')
+
+def _request_path(pid):
+	return os.path.join(RUN_DIR, '%d.request'%(pid))
+
+_requested = threading.Event()
+
+def _wait_for_requests():
+	while True:
+		_requested.wait()
+		_requested.clear()
+		seconds, when = DEFAULT_SECONDS, None
+		try:
+			with open(_request_path(os.getpid())) as file:
+				request = json.load(file)
+			os.remove(_request_path(os.getpid()))
+			seconds = float(request.get('seconds', DEFAULT_SECONDS))
+			# only the time is taken from the request, never a path: the profile always goes in OUTPUT_DIR
+			if 'time' in request:
+				when = datetime.datetime.fromtimestamp(float(request['time']))
+		except (OSError, ValueError, TypeError, OverflowError):
+			pass # signaled by hand - use the defaults
+		profile(seconds, output_path(_name, when))
+
+def _handle_signal(sig, frame):
+	# signal handlers run on the main thread, between whatever it was doing - so just wake up the waiting thread
+	_requested.set()
+
+def _remove_pid_file(path):
+	try:
+		with open(path) as file:
+			if int(file.read()) == os.getpid():
+				os.remove(path)
+	except (OSError, ValueError):
+		pass
+
+_name = None
+
+def install(name):
+	"""Lets this process be profiled on request, as name (see request()). Must be called from the main thread. Until a
+	profile is asked for, this only leaves one thread blocked waiting."""
+	global _name
+	if _name is not None:
+		return
+	log = loghelper.get_logger(__file__)
+	try:
+		os.makedirs(RUN_DIR, mode = 0o770, exist_ok = True) # the server asks processes run by others in its group
+		if os.stat(RUN_DIR).st_mode & stat.S_IWOTH:
+			log.error('%s can be written to by anyone - not enabling profiling', RUN_DIR)
+			return
+		with open(_pid_path(name), 'w') as file:
+			file.write(str(os.getpid()))
+	except OSError:
+		log.exception('Could not enable profiling')
+		return
+	_name = name
+	atexit.register(_remove_pid_file, _pid_path(name))
+	threading.Thread(target = _wait_for_requests, name = 'ProfileRequests', daemon = True).start()
+	signal.signal(PROFILE_SIGNAL, _handle_signal)
+
+def request(name, seconds = DEFAULT_SECONDS):
+	"""Asks the process that installed the hook as name to profile itself for the given number of seconds. Returns
+	the path the profile will be written to. Raises a ProcessLookupError if no such process is running, and a
+	PermissionError if the PID file wasn't written by the user the process runs as."""
+	try:
+		with open(_pid_path(name)) as file:
+			pid = int(file.read())
+			owner = os.fstat(file.fileno()).st_uid
+	except (OSError, ValueError):
+		raise ProcessLookupError('%s is not running with profiling enabled'%(name))
+	try:
+		if os.stat('/proc/%d'%(pid)).st_uid != owner:
+			raise PermissionError('PID %d does not belong to whoever wrote the PID file for %s'%(pid, name))
+	except FileNotFoundError:
+		raise ProcessLookupError('%s (PID %d) is not running'%(name, pid))
+	when = datetime.datetime.now()
+	with open(_request_path(pid), 'w') as file:
+		json.dump({ 'seconds': min(seconds, MAX_SECONDS), 'time': when.timestamp() }, file)
+	try:
+		os.kill(pid, PROFILE_SIGNAL)
+	except ProcessLookupError:
+		os.remove(_request_path(pid))
+		raise ProcessLookupError('%s (PID %d) is not running'%(name, pid))
+	return output_path(name, when)
+
+if __name__ == '__main__':
+	import argparse
+	parser = argparse.ArgumentParser(description = 'Profile a running process that has the profiling hook installed')
+	parser.add_argument('name', help = 'Process to profile: processor, nmea, camera_bus or server')
+	parser.add_argument('-s', '--seconds', type = float, default = DEFAULT_SECONDS, help = 'How long to profile for (default: %g)'%(DEFAULT_SECONDS))
+	args = parser.parse_args()
+	print('Profiling %s for %g seconds - the profile will be written to %s'%(args.name, args.seconds, request(args.name, args.seconds)))
@@ -0,0 +1,153 @@
+import datetime
+import numpy
+
+from lib import records
+from lib import plants
+
+# the bounding box of a record is split into GRID_CELLS x GRID_CELLS cells for spatial queries
+GRID_CELLS = 64
+
+class QueryIndex:
+	"""Answers time range, bounding box and plant type queries over a record array without scanning every line.
+	Lines are indexed twice: by timestamp (sorted), and by the cell of a uniform longitude/latitude grid they fall in.
+	A query takes its candidate lines from whichever index narrows things down the most, then checks only those
+	candidates against the rest of the conditions."""
+	def __init__(self, array):
+		self.array = array
+		self.timestamps = numpy.asarray(array['timestamp'])
+		self.longitudes = numpy.asarray(array['longitude'])
+		self.latitudes = numpy.asarray(array['latitude'])
+		self.rows = numpy.asarray(array['rows'])
+		# records are written in time order, but don't count on it (e.g. if the clock was set during a run)
+		if numpy.all(self.timestamps[1:] >= self.timestamps[:-1]):
+			self.time_order = None
+			self.sorted_times = self.timestamps
+		else:
+			self.time_order = numpy.argsort(self.timestamps, kind = 'stable')
+			self.sorted_times = self.timestamps[self.time_order]
+		if len(array) != 0:
+			self.bounds = (float(self.longitudes.min()), float(self.latitudes.min()), float(self.longitudes.max()), float(self.latitudes.max()))
+			cols, rows = self._cells(self.longitudes, self.latitudes)
+			keys = rows * GRID_CELLS + cols
+			self.cell_order = numpy.argsort(keys, kind = 'stable')
+			self.cell_starts = numpy.searchsorted(keys[self.cell_order], numpy.arange(GRID_CELLS * GRID_CELLS + 1))
+	def __len__(self):
+		return len(self.timestamps)
+	def _cells(self, longitudes, latitudes):
+		"""Returns the (column, row) grid cells of the given positions, clipped to the grid"""
+		min_lon, min_lat, max_lon, max_lat = self.bounds
+		cols = numpy.floor((numpy.asarray(longitudes) - min_lon) / max(max_lon - min_lon, 1e-12) * GRID_CELLS).astype(numpy.int64)
+		rows = numpy.floor((numpy.asarray(latitudes) - min_lat) / max(max_lat - min_lat, 1e-12) * GRID_CELLS).astype(numpy.int64)
+		return numpy.clip(cols, 0, GRID_CELLS - 1), numpy.clip(rows, 0, GRID_CELLS - 1)
+	def _time_candidates(self, start, end):
+		lo = 0 if start is None else numpy.searchsorted(self.sorted_times, records.to_timestamp(start), 'left')
+		hi = len(self) if end is None else numpy.searchsorted(self.sorted_times, records.to_timestamp(end), 'right')
+		if self.time_order is None:
+			return numpy.arange(lo, hi)
+		return self.time_order[lo:hi]
+	def _bbox_candidates(self, bbox):
+		min_lon, min_lat, max_lon, max_lat = bbox
+		if min_lon > self.bounds[2] or max_lon < self.bounds[0] or min_lat > self.bounds[3] or max_lat < self.bounds[1]:
+			return numpy.zeros(0, numpy.intp)
+		(first_col, last_col), (first_row, last_row) = self._cells([min_lon, max_lon], [min_lat, max_lat])
+		# cells in one grid row are contiguous in cell_order, so each grid row is a single slice
+		slices = [self.cell_order[self.cell_starts[row * GRID_CELLS + first_col]:self.cell_starts[row * GRID_CELLS + last_col + 1]] \
+			for row in range(first_row, last_row + 1)]
+		return numpy.concatenate(slices)
+	def query(self, start = None, end = None, bbox = None, plant_types = plants.Plants.NONE):
+		"""Returns the indices (in record order) of the lines recorded between the datetimes start and end (inclusive),
+		within bbox = (min longitude, min latitude, max longitude, max latitude), and with at least one of plant_types
+		in one of their rows. Conditions that are None (or NONE, for plant_types) aren't applied."""
+		if len(self) == 0:
+			return numpy.zeros(0, numpy.intp)
+		candidates = None
+		if start is not None or end is not None:
+			candidates = self._time_candidates(start, end)
+		if bbox is not None:
+			in_bbox = self._bbox_candidates(bbox)
+			candidates = in_bbox if candidates is None or len(in_bbox) < len(candidates) else candidates
+		if candidates is None:
+			candidates = numpy.arange(len(self))
+		keep = numpy.ones(len(candidates), bool)
+		if start is not None:
+			keep &= self.timestamps[candidates] >= records.to_timestamp(start)
+		if end is not None:
+			keep &= self.timestamps[candidates] <= records.to_timestamp(end)
+		if bbox is not None:
+			longitudes, latitudes = self.longitudes[candidates], self.latitudes[candidates]
+			keep &= (longitudes >= bbox[0]) & (latitudes >= bbox[1]) & (longitudes <= bbox[2]) & (latitudes <= bbox[3])
+		if plant_types != plants.Plants.NONE:
+			keep &= numpy.any((self.rows[candidates] & int(plant_types)) != 0, axis = 1)
+		return numpy.sort(candidates[keep])
+	def lines(self, indices):
+		"""Returns the RecordLines at the given indices"""
+		return [records.RecordLine.from_row(self.array[i]) for i in indices]
+
+def parse_when(string):
+	"""Parses a query time: either a full ISO date and time (returned as a datetime), or just a time of day such as
+	'10:02' (returned as a time - see on_date()). Records are in naive local time, so a date and time with a time zone
+	('...Z', '...+02:00') is converted to local time. Raises a ValueError if it is neither, or if it is a time of day
+	with a time zone (which can't be converted without a date)."""
+	try:
+		when = datetime.datetime.fromisoformat(string)
+	except ValueError:
+		when = datetime.time.fromisoformat(string)
+		if when.tzinfo is not None:
+			raise ValueError('A time of day cannot have a time zone: %s'%(string))
+		return when
+	if when.tzinfo is not None:
+		when = when.astimezone().replace(tzinfo = None)
+	return when
+
+def on_date(when, date):
+	"""Turns a time of day from parse_when() into a datetime on the given date (today, if date is None). datetimes
+	and None are returned as they are."""
+	if isinstance(when, datetime.time):
+		return datetime.datetime.combine(date if date is not None else datetime.date.today(), when)
+	return when
+
+def parse_time(string, date):
+	"""Parses a query time (see parse_when()), taking times of day to be on the given date"""
+	return on_date(parse_when(string), date)
+
+def parse_bbox(string):
+	"""Parses a bounding box given as 'min longitude,min latitude,max longitude,max latitude'"""
+	bbox = tuple(float(value) for value in string.split(','))
+	if len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+		raise ValueError('Invalid bounding box %s'%(string))
+	return bbox
+
+# plant names are matched in any case, so the lowercase names the catalogue and heatmap JSON use work as well
+_PLANT_NAMES = { plant.name.lower(): plant for plant in plants.Plants if plant != plants.Plants.NONE }
+
+def parse_plants(string):
+	"""Parses a comma- or pipe-delimited list of plant names, in any case and with or without a 'Plants.' prefix.
+	Raises a ValueError listing the valid names if one of them isn't a plant."""
+	found = plants.Plants.NONE
+	for name in string.replace(',', '|').split('|'):
+		name = name.strip().lower()
+		if name.startswith('plants.'):
+			name = name[len('plants.'):]
+		if name == '':
+			continue
+		if name not in _PLANT_NAMES:
+			raise ValueError('Unknown plant %s - expected any of %s'%(name, ', '.join(_PLANT_NAMES)))
+		found |= _PLANT_NAMES[name]
+	return found
+
+if __name__ == '__main__':
+	import argparse
+	parser = argparse.ArgumentParser(description = 'Query the lines of a record')
+	parser.add_argument('record_id', help = 'Record to query')
+	parser.add_argument('-s', '--start', help = 'Earliest time (ISO date and time, or time of day)')
+	parser.add_argument('-e', '--end', help = 'Latest time (ISO date and time, or time of day)')
+	parser.add_argument('-b', '--bbox', help = 'Bounding box: min longitude,min latitude,max longitude,max latitude')
+	parser.add_argument('-p', '--plants', help = 'Plant types, e.g. Foxtail,Ragweed')
+	args = parser.parse_args()
+	record = records.Record.read(args.record_id)
+	index = QueryIndex(record.array())
+	date = records.from_timestamp(index.sorted_times[0]).date() if len(index) != 0 else datetime.date.today()
+	found = index.query(parse_time(args.start, date) if args.start else None, parse_time(args.end, date) if args.end else None, \
+		parse_bbox(args.bbox) if args.bbox else None, parse_plants(args.plants) if args.plants else plants.Plants.NONE)
+	for line in index.lines(found):
+		print(line)
@@ -1,16 +1,31 @@
 import os
+import time
 import cv2
 import datetime
 import numpy
 import math
+import struct
+import zlib
+import queue
+import threading
+import fcntl
 
 from lib import plants
+from lib import loghelper
 
-#Records are stored as DIR/yyyymmdd-#.rec
+#Records are stored as DIR/yyyy-mm-dd_#.rec, or DIR/yyyy-mm-dd_#.recb once converted to the binary format, or
+#DIR/ARCHIVE_DIR/yyyy-mm/yyyy-mm-dd_#.reca once compressed by lib.archive
 DIR = '/home/agbot/agbot-srvr/records'
 EXT = '.rec'
+BIN_EXT = '.recb'
+ARCHIVE_EXT = '.reca'
+ARCHIVE_DIR = 'archive'
 CURRENT = 'CURRENT'
 
+# RecordWriter flushes and fsyncs at least this often, or whenever this much data is waiting to be written
+FLUSH_INTERVAL = 1.0 # seconds
+FLUSH_BYTES = 64 * 1024
+
 MAX_IMG_WIDTH = 700
 MAX_IMG_HEIGHT = 500
 PLANT_RADIUS_FT = 2 / 12 # TODO: adjust as needed. This is 4 inches diameter for one plant
@@ -22,8 +37,143 @@ def get_name(record_id):
 	return record_id
 
 def get_records():
-	files = [file[:-len(EXT)] for file in os.listdir(DIR) if os.path.isfile(os.path.join(DIR, file)) and file.endswith(EXT)]
-	return [(record_id, get_name(record_id)) for record_id in files]
+	files = set()
+	for file in os.listdir(DIR):
+		if os.path.isfile(os.path.join(DIR, file)):
+			for ext in (EXT, BIN_EXT):
+				if file.endswith(ext):
+					files.add(file[:-len(ext)])
+	archive = os.path.join(DIR, ARCHIVE_DIR)
+	if os.path.isdir(archive):
+		for month in os.listdir(archive):
+			for file in os.listdir(os.path.join(archive, month)):
+				if file.endswith(ARCHIVE_EXT):
+					files.add(file[:-len(ARCHIVE_EXT)])
+	return [(record_id, get_name(record_id)) for record_id in sorted(files)]
+
+def get_archive_path(record_id):
+	"""Returns where the compressed archive of a record goes. Archives are grouped by month so the directories stay
+	small, and the month comes from the record ID so the archive can be found without searching."""
+	record_id = os.path.basename(record_id)
+	return os.path.join(DIR, ARCHIVE_DIR, record_id[:7], record_id + ARCHIVE_EXT)
+
+def get_path(record_id):
+	"""Returns the path of the file holding the given record, preferring the binary format if both exist, and the
+	archive if neither does. Raises a FileNotFoundError if there is no such record."""
+	# os.path.basename() keeps record IDs from the web API from reaching outside DIR
+	for ext in (BIN_EXT, EXT):
+		path = os.path.join(DIR, os.path.basename(record_id) + ext)
+		if os.path.isfile(path):
+			return path
+	path = get_archive_path(record_id)
+	if os.path.isfile(path):
+		return path
+	raise FileNotFoundError('%s is not a valid record file'%(record_id))
+
+# Binary record format: a HEADER_SIZE-byte header (magic, format version, number of rows, zero padding) followed by
+# one record_dtype() entry per record line. Timestamps are microseconds since 1970-01-01 in local time (the text
+# format stores naive local times too), and each row is a Plants bitmask.
+BIN_MAGIC = b'AGBOTREC'
+BIN_VERSION = 1
+HEADER_SIZE = 64
+_HEADER = struct.Struct('<8sHH')
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+def record_dtype(rows = len(ROW_DIST)):
+	return numpy.dtype([('timestamp', '<i8'), ('longitude', '<f8'), ('latitude', '<f8'), ('rows', 'u1', (rows,))])
+RECORD_DTYPE = record_dtype()
+
+def to_timestamp(time):
+	"""Converts a naive datetime to the integer timestamp used by the binary format"""
+	return (time - _EPOCH) // datetime.timedelta(microseconds = 1)
+def from_timestamp(timestamp):
+	return _EPOCH + datetime.timedelta(microseconds = int(timestamp))
+
+def read_binary(path):
+	"""Memory-maps a binary record file and returns it as a numpy structured array. Nothing is parsed."""
+	with open(path, 'rb') as file:
+		magic, version, rows = _HEADER.unpack(file.read(_HEADER.size))
+	if magic != BIN_MAGIC or version != BIN_VERSION:
+		raise ValueError('%s is not a version %d binary record file'%(path, BIN_VERSION))
+	dtype = record_dtype(rows)
+	count = (os.path.getsize(path) - HEADER_SIZE) // dtype.itemsize
+	if count == 0:
+		return numpy.zeros(0, dtype)
+	return numpy.memmap(path, dtype, 'r', HEADER_SIZE, (count,))
+
+def write_binary(path, array):
+	"""Writes a structured array (see record_dtype()) to a binary record file. The file is written under a temporary
+	name and then renamed, so readers never see a partial file."""
+	temp = path + '.tmp'
+	with open(temp, 'wb') as file:
+		header = _HEADER.pack(BIN_MAGIC, BIN_VERSION, array.dtype['rows'].shape[0])
+		file.write(header + bytes(HEADER_SIZE - len(header)))
+		file.write(array.tobytes())
+		file.flush()
+		os.fsync(file.fileno())
+	os.rename(temp, path)
+
+def _lines_to_array(lines):
+	array = numpy.zeros(len(lines), RECORD_DTYPE)
+	for i, line in enumerate(lines):
+		array[i] = (to_timestamp(line.timestamp), line.longitude, line.latitude, [int(row) for row in line.rowdata])
+	return array
+
+CHUNK_LINES = 4096
+
+def iter_chunks(record_id, chunk_lines = CHUNK_LINES):
+	"""Reads a record a piece at a time, yielding structured arrays (see record_dtype()) of up to chunk_lines lines
+	each, so that even huge records can be processed in constant memory. Binary records are sliced straight out of the
+	memory-mapped file; text records are parsed as they are read."""
+	path = get_path(record_id)
+	if path.endswith(BIN_EXT):
+		array = read_binary(path)
+		for start in range(0, len(array), chunk_lines):
+			yield array[start:start + chunk_lines]
+		return
+	if path.endswith(ARCHIVE_EXT):
+		from lib import archive
+		with archive.ArchiveReader(path) as reader:
+			for start in range(0, len(reader), chunk_lines):
+				yield reader.read(start, start + chunk_lines)
+		return
+	with open(path) as file:
+		lines = []
+		for line in file:
+			text = _unframe(line)
+			if text is None:
+				continue
+			lines.append(RecordLine.read(text))
+			if len(lines) == chunk_lines:
+				yield _lines_to_array(lines)
+				lines = []
+		if len(lines) != 0:
+			yield _lines_to_array(lines)
+
+def new_record_path(date = None):
+	"""Returns the path for the next record started on the given date (today by default)"""
+	date = str(date if date is not None else datetime.date.today())
+	numbers = [-1]
+	archive = os.path.join(DIR, ARCHIVE_DIR, date[:7])
+	for file in os.listdir(DIR) + (os.listdir(archive) if os.path.isdir(archive) else []):
+		for ext in (EXT, BIN_EXT, ARCHIVE_EXT):
+			if file.startswith(date + '_') and file.endswith(ext):
+				# trim the date and extension from the file names and parse the numbers
+				try:
+					numbers.append(int(file[len(date) + 1:-len(ext)]))
+				except ValueError:
+					pass
+	return os.path.join(DIR, '%s_%d%s'%(date, max(numbers) + 1, EXT))
+
+def convert(record_id, keep_text = False):
+	"""Converts a text record to the binary format. The text file is deleted afterwards unless keep_text is True."""
+	path = os.path.join(DIR, os.path.basename(record_id) + EXT)
+	if not os.path.isfile(path):
+		raise FileNotFoundError('%s is not a valid text record file'%(record_id))
+	record = Record.read_text(record_id, path)
+	write_binary(os.path.join(DIR, os.path.basename(record_id) + BIN_EXT), record.array())
+	if not keep_text:
+		os.remove(path)
 
 def _vec(*components):
 	return numpy.array(components, numpy.float64)
@@ -33,14 +183,14 @@ def _hat(vector):
 	return vector / _mag(vector)
 def _crossprod(v1, v2):
 	return _vec(v1[1]*v2[2] - v1[2]*v2[1], v1[2]*v2[0] - v1[0]*v2[2], v1[0]*v2[1] - v1[1]*v2[0])
-def _dotprod(v1, v2):
-	return sum([x*y for x,y in zip(v1, v2)])
 EARTH_RADIUS = 20_902_464 # feet
 def _to_cartesian(longitude, latitude):
-	theta = math.radians(longitude)
-	phi = math.radians(90 - latitude)
-	xy_radius = math.sin(phi) * EARTH_RADIUS
-	return _vec(xy_radius * math.cos(theta), xy_radius * math.sin(theta), EARTH_RADIUS * math.cos(phi))
+	"""Converts a longitude and latitude (or arrays of them) to cartesian coordinates. The last axis of the result
+	holds (x, y, z)."""
+	theta = numpy.radians(longitude)
+	phi = numpy.radians(90 - numpy.asarray(latitude, numpy.float64))
+	xy_radius = numpy.sin(phi) * EARTH_RADIUS
+	return numpy.stack((xy_radius * numpy.cos(theta), xy_radius * numpy.sin(theta), EARTH_RADIUS * numpy.cos(phi)), axis = -1)
 def _coordinate_vectors(x0, y0, z0):
 	"""Returns two vectors - one pointing North in three dimensions (relative to the current position)
 	and one pointing East in three dimensions (relative to the current position)"""
@@ -65,9 +215,67 @@ def _coordinate_vectors(x0, y0, z0):
 	east = _hat(_crossprod(north, _vec(x0, y0, z0)))
 	return north, east
 
+def project(longitudes, latitudes, center_longitude, center_latitude):
+	"""Projects arrays of positions onto the plane tangent to the earth at the given center. Returns two arrays with
+	the distance of each position east and north of the center, in feet."""
+	center = _to_cartesian(center_longitude, center_latitude)
+	north_vec, east_vec = _coordinate_vectors(center[0], center[1], center[2])
+	rel_posns = _to_cartesian(longitudes, latitudes) - center
+	return rel_posns @ east_vec, rel_posns @ north_vec
+
+_ROW_DIST = numpy.array(ROW_DIST, numpy.float64)
+
+def row_positions(east, north):
+	"""Given the projected positions of each line of a record (see project()), returns an array of shape
+	(lines, rows, 2) with the (east, north) position of the center of each row, in feet. Rows are offset at right
+	angles to the direction of travel, which is taken from the change in position since the previous line."""
+	posns = numpy.stack((east, north), axis = 1)
+	velocity = numpy.diff(posns, axis = 0)
+	velocity = numpy.concatenate((velocity[:1], velocity)) if len(velocity) != 0 else numpy.zeros_like(posns)
+	# a vector normal to the direction of travel, pointing right - or zero if we weren't moving
+	speed = numpy.hypot(velocity[:, 0], velocity[:, 1])
+	normal = numpy.stack((velocity[:, 1], -velocity[:, 0]), axis = 1)
+	normal = numpy.divide(normal, speed[:, None], out = numpy.zeros_like(normal), where = speed[:, None] != 0)
+	return posns[:, None, :] + _ROW_DIST[None, :, None] * normal[:, None, :]
+
+def draw_plants(img, xs, ys, rows, radius_px):
+	"""Draws a filled circle for every plant found. xs and ys are integer arrays of pixel coordinates, and rows is
+	a matching array of Plants bitmasks. Instead of one cv2.circle() call per plant, each kind of plant is stamped
+	onto a mask and grown into circles with a single dilation, so the cost hardly depends on the number of plants.
+	Where plants overlap, the highest-valued one is drawn on top."""
+	height, width = img.shape[:2]
+	inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+	xs, ys, rows = xs[inside], ys[inside], rows[inside]
+	kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * radius_px + 1, 2 * radius_px + 1))
+	for plant in plants.Plants:
+		if plant == plants.Plants.NONE:
+			continue
+		found = (rows & int(plant)) != 0
+		if not numpy.any(found):
+			continue
+		mask = numpy.zeros((height, width), numpy.uint8)
+		mask[ys[found], xs[found]] = 255
+		mask = cv2.dilate(mask, kernel)
+		img[mask != 0] = get_color(plant)
+
 # RecordLine text format: [ISO Local Time] [latitude] [longitude] [plants]
 # [plants] is a comma-delimited list of Plants objects (which are themselves pipe-delimited).
 # Each entry in the list corresponds to a row, and the rows are listed left to right.
+# Lines written by RecordWriter end with ' *' and the CRC32 of the rest of the line in hex, so a line that was only
+# partly written when the power went out can be recognized and dropped.
+def _frame(text):
+	return '%s *%08x'%(text, zlib.crc32(text.encode('utf-8')))
+def _unframe(line):
+	"""Returns the text of a record file line without its checksum, or None if the checksum doesn't match. Lines
+	without a checksum (from records written before they were added) are returned as they are."""
+	line = line.strip()
+	text, sep, checksum = line.rpartition(' *')
+	if sep == '':
+		return line if len(line) != 0 else None
+	try:
+		return text if int(checksum, 16) == zlib.crc32(text.encode('utf-8')) else None
+	except ValueError:
+		return None
 def _img_compute_scale(width_ft, height_ft):
 	if width_ft == 0 and height_ft == 0:
 		raise ValueError('Cannot compute scale: area given is infinitesimal')
@@ -86,15 +294,6 @@ def get_color(plant):
 		return (0, 255, 246) #yellow
 	elif plants.Plants.Ragweed in plant:
 		return (255, 0, 0) #blue
-def _draw_record_line(img, record_line, posn_px, normal_ft, scale, plant_radius_px):
-	for row_offs, row in zip(ROW_DIST, record_line.rowdata):
-		center = posn_px + scale * row_offs * normal_ft # find the center of any weeds found in that row
-		for plant in row:
-			# debug only
-			#print('drawing circle at (%d,%d), radius %d, color (%d %d %d)'\
-			#	%(int(center[0]), int(center[1]), plant_radius_px, get_color(plant)[0], get_color(plant)[1], get_color(plant)[2]))
-			cv2.circle(img, (int(center[0]), int(center[1])), plant_radius_px, get_color(plant), -1)
-
 class RecordLine:
 	@classmethod
 	def read(cls, string):
@@ -102,6 +301,11 @@ class RecordLine:
 		rows = ' '.join(parts[3:]).split(',')
 		return RecordLine(datetime.datetime.fromisoformat(parts[0]), float(parts[1]), float(parts[2]), \
 			[plants.Plants.deserialize(row.strip()) for row in rows])
+	@classmethod
+	def from_row(cls, row):
+		"""Builds a RecordLine from one entry of a record array"""
+		return RecordLine(from_timestamp(row['timestamp']), float(row['longitude']), float(row['latitude']), \
+			[plants.Plants(int(plant)) for plant in row['rows']])
 	def __init__(self, timestamp, longitude, latitude, rows):
 		self.timestamp = timestamp
 		self.longitude = longitude
@@ -130,26 +334,57 @@ class RecordSummary:
 class Record:
 	@classmethod
 	def read(cls, record_id):
-		path = record_id + EXT
-		if not path in os.listdir(DIR):
-			raise FileNotFoundError('%s is not a valid record file'%(record_id))
+		path = get_path(record_id)
+		if path.endswith(BIN_EXT):
+			record = Record(record_id, get_name(record_id))
+			record.data = read_binary(path)
+			return record
+		if path.endswith(ARCHIVE_EXT):
+			# imported here because lib.archive itself builds on this module
+			from lib import archive
+			record = Record(record_id, get_name(record_id))
+			record.data = archive.read_archive(path)
+			return record
+		return cls.read_text(record_id, path)
+	@classmethod
+	def read_text(cls, record_id, path):
 		record = Record(record_id, get_name(record_id))
-		with open(os.path.join(DIR, path)) as file:
+		with open(path) as file:
 			for line in file:
-				record.lines.append(RecordLine.read(line.strip()))
+				text = _unframe(line)
+				if text is not None:
+					record.lines.append(RecordLine.read(text))
 		return record
 	def __init__(self, record_id, name):
 		self.record_id = record_id
 		self.name = name
 		self.summary = None
 		self.lines = []
+		# binary records are backed by a structured array (see record_dtype()) instead of a list of RecordLines
+		self.data = None
+		self._array = None
+		# for snapshots taken by a RecordTail: which run of the live record (see RecordTail.generation) it shows
+		self.generation = None
 	def __iter__(self):
-		return self.lines.__iter__()
+		if self.data is None:
+			return self.lines.__iter__()
+		return (RecordLine.from_row(row) for row in self.data)
 	def __len__(self):
-		return len(self.lines)
+		return len(self.lines) if self.data is None else len(self.data)
+	def array(self):
+		"""Returns the record as a numpy structured array (see record_dtype()). For binary records this is the
+		memory-mapped file itself; for text records it is built from the lines on first use."""
+		if self.data is not None:
+			return self.data
+		# lines are only ever appended, so only convert the ones we haven't seen yet
+		done = 0 if self._array is None else len(self._array)
+		if done != len(self.lines):
+			new = _lines_to_array(self.lines[done:])
+			self._array = new if self._array is None else numpy.concatenate((self._array, new))
+		return self._array
 	def write(self, file):
-		for line in self.lines:
-			print(str(line), file)
+		for line in self:
+			print(str(line), file=file)
 		file.flush()
 	def render(self):
 		if len(self) == 0:
@@ -158,11 +393,8 @@ class Record:
 			return img
 		else:
 			self.get_summary()
-			center = _to_cartesian(self.summary.longitude, self.summary.latitude)
-			north_vec, east_vec = _coordinate_vectors(center[0], center[1], center[2])
-			rel_posns = [_to_cartesian(record.longitude, record.latitude) - center for record in self]
-			rel_north = [_dotprod(north_vec, rel_posn) for rel_posn in rel_posns]
-			rel_east = [_dotprod(east_vec, rel_posn) for rel_posn in rel_posns]
+			array = self.array()
+			rel_east, rel_north = project(array['longitude'], array['latitude'], self.summary.longitude, self.summary.latitude)
 			# add a margin to account for width of the BOT
 			margin = ROW_DIST[-1] + PLANT_RADIUS_FT + 3
 			furthest_east = numpy.max(rel_east) + margin
@@ -174,42 +406,197 @@ class Record:
 			width_px, height_px = math.floor(width_ft * scale), math.floor(height_ft * scale)
 			img = numpy.full((height_px, width_px, 3), 200, numpy.uint8)
 			plant_radius_px = math.ceil(scale * PLANT_RADIUS_FT) # radius >= 1 - always draw at least 1px
-			def _posn_ft(i):
-				return _vec(rel_east[i], rel_north[i])
-			def _posn_px(i):
-				posn_ft = _posn_ft(i)
-				return _vec(int(scale * (posn_ft[0] - furthest_west)), int(scale * (furthest_north - posn_ft[1])))
-			if len(self) == 1:
-				_draw_record_line(img, self.lines[0], _posn_ft(0), _vec(0,0), scale, plant_radius_px)
-			else:
-				for i in range(len(self)):
-					posn_ft = _posn_ft(i)
-					print('posn_ft(%d)=%s'%(i, repr(posn_ft)))
-					print('posn_px(%d)=%s'%(i, repr(_posn_px(i))))
-					velocity_ft = posn_ft - _posn_ft(i - 1) if i != 0 else _posn_ft(i + 1) - posn_ft
-					# compute a vector normal to the direction of travel, pointing right
-					normal_ft = _hat(_vec(velocity_ft[1], velocity_ft[0])) if (velocity_ft[0] != 0 or velocity_ft[1] != 0) else _vec(0, 0)
-					_draw_record_line(img, self.lines[i], _posn_px(i), normal_ft, scale, plant_radius_px)
+			posns = row_positions(rel_east, rel_north)
+			xs = (scale * (posns[:, :, 0] - furthest_west)).astype(numpy.intp)
+			ys = (scale * (furthest_north - posns[:, :, 1])).astype(numpy.intp)
+			draw_plants(img, xs.ravel(), ys.ravel(), numpy.asarray(array['rows']).ravel(), plant_radius_px)
 			# TODO: if we want to draw a little AgBot picture in the last position, do that here
 			return img
 	def get_summary(self):
 		if self.summary is None:
 			if len(self) == 0:
 				raise ValueError('Cannot compute summary of an empty record')
-			avg_latitude = sum(record.latitude for record in self) / len(self)
-			longitudes1 = numpy.array([record.longitude for record in self], numpy.float64)
-			longitudes2 = numpy.array([record.longitude if record.longitude < 180.0 else record.longitude - 360.0 \
-									for record in self], numpy.float64)
-			avg_longitude = numpy.average(longitudes2) \
+			array = self.array()
+			avg_latitude = float(numpy.average(array['latitude']))
+			longitudes1 = numpy.asarray(array['longitude'], numpy.float64)
+			longitudes2 = numpy.where(longitudes1 < 180.0, longitudes1, longitudes1 - 360.0)
+			avg_longitude = float(numpy.average(longitudes2) \
 							if numpy.std(longitudes2) < numpy.std(longitudes1) \
-							else numpy.average(longitudes1)
+							else numpy.average(longitudes1))
 			self.summary = RecordSummary(
 				self.record_id, self.name, \
-				min(record.timestamp for record in self), \
-				max(record.timestamp for record in self), \
+				from_timestamp(array['timestamp'].min()), \
+				from_timestamp(array['timestamp'].max()), \
 				avg_latitude, avg_longitude)
 		return self.summary
 	def __str__(self):
 		return "Record '%s' (%d lines)"%(self.name, len(self))
 	def __repr__(self):
 		return 'Record(record_id=%s, name=%s, len=%d)'%(self.record_id, self.name, len(self))
+
+class RecordTail:
+	"""Follows a text record that is still being written (i.e. CURRENT). Each call to update() parses only the
+	complete lines appended since the last call, so keeping up with a growing record costs time proportional to the
+	new data rather than the whole file. If the file is truncated or replaced (a new run started), it starts over,
+	and generation goes up."""
+	def __init__(self, record_id):
+		self.record_id = record_id
+		self.lock = threading.Lock()
+		self.generation = 0
+		self._reset(None)
+	def _reset(self, inode):
+		self.record = Record(self.record_id, get_name(self.record_id))
+		self.snapshot = None
+		self.generation += 1
+		self.inode = inode
+		self.offset = 0
+		self.partial = b''
+	def _snapshot(self):
+		"""Returns a Record of the lines read so far that later updates leave alone, so callers can use it without
+		holding the lock. Called with the lock held."""
+		if self.snapshot is None or len(self.snapshot.lines) != len(self.record.lines):
+			snapshot = Record(self.record_id, self.record.name)
+			snapshot.lines = list(self.record.lines) # (the RecordLines themselves never change)
+			snapshot.generation = self.generation
+			# the lines in the last snapshot's array are still the first lines of this one, so only the new ones need
+			# converting
+			if self.snapshot is not None and self.snapshot._array is not None:
+				snapshot._array = self.snapshot._array
+			self.snapshot = snapshot
+		return self.snapshot
+	def update(self):
+		"""Reads any newly appended lines and returns a snapshot of the Record so far (the same one as last time if
+		nothing was appended). Raises a FileNotFoundError if the file doesn't exist."""
+		with self.lock:
+			try:
+				file = open(os.path.join(DIR, os.path.basename(self.record_id) + EXT), 'rb')
+			except FileNotFoundError:
+				self._reset(None)
+				raise FileNotFoundError('%s is not a valid record file'%(self.record_id))
+			with file:
+				stat = os.fstat(file.fileno())
+				if stat.st_ino != self.inode or stat.st_size < self.offset:
+					self._reset(stat.st_ino)
+				if stat.st_size == self.offset:
+					return self._snapshot()
+				file.seek(self.offset)
+				data = file.read(stat.st_size - self.offset)
+			self.offset += len(data)
+			# hold on to any incomplete line at the end until the rest of it is written
+			complete, _, self.partial = (self.partial + data).rpartition(b'\n')
+			for line in complete.split(b'\n'):
+				try:
+					text = _unframe(line.decode('utf-8'))
+				except UnicodeDecodeError:
+					continue
+				if text is not None:
+					self.record.lines.append(RecordLine.read(text))
+			return self._snapshot()
+
+class RecordWriter:
+	"""Appends RecordLines to a record file from a background thread, so the caller never waits on formatting or disk
+	I/O. Lines are written in checksummed batches, and the file is flushed and fsynced every FLUSH_INTERVAL seconds
+	or FLUSH_BYTES bytes, whichever comes first - so a power cut only loses the last moments of data. While open,
+	the writer holds an exclusive lock on the file; this is how recover() tells a live record from an abandoned one."""
+	def __init__(self, path, flush_interval = FLUSH_INTERVAL, flush_bytes = FLUSH_BYTES):
+		self.path = path
+		self.flush_interval = flush_interval
+		self.flush_bytes = flush_bytes
+		self.file = open(path, 'ab')
+		try:
+			fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except OSError:
+			self.file.close()
+			raise
+		self.queue = queue.SimpleQueue()
+		self.error = None
+		self.count = 0 # lines appended so far
+		self.thread = threading.Thread(target = self._run, name = 'RecordWriter', daemon = True)
+		self.thread.start()
+	def append(self, *lines):
+		"""Queues RecordLines to be written. This never blocks."""
+		if self.error is not None:
+			raise self.error
+		self.queue.put(lines)
+		self.count += len(lines)
+	def _run(self):
+		buffer = []
+		size = 0
+		done = False
+		last_flush = time.monotonic()
+		try:
+			while not done:
+				try:
+					lines = self.queue.get(timeout = max(0.0, last_flush + self.flush_interval - time.monotonic()))
+					if lines is None:
+						done = True
+					else:
+						for line in lines:
+							data = (_frame(str(line)) + '\n').encode('utf-8')
+							buffer.append(data)
+							size += len(data)
+				except queue.Empty:
+					pass
+				if done or size >= self.flush_bytes or time.monotonic() - last_flush >= self.flush_interval:
+					if size != 0:
+						self.file.write(b''.join(buffer))
+						self.file.flush()
+						os.fsync(self.file.fileno())
+						buffer = []
+						size = 0
+					last_flush = time.monotonic()
+		except Exception as ex:
+			# append() and close() raise this from now on, so the caller finds out the lines aren't being written
+			self.error = ex
+			loghelper.get_logger(__file__).exception('Could not write to record %s - no more lines will be written', self.path)
+	def close(self):
+		"""Writes out everything queued so far and closes the file"""
+		if self.file is not None:
+			self.queue.put(None)
+			self.thread.join()
+			self.file.close()
+			self.file = None
+			if self.error is not None:
+				raise self.error
+	def finalize(self, path):
+		"""Closes the file and atomically moves it to path"""
+		self.close()
+		os.rename(self.path, path)
+
+def recover(path):
+	"""Finalizes a record file left behind by a RecordWriter that was never closed (because of a crash or power cut):
+	any partially-written line at the end is cut off and the file is moved to a new record. Returns the new path.
+	Raises a BlockingIOError if a live RecordWriter still has the file open."""
+	with open(path, 'r+b') as file:
+		fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+		good = 0
+		offset = 0
+		for line in file:
+			offset += len(line)
+			if not line.endswith(b'\n'):
+				break
+			try:
+				if _unframe(line.decode('utf-8')) is not None:
+					good = offset
+			except UnicodeDecodeError:
+				pass
+		file.truncate(good)
+		file.flush()
+		os.fsync(file.fileno())
+		date = datetime.date.fromtimestamp(os.fstat(file.fileno()).st_mtime)
+	new_path = new_record_path(date)
+	os.rename(path, new_path)
+	return new_path
+
+if __name__ == '__main__':
+	import argparse
+	parser = argparse.ArgumentParser(description = 'Convert text records to the binary record format')
+	parser.add_argument('records', nargs = '*', help = 'IDs of the records to convert. The default is every text record.')
+	parser.add_argument('-k', '--keep-text', action = 'store_true', help = 'Keep the text files after converting them')
+	args = parser.parse_args()
+	record_ids = args.records
+	if len(record_ids) == 0:
+		record_ids = [file[:-len(EXT)] for file in os.listdir(DIR) if file.endswith(EXT) and file != CURRENT + EXT]
+	for record_id in record_ids:
+		convert(record_id, args.keep_text)
+		print('Converted %s'%(record_id))
@@ -0,0 +1,64 @@
+import collections
+import os
+import threading
+
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+
+class RenderCache:
+	"""A thread-safe LRU cache of rendered (already encoded) images, bounded by their total size in bytes rather than
+	their number. If directory is given, entries are also written there so they survive a server restart.
+	Keys must be usable as file names, and should change whenever the underlying data does - then a stale entry is
+	simply never asked for again, and falls out of the cache on its own."""
+	def __init__(self, max_bytes = DEFAULT_MAX_BYTES, directory = None, ext = '.jpeg'):
+		self.max_bytes = max_bytes
+		self.directory = directory
+		self.ext = ext
+		self.entries = collections.OrderedDict()
+		self.size = 0
+		self.lock = threading.Lock()
+	def _path(self, key):
+		return os.path.join(self.directory, key + self.ext)
+	def get(self, key):
+		"""Returns the data cached under key, or None"""
+		with self.lock:
+			data = self.entries.get(key)
+			if data is not None:
+				self.entries.move_to_end(key)
+				return data
+		if self.directory is not None:
+			try:
+				with open(self._path(key), 'rb') as file:
+					data = file.read()
+			except OSError:
+				return None
+			self._insert(key, data)
+		return data
+	def put(self, key, data, persist = True, group = None):
+		"""Caches data under key. With persist = False the entry is only kept in memory. group names a set of keys
+		(e.g. every version of one record) of which only the newest needs to be kept on disk."""
+		self._insert(key, data)
+		if persist and self.directory is not None:
+			try:
+				os.makedirs(self.directory, exist_ok = True)
+				if group is not None:
+					for file in os.listdir(self.directory):
+						if file.startswith(group + '-') and file.endswith(self.ext):
+							os.remove(os.path.join(self.directory, file))
+				temp = self._path(key) + '.tmp'
+				with open(temp, 'wb') as file:
+					file.write(data)
+				os.rename(temp, self._path(key))
+			except OSError:
+				pass # the disk cache is only an optimization
+	def _insert(self, key, data):
+		if len(data) > self.max_bytes:
+			return
+		with self.lock:
+			old = self.entries.pop(key, None)
+			if old is not None:
+				self.size -= len(old)
+			self.entries[key] = data
+			self.size += len(data)
+			while self.size > self.max_bytes:
+				_, evicted = self.entries.popitem(last = False)
+				self.size -= len(evicted)
@@ -0,0 +1,134 @@
+import time
+
+from lib import loghelper
+
+# Ground a camera sees takes distance_ft / speed seconds to reach the tillers. Detection results for a frame have to
+# reach the multivator ACTUATION_TIME before that to be of any use; later than that, the frame is a deadline miss.
+ACTUATION_TIME = 0.25 # seconds - TODO: measure how long the multivator takes to move a tiller
+# How far (in the direction of travel) one camera frame reaches. Each camera has to take its next frame before the
+# ground moves this far, or some of it goes unseen (a coverage gap).
+FOV_LENGTH_FT = 2.0 # TODO: measure
+MIN_SPEED_FPS = 0.5 # below this, we're as good as stopped and there are no deadlines
+# Degradation levels, from best to cheapest: whether to skip cameras that see the same row as another one, and the
+# scale the frames are shrunk by before they are handed to darknet. The network's input size is set by its cfg file
+# (darknet resizes whatever it is given to that), so shrinking doesn't make the network any faster: what it saves is
+# converting the frame into darknet's image format (darknet_wrapper.array_to_image()), which grows with the frame.
+LEVELS = [(False, 1.0), (True, 1.0), (True, 0.75), (True, 0.5)]
+# A level is given up when a round of cameras takes longer than the ground takes to cross FOV_LENGTH_FT (utilization
+# over 1), and gone back to when utilization falls below UPGRADE_UTILIZATION - or, one level at a time, while we're
+# stopped and there are no deadlines. Either way, not more often than every HOLD_TIME seconds, so the timing estimates
+# have caught up with the last change.
+UPGRADE_UTILIZATION = 0.5
+HOLD_TIME = 2.0 # seconds
+SMOOTHING = 0.2 # weight of the newest measurement in each camera's running average detection time
+
+class CameraScheduler:
+	"""Decides which cameras the processor looks at, in which order, and at what input scale, based on how fast the BOT
+	is moving. cameras is a list of camera IDs, rows maps each to the row (see records.ROW_DIST) it sees, and
+	distances maps each to how far ahead of the tillers (in feet) the ground it sees is."""
+	def __init__(self, cameras, rows, distances, fov_ft = FOV_LENGTH_FT, actuation_time = ACTUATION_TIME):
+		self.cameras = list(cameras)
+		self.rows = rows
+		self.distances = distances
+		self.fov_ft = fov_ft
+		self.actuation_time = actuation_time
+		self.level = 0
+		self.changed = time.monotonic()
+		self.durations = {} # camera ID -> running average of how long detection takes, in seconds
+		self.last_capture = {} # camera ID -> time.monotonic() its last frame was captured
+		self.frames = 0
+		self.misses = 0
+		self.gaps = 0
+		self.skipped = 0
+		self.utilization = None
+		self.log = loghelper.get_logger(__file__)
+	@property
+	def scale(self):
+		"""The factor to shrink frames by before handing them to darknet"""
+		return LEVELS[self.level][1]
+	def _redundant(self):
+		"""Returns the cameras that see the same row as an earlier camera"""
+		seen = set()
+		redundant = set()
+		for camera in self.cameras:
+			if self.rows.get(camera) in seen:
+				redundant.add(camera)
+			seen.add(self.rows.get(camera))
+		return redundant
+	def _adapt(self, now, speed):
+		if speed is None or speed < MIN_SPEED_FPS:
+			self.utilization = None
+			if self.level > 0 and now - self.changed >= HOLD_TIME:
+				self.level -= 1
+				self.changed = now
+				self.log.info('Stopped - now %s redundant cameras at %.0f%% input scale', \
+					'skipping' if LEVELS[self.level][0] else 'using', self.scale * 100)
+			return
+		skip = self._redundant() if LEVELS[self.level][0] else set()
+		# until a camera has been timed, assume it takes as long as the slowest one that has
+		known = max(self.durations.values(), default = 0.0)
+		round_time = sum(self.durations.get(camera, known) for camera in self.cameras if camera not in skip)
+		self.utilization = round_time * speed / self.fov_ft
+		if now - self.changed < HOLD_TIME:
+			return
+		if self.utilization > 1.0 and self.level < len(LEVELS) - 1:
+			self.level += 1
+		elif self.utilization < UPGRADE_UTILIZATION and self.level > 0:
+			self.level -= 1
+		else:
+			return
+		self.changed = now
+		self.log.info('Camera round takes %.0f%% of the time available at %.1f ft/s - now %s redundant cameras at %.0f%% input scale', \
+			self.utilization * 100, speed, 'skipping' if LEVELS[self.level][0] else 'using', self.scale * 100)
+	def plan(self, now, speed):
+		"""Returns the camera IDs to process next, in order, given the ground speed in feet per second (None if it is
+		unknown). The camera closest to the tillers has the tightest deadline, so it goes first."""
+		self._adapt(now, speed)
+		cameras = self.cameras
+		if LEVELS[self.level][0]:
+			redundant = self._redundant()
+			cameras = [camera for camera in cameras if camera not in redundant]
+			self.skipped += len(self.cameras) - len(cameras)
+			for camera in redundant: # when they come back, the time they were left out isn't a coverage gap
+				self.last_capture.pop(camera, None)
+		if speed is None or speed < MIN_SPEED_FPS:
+			return sorted(cameras, key = lambda camera: self.last_capture.get(camera, 0.0))
+		return sorted(cameras, key = lambda camera: (self.distances.get(camera, 0.0), self.last_capture.get(camera, 0.0)))
+	def reset(self):
+		"""Forgets when each camera was last looked at, e.g. on entering a row, so the time since doesn't count as a
+		coverage gap"""
+		self.last_capture.clear()
+	def deadline(self, camera, capture_time, speed):
+		"""Returns the time.monotonic() value by which the results for a frame have to be sent, or None if there is
+		no deadline (because we aren't moving)"""
+		if speed is None or speed < MIN_SPEED_FPS:
+			return None
+		return capture_time + self.distances.get(camera, 0.0) / speed - self.actuation_time
+	def done(self, camera, capture_time, started, finished, speed):
+		"""Records that detection for a frame captured at capture_time ran from started to finished. Returns False if
+		the frame missed its deadline (and counts the miss), in which case its results may be too late to act on."""
+		self.frames += 1
+		duration = finished - started
+		previous = self.durations.get(camera)
+		self.durations[camera] = duration if previous is None else previous + SMOOTHING * (duration - previous)
+		last = self.last_capture.get(camera)
+		self.last_capture[camera] = capture_time
+		deadline = self.deadline(camera, capture_time, speed)
+		if deadline is None:
+			return True
+		if last is not None and (capture_time - last) * speed > self.fov_ft:
+			self.gaps += 1
+		if finished > deadline:
+			self.misses += 1
+			return False
+		return True
+	def stats(self):
+		return {
+			'frames': self.frames,
+			'misses': self.misses,
+			'gaps': self.gaps,
+			'skipped': self.skipped,
+			'level': self.level,
+			'scale': self.scale,
+			'utilization': self.utilization,
+		}
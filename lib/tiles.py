@@ -0,0 +1,154 @@
+import math
+import cv2
+import numpy
+
+from lib import records
+from lib import plants
+
+TILE_SIZE = 256 # pixels
+# the deepest zoom level shows at least this many pixels per foot
+DETAIL_SCALE = 24.0
+# below this plant radius (in pixels) circles would be invisible specks, so plants are drawn as density cells instead
+MIN_RADIUS_PX = 2.0
+# size of a density cell, in pixels
+DENSITY_CELL_PX = 4
+# a density cell with this many plants is drawn in full color
+DENSITY_SATURATION = 16
+BACKGROUND = 200
+
+_KINDS = [plant for plant in plants.Plants if plant != plants.Plants.NONE]
+
+class TileIndex:
+	"""A spatial index of the plants in a record, for rendering fixed-size map tiles of it at any zoom level.
+	The world is a square just big enough to hold the whole record; at zoom level z it is split into 2^z by 2^z tiles
+	of TILE_SIZE pixels. Tiles at the deeper zoom levels draw every plant, looked up by the tile it falls in at the
+	deepest level. Tiles at shallow zoom levels, where a plant would be smaller than a pixel or two, instead show how
+	many plants of each kind fall in each DENSITY_CELL_PX square; those counts are precomputed once at the deepest such
+	level, and merged into bigger cells for the levels above it."""
+	def __init__(self, array):
+		self.line_count = len(array)
+		if len(array) == 0:
+			raise ValueError('Cannot index an empty record')
+		longitudes, latitudes = numpy.asarray(array['longitude']), numpy.asarray(array['latitude'])
+		self.origin = (float((longitudes.min() + longitudes.max()) / 2), float((latitudes.min() + latitudes.max()) / 2))
+		east, north = records.project(longitudes, latitudes, *self.origin)
+		posns = records.row_positions(east, north)
+		rows = numpy.asarray(array['rows']).ravel()
+		found = rows != plants.Plants.NONE
+		xs, ys, rows = posns[:, :, 0].ravel()[found], posns[:, :, 1].ravel()[found], rows[found]
+		# the world: a square around every row position, with room for the circles drawn at the edges
+		margin = records.PLANT_RADIUS_FT + 1
+		min_x, max_x = float(posns[:, :, 0].min()) - margin, float(posns[:, :, 0].max()) + margin
+		min_y, max_y = float(posns[:, :, 1].min()) - margin, float(posns[:, :, 1].max()) + margin
+		self.extent = max(max_x - min_x, max_y - min_y)
+		self.west = (min_x + max_x - self.extent) / 2
+		self.north = (min_y + max_y + self.extent) / 2
+		self.max_zoom = max(0, math.ceil(math.log2(self.extent * DETAIL_SCALE / TILE_SIZE)))
+		# deepest zoom level that is drawn as density cells, or -1 if every level draws plants
+		self.density_zoom = -1
+		while self.density_zoom < self.max_zoom and self.scale(self.density_zoom + 1) * records.PLANT_RADIUS_FT < MIN_RADIUS_PX:
+			self.density_zoom += 1
+		# plants, sorted by the tile they fall in at max_zoom
+		n = 1 << self.max_zoom
+		size = self.extent / n
+		keys = _keys(numpy.clip(((self.north - ys) / size).astype(numpy.int64), 0, n - 1), \
+			numpy.clip(((xs - self.west) / size).astype(numpy.int64), 0, n - 1), n)
+		order = numpy.argsort(keys, kind = 'stable')
+		self.keys, self.xs, self.ys, self.rows = keys[order], xs[order], ys[order], rows[order]
+		# plant counts per density cell at density_zoom, as (cell row, cell column, counts per kind of plant)
+		if self.density_zoom >= 0:
+			cells = (1 << self.density_zoom) * TILE_SIZE // DENSITY_CELL_PX
+			size = self.extent / cells
+			cell_keys = _keys(numpy.clip(((self.north - ys) / size).astype(numpy.int64), 0, cells - 1), \
+				numpy.clip(((xs - self.west) / size).astype(numpy.int64), 0, cells - 1), cells)
+			unique, inverse = numpy.unique(cell_keys, return_inverse = True)
+			self.cell_rows, self.cell_cols = unique // cells, unique % cells
+			self.cell_counts = numpy.zeros((len(unique), len(_KINDS)), numpy.int64)
+			for k, plant in enumerate(_KINDS):
+				self.cell_counts[:, k] = numpy.bincount(inverse, weights = (rows & int(plant)) != 0, minlength = len(unique))
+	def scale(self, zoom):
+		"""Pixels per foot at the given zoom level"""
+		return TILE_SIZE * (1 << zoom) / self.extent
+	def info(self):
+		return {
+			'tileSize': TILE_SIZE,
+			'maxZoom': self.max_zoom,
+			'densityZoom': self.density_zoom,
+			'widthFt': self.extent,
+			'lineCount': self.line_count,
+		}
+	def render(self, zoom, x, y):
+		"""Returns the tile in column x and row y at the given zoom level as a TILE_SIZE x TILE_SIZE BGR image.
+		Raises a ValueError for tiles outside the world."""
+		if not 0 <= zoom <= self.max_zoom or not 0 <= x < (1 << zoom) or not 0 <= y < (1 << zoom):
+			raise ValueError('No tile %d/%d/%d'%(zoom, x, y))
+		img = numpy.full((TILE_SIZE, TILE_SIZE, 3), BACKGROUND, numpy.uint8)
+		if zoom <= self.density_zoom:
+			self._render_density(img, zoom, x, y)
+		else:
+			self._render_plants(img, zoom, x, y)
+		return img
+	def _render_plants(self, img, zoom, x, y):
+		scale = self.scale(zoom)
+		radius_px = math.ceil(scale * records.PLANT_RADIUS_FT)
+		# the tiles at max_zoom that this one covers, plus one more all around for circles overlapping the edge
+		shift = self.max_zoom - zoom
+		n = 1 << self.max_zoom
+		first_col, last_col = max((x << shift) - 1, 0), min(((x + 1) << shift), n - 1)
+		first_row, last_row = max((y << shift) - 1, 0), min(((y + 1) << shift), n - 1)
+		slices = []
+		for row in range(first_row, last_row + 1):
+			start, end = numpy.searchsorted(self.keys, [_keys(row, first_col, n), _keys(row, last_col, n) + 1])
+			if start != end:
+				slices.append(slice(start, end))
+		if len(slices) == 0:
+			return
+		xs = numpy.concatenate([self.xs[s] for s in slices])
+		ys = numpy.concatenate([self.ys[s] for s in slices])
+		rows = numpy.concatenate([self.rows[s] for s in slices])
+		tile_ft = TILE_SIZE / scale
+		xs = numpy.floor((xs - (self.west + x * tile_ft)) * scale).astype(numpy.intp)
+		ys = numpy.floor(((self.north - y * tile_ft) - ys) * scale).astype(numpy.intp)
+		# draw_plants() drops anything outside the image, so draw onto a tile with a border and crop it afterwards
+		border = radius_px
+		padded = numpy.full((TILE_SIZE + 2 * border, TILE_SIZE + 2 * border, 3), BACKGROUND, numpy.uint8)
+		records.draw_plants(padded, xs + border, ys + border, rows, radius_px)
+		img[:] = padded[border:border + TILE_SIZE, border:border + TILE_SIZE]
+	def _render_density(self, img, zoom, x, y):
+		# merge the precomputed cells into this level's cells - each level up halves the number of cells across
+		shift = self.density_zoom - zoom
+		cells = TILE_SIZE // DENSITY_CELL_PX
+		rows, cols = self.cell_rows >> shift, self.cell_cols >> shift
+		inside = (rows >= y * cells) & (rows < (y + 1) * cells) & (cols >= x * cells) & (cols < (x + 1) * cells)
+		if not numpy.any(inside):
+			return
+		index = (rows[inside] - y * cells) * cells + (cols[inside] - x * cells)
+		counts = self.cell_counts[inside]
+		# each cell gets the colors of its plants mixed in proportion to their counts, and gets more opaque the more
+		# plants it has
+		count = numpy.zeros((cells * cells, len(_KINDS)), numpy.float32)
+		for k in range(len(_KINDS)):
+			count[:, k] = numpy.bincount(index, weights = counts[:, k], minlength = cells * cells)
+		total = count.sum(axis = 1, keepdims = True)
+		colors = numpy.array([records.get_color(plant) for plant in _KINDS], numpy.float32)
+		mixed = count @ colors / numpy.maximum(total, 1)
+		alpha = numpy.minimum(numpy.log1p(total) / math.log1p(DENSITY_SATURATION), 1.0)
+		grid = (BACKGROUND * (1 - alpha) + mixed * alpha).reshape(cells, cells, 3)
+		img[:] = cv2.resize(grid.astype(numpy.uint8), (TILE_SIZE, TILE_SIZE), interpolation = cv2.INTER_NEAREST)
+
+def _keys(row, col, n):
+	return row * n + col
+
+if __name__ == '__main__':
+	import argparse
+	import os
+	parser = argparse.ArgumentParser(description = 'Render map tiles of a record')
+	parser.add_argument('record_id', help = 'Record to render')
+	parser.add_argument('zoom', type = int, nargs = '?', default = 0, help = 'Zoom level to render (default: 0)')
+	parser.add_argument('-o', '--output', default = '.', help = 'Directory to write the tiles to')
+	args = parser.parse_args()
+	index = TileIndex(records.Record.read(args.record_id).array())
+	print(index.info())
+	for y in range(1 << args.zoom):
+		for x in range(1 << args.zoom):
+			cv2.imwrite(os.path.join(args.output, '%s_%d_%d_%d.jpeg'%(args.record_id, args.zoom, x, y)), index.render(args.zoom, x, y))
@@ -0,0 +1,199 @@
+import concurrent.futures
+import collections
+import multiprocessing
+import os
+import threading
+import cv2
+
+from lib import records
+from lib import catalogue
+from lib import tiles
+from lib import query
+from lib import heatmap
+from lib import export
+
+# worker processes run at a lower priority than the server (and the processor), so rendering never slows them down
+NICENESS = 10
+PROCESSES = 2
+TIMEOUT = 30.0 # seconds a request waits for its result before giving up
+INDEX_COUNT = 4
+
+def _context():
+	# forking a process that is running threads (as the server is) can deadlock the child, so start workers from a
+	# clean fork server instead where we can
+	methods = multiprocessing.get_all_start_methods()
+	return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+def _initialize(directory):
+	records.DIR = directory
+	os.nice(NICENESS)
+
+class WorkerPool:
+	"""A bounded pool of worker processes for CPU-heavy work (parsing, rendering, encoding), so it runs outside the
+	server process and can't hold up other requests by holding the GIL. Identical requests that arrive while one is
+	already being worked on share its result instead of doing the same work again."""
+	def __init__(self, processes = PROCESSES, timeout = TIMEOUT):
+		self.processes = processes
+		self.timeout = timeout
+		self.executor = None
+		self.pending = {} # key -> Future of the work in progress
+		self.lock = threading.Lock()
+	def _executor(self):
+		# started on first use, so it picks up records.DIR as it is by then
+		if self.executor is None:
+			self.executor = concurrent.futures.ProcessPoolExecutor(self.processes, _context(), _initialize, (records.DIR,))
+		return self.executor
+	def run(self, key, function, *args):
+		"""Runs function(*args) in a worker process and returns its result, or raises whatever it raised. If work with
+		the same key is already under way, waits for that instead. Raises a concurrent.futures.TimeoutError if the
+		result takes longer than the timeout (the work carries on, and later requests with the same key can still
+		pick it up)."""
+		with self.lock:
+			future = self.pending.get(key)
+			if future is None:
+				try:
+					future = self._executor().submit(function, *args)
+				except concurrent.futures.process.BrokenProcessPool:
+					self._restart()
+					future = self._executor().submit(function, *args)
+				self.pending[key] = future
+				new = True
+			else:
+				new = False
+		if new:
+			# (outside the lock: if the future is already done, the callback runs right here, and takes the lock itself)
+			future.add_done_callback(lambda future: self._done(key, future))
+		try:
+			return future.result(self.timeout)
+		except concurrent.futures.process.BrokenProcessPool:
+			with self.lock:
+				self._restart()
+			raise
+	def _restart(self):
+		# a worker died (e.g. killed for using too much memory), which breaks the whole pool - start over with a new one
+		if self.executor is not None:
+			self.executor.shutdown(wait = False)
+			self.executor = None
+	def _done(self, key, future):
+		with self.lock:
+			if self.pending.get(key) is future:
+				del self.pending[key]
+	def stream(self, function, *args):
+		"""Runs the generator function(*args) in a process of its own, and yields the pieces of bytes it yields.
+		Raises a concurrent.futures.TimeoutError if the process goes quiet for longer than the timeout, and stops the
+		process if the caller stops reading."""
+		context = _context()
+		receiver, sender = context.Pipe(duplex = False)
+		process = context.Process(target = _stream, args = (sender, records.DIR, function, args), daemon = True)
+		process.start()
+		sender.close()
+		try:
+			while True:
+				if not receiver.poll(self.timeout):
+					raise concurrent.futures.TimeoutError('Worker process produced nothing for %g seconds'%(self.timeout))
+				data = receiver.recv()
+				if isinstance(data, Exception):
+					raise data
+				if len(data) == 0:
+					break
+				yield data
+		finally:
+			receiver.close()
+			if process.is_alive():
+				process.terminate()
+			process.join()
+	def shutdown(self):
+		if self.executor is not None:
+			self.executor.shutdown(wait = False, cancel_futures = True)
+			self.executor = None
+
+def _stream(connection, directory, function, args):
+	_initialize(directory)
+	try:
+		for data in function(*args):
+			connection.send(data)
+		connection.send(b'')
+	except BrokenPipeError:
+		pass # the server stopped reading
+	except Exception as ex:
+		connection.send(ex)
+	finally:
+		connection.close()
+
+# The functions below run in the worker processes. Each process keeps the indexes of the last few record versions it
+# was asked about, so e.g. the tiles of one record don't rebuild the tile index every time.
+
+class IndexCache:
+	"""Keeps the indexes (built by build(record array)) of the last few record versions that were asked for"""
+	def __init__(self, build, count = INDEX_COUNT):
+		self.build = build
+		self.count = count
+		self.indexes = collections.OrderedDict()
+	def get(self, record_id, version):
+		index = self.indexes.get(version)
+		if index is not None:
+			self.indexes.move_to_end(version)
+			return index
+		index = self.build(records.Record.read(record_id).array())
+		self.indexes[version] = index
+		while len(self.indexes) > self.count:
+			self.indexes.popitem(last = False)
+		return index
+
+_tile_indexes = IndexCache(tiles.TileIndex)
+_query_indexes = IndexCache(query.QueryIndex)
+_heatmap = (None, None) # (version, Aggregate) of the last heatmap computed
+
+def _jpeg(image):
+	retval, stream = cv2.imencode('.jpeg', image)
+	if not retval:
+		raise ValueError('Could not encode image as a JPEG')
+	return stream.tobytes()
+
+def render_record(record_id):
+	"""Returns the image of a whole record as JPEG data"""
+	return _jpeg(records.Record.read(record_id).render())
+
+def record_summary(record_id):
+	"""Returns the catalogue entry of a record, adding it to the catalogue first if need be"""
+	return catalogue.get(record_id)
+
+def reconcile_catalogue():
+	catalogue.reconcile()
+
+def tile_info(record_id, version):
+	return _tile_indexes.get(record_id, version).info()
+
+def render_tile(record_id, version, zoom, x, y):
+	"""Returns one map tile of a record as JPEG data"""
+	return _jpeg(_tile_indexes.get(record_id, version).render(zoom, x, y))
+
+def query_record(record_id, version, start, end, bbox, plant_types, offset, limit):
+	"""Answers a query (see query.QueryIndex.query()) and returns (total number of lines found, a page of them as
+	JSON-ready dicts). start and end may be times of day (datetime.time), which are taken to be on the record's date."""
+	index = _query_indexes.get(record_id, version)
+	date = records.from_timestamp(index.sorted_times[0]).date() if len(index) != 0 else None
+	start, end = [query.on_date(time, date) for time in (start, end)]
+	found = index.query(start, end, bbox, plant_types)
+	return len(found), [{
+		'time': line.timestamp.isoformat(),
+		'longitude': line.longitude,
+		'latitude': line.latitude,
+		'rows': [[plant.name for plant in row] for row in line.rowdata],
+	} for line in index.lines(found[offset:offset + limit])]
+
+def _aggregate(record_ids, version):
+	global _heatmap
+	if _heatmap[0] != version:
+		_heatmap = (version, heatmap.aggregate(record_ids))
+	return _heatmap[1]
+
+def heatmap_json(record_ids, version):
+	return _aggregate(record_ids, version).to_json()
+
+def heatmap_image(record_ids, version, plant_types):
+	return _jpeg(_aggregate(record_ids, version).render(plant_types))
+
+def export_record(record_id, format):
+	"""Yields the export of a record (see export.export()) in pieces of bytes - for WorkerPool.stream()"""
+	return export.export(record_id, format)
@@ -0,0 +1,313 @@
+#!/usr/bin/python
+'''
+Runs detection over images and videos recorded earlier, e.g. to compare new weights against old ones on the same
+data. There are no real-time constraints: frames are spread over worker processes (each with its own copy of the
+network) and processed as fast as the machine allows.
+	python offline.py /data/2019-06-01 --nmea /data/2019-06-01/trimble.cap -w new.weights --workers 4
+The input directory is searched recursively for images and videos. Each file's camera is taken from the first
+directory or file name part that looks like a camera ID (id0, id1, ...), or --camera. Frames are timed by, in order of
+preference: the .json sidecar lib/archiver.py saves next to each image; a date and time in the file name (for a video,
+when it started), or the date directory and time file name the archiver uses; or, failing those, the files'
+modification times - an image was taken when it was last modified, and a video ended when it was. Copying files
+usually changes their modification times, so positioning frames timed that way needs --time-offset to say so.
+Given an NMEA capture (see lib/nmea.py --capture) to position the frames by, a normal record is written to
+records.DIR. Every frame's detections are written to a JSON lines file either way. A file that can't be processed
+is logged and skipped, without stopping the rest.
+'''
+
+import concurrent.futures
+import datetime
+import json
+import multiprocessing
+import os
+import re
+import time
+import cv2
+
+import processor
+from lib import records
+from lib import catalogue
+from lib import darknet_wrapper
+from lib import loghelper
+from lib import nmea
+from lib import positioning
+
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.bmp')
+VIDEO_EXTS = ('.avi', '.mp4', '.mkv', '.mov')
+CAMERA_ID = re.compile(r'^(id\d+)(?:\b|_)')
+# a date and time in a file name, e.g. 2019-06-01_10-30-15, 20190601-103015 or 2019-06-01T10:30:15.250
+NAME_TIME = re.compile(r'(?<!\d)(\d{4})-?(\d{2})-?(\d{2})[T_ -]?(\d{2})[-:]?(\d{2})[-:]?(\d{2})(\.\d+)?(?!\d)')
+# or, as lib/archiver.py saves frames, a date directory with the time at the start of the file name
+DIR_DATE = re.compile(r'^(\d{4})-(\d{2})-(\d{2})$')
+NAME_CLOCK = re.compile(r'^(\d{2})(\d{2})(\d{2})(\.\d+)?(?!\d)')
+VIDEO_CHUNK_FRAMES = 64 # frames of a video handed to a worker at a time
+WORKERS = 2
+
+class Source:
+	"""One image or video file. time is the wall-clock time of its first frame, timed_by where that came from
+	('sidecar', 'name' or 'mtime'), and fps its frame rate (None for images)."""
+	def __init__(self, path, camera_id, time, frames = 1, fps = None, timed_by = 'mtime'):
+		self.path = path
+		self.camera_id = camera_id
+		self.time = time
+		self.frames = frames
+		self.fps = fps
+		self.timed_by = timed_by
+	def frame_time(self, index):
+		return self.time + (index / self.fps if self.fps else 0.0)
+
+def _camera_id(path, root, default):
+	for part in os.path.relpath(path, root).split(os.sep):
+		match = CAMERA_ID.match(part)
+		if match is not None:
+			return match.group(1)
+	return default
+
+def _datetime(year, month, day, hour, minute, second, fraction):
+	try:
+		return datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second)).timestamp() + \
+			float(fraction or 0.0)
+	except ValueError:
+		return None
+
+def path_time(path):
+	"""Returns the wall-clock time in the name of a file (see NAME_TIME and NAME_CLOCK), or None if there isn't one"""
+	directory, file = os.path.split(path)
+	for match in NAME_TIME.finditer(file):
+		t = _datetime(*match.groups())
+		if t is not None:
+			return t
+	clock = NAME_CLOCK.match(file)
+	if clock is not None:
+		for part in reversed(directory.split(os.sep)):
+			date = DIR_DATE.match(part)
+			if date is not None:
+				return _datetime(*date.groups(), *clock.groups())
+	return None
+
+def _sidecar_time(path):
+	"""Returns the capture time from an archived image's .json sidecar (see lib/archiver.py), or None"""
+	try:
+		with open(os.path.splitext(path)[0] + '.json') as file:
+			return datetime.datetime.fromisoformat(json.load(file)['time']).timestamp()
+	except (OSError, ValueError, TypeError, KeyError):
+		return None
+
+def find_sources(root, default_camera = None):
+	"""Returns a Source for every image and video under root, in path order"""
+	sources = []
+	for directory, subdirectories, files in os.walk(root):
+		subdirectories.sort()
+		for file in sorted(files):
+			path = os.path.join(directory, file)
+			ext = os.path.splitext(file)[1].lower()
+			if ext not in IMAGE_EXTS + VIDEO_EXTS:
+				continue
+			camera_id = _camera_id(path, root, default_camera)
+			named = path_time(path)
+			if ext in IMAGE_EXTS:
+				captured = _sidecar_time(path)
+				if captured is not None:
+					sources.append(Source(path, camera_id, captured, timed_by = 'sidecar'))
+				elif named is not None:
+					sources.append(Source(path, camera_id, named, timed_by = 'name'))
+				else:
+					sources.append(Source(path, camera_id, os.path.getmtime(path)))
+				continue
+			video = cv2.VideoCapture(path)
+			try:
+				frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+				fps = video.get(cv2.CAP_PROP_FPS) or 30.0
+			finally:
+				video.release()
+			if frames <= 0:
+				continue
+			if named is not None:
+				sources.append(Source(path, camera_id, named, frames, fps, 'name'))
+			else:
+				sources.append(Source(path, camera_id, os.path.getmtime(path) - frames / fps, frames, fps))
+	return sources
+
+# Worker processes each load the network once, then detect plants in whatever frames they are handed
+
+_net = None
+_meta = None
+
+def _load(cfg_path, weights_path, data_path):
+	global _net
+	global _meta
+	_meta = darknet_wrapper.load_meta(data_path.encode('utf-8'))
+	_net = darknet_wrapper.load_net(cfg_path.encode('utf-8'), weights_path.encode('utf-8'), 0)
+
+def _detect(image, threshold):
+	return [(cls.decode('latin-1'), confidence, box) for cls, confidence, box in \
+		darknet_wrapper.detect_cv2(_net, _meta, image, thresh = threshold)]
+
+def detect_frames(path, start, count, threshold):
+	"""Returns [(frame index, detections)] for count frames of an image or video file, starting at frame start"""
+	if count == 1 and start == 0 and os.path.splitext(path)[1].lower() in IMAGE_EXTS:
+		image = cv2.imread(path)
+		return [(0, _detect(image, threshold) if image is not None else None)]
+	results = []
+	video = cv2.VideoCapture(path)
+	try:
+		if start != 0:
+			video.set(cv2.CAP_PROP_POS_FRAMES, start)
+		for index in range(start, start + count):
+			ret, image = video.read()
+			if not ret:
+				break
+			results.append((index, _detect(image, threshold)))
+	finally:
+		video.release()
+	return results
+
+def _tasks(sources):
+	"""Splits the sources into (source number, first frame, number of frames) pieces of work"""
+	for i, source in enumerate(sources):
+		for start in range(0, source.frames, VIDEO_CHUNK_FRAMES):
+			yield i, start, min(VIDEO_CHUNK_FRAMES, source.frames - start)
+
+def detect(sources, cfg_path, weights_path, data_path, threshold, workers = WORKERS, progress = None):
+	"""Runs detection over every frame of the sources in worker processes. Returns (a list of (time, source, frame
+	index, detections), sorted by time; the sources that failed, in path order). detections is None for an image that
+	couldn't be read. A source that fails part way may still have some of its frames in the list."""
+	log = loghelper.get_logger(__file__)
+	frames = []
+	failed = set()
+	context = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+	with concurrent.futures.ProcessPoolExecutor(workers, context, _load, (cfg_path, weights_path, data_path)) as executor:
+		futures = { executor.submit(detect_frames, sources[i].path, start, count, threshold): i for i, start, count in _tasks(sources) }
+		for future in concurrent.futures.as_completed(futures):
+			source = sources[futures[future]]
+			try:
+				results = future.result()
+			except Exception:
+				if source not in failed:
+					log.exception('Could not process %s', source.path)
+				failed.add(source)
+				continue
+			for index, detections in results:
+				frames.append((source.frame_time(index), source, index, detections))
+			if progress is not None:
+				progress(len(frames))
+	frames.sort(key = lambda frame: (frame[0], frame[1].path, frame[2]))
+	return frames, sorted(failed, key = lambda source: source.path)
+
+def read_fixes(path):
+	"""Yields (wall-clock time, parsed GGA or VTG sentence) from an NMEA capture file, in order"""
+	capture = nmea.CaptureReader(path)
+	for received, sentence in capture:
+		line = sentence.decode('latin-1').strip()
+		if line[3:6] not in (nmea.GGA, nmea.VTG):
+			continue
+		try:
+			yield capture.wall_time(received), nmea.parse(line, check = True)
+		except Exception: # garbled sentences are skipped, just as the live listener does
+			continue
+
+def position_frames(frames, fixes):
+	"""Yields (frame, (longitude, latitude) or None) for each of frames (sorted by time), positioned by the fixes
+	from read_fixes() as processor.py would have done live"""
+	history = positioning.FixHistory()
+	pending = None
+	for frame in frames:
+		t = frame[0]
+		# feed in fixes up to a little past the frame, so its position can be interpolated rather than extrapolated
+		while True:
+			if pending is None:
+				pending = next(fixes, None)
+				if pending is None:
+					break
+			if pending[0] > t + 1.0:
+				break
+			if pending[1].sentence_type == nmea.GGA:
+				history.add_gga(*pending)
+			else:
+				history.add_vtg(*pending)
+			pending = None
+		forward_ft, right_ft = processor.CAMERA_OFFSETS.get(frame[1].camera_id, (0.0, 0.0))
+		yield frame, history.position(t, forward_ft, right_ft)
+
+def write_detections(path, frames):
+	with open(path, 'w') as file:
+		for t, source, index, detections in frames:
+			file.write(json.dumps({
+				'source': source.path,
+				'frame': index,
+				'camera': source.camera_id,
+				'time': datetime.datetime.fromtimestamp(t).isoformat(),
+				'detections': [{ 'class': cls, 'confidence': confidence, 'bbox': list(box) } for cls, confidence, box in detections] \
+					if detections is not None else None,
+			}) + '\n')
+
+def write_record(frames, nmea_path):
+	"""Writes the frames that can be positioned to a new record in records.DIR. Returns (path, lines written)."""
+	date = datetime.date.fromtimestamp(frames[0][0])
+	path = records.new_record_path(date)
+	writer = records.RecordWriter(path + '.tmp')
+	count = 0
+	try:
+		for (t, source, index, detections), position in position_frames(frames, read_fixes(nmea_path)):
+			if position is None or detections is None or source.camera_id is None:
+				continue
+			writer.append(records.RecordLine(datetime.datetime.fromtimestamp(t), position[0], position[1], \
+				processor.detections_to_rows(source.camera_id, detections)))
+			count += 1
+	except:
+		writer.close()
+		os.remove(path + '.tmp')
+		raise
+	writer.finalize(path)
+	return path, count
+
+if __name__ == '__main__':
+	import argparse
+	parser = argparse.ArgumentParser(description = 'Run detection over recorded images and videos')
+	parser.add_argument('input', help = 'directory of images and/or videos')
+	parser.add_argument('-n', '--nmea', help = 'NMEA capture file to position frames by. Without it, no record is written.')
+	parser.add_argument('-o', '--detections', help = 'file to write every frame\'s detections to, as JSON lines (default: detections-<time>.jsonl)')
+	parser.add_argument('--camera', help = 'camera ID for files that don\'t have one in their path')
+	parser.add_argument('--time-offset', type = float, help = 'seconds to add to every frame\'s time, e.g. to correct a camera clock. ' \
+		'Required with --nmea if any file is timed by its modification time - use 0 if those are right.')
+	parser.add_argument('-c', '--cfg-file', default = processor.CFG_FILE, help = 'darknet *.cfg file. Defaults to the Yolo_mark_2 file')
+	parser.add_argument('-w', '--weights-file', default = processor.WEIGHTS_FILE, help = 'darknet *.weights file. Defaults to the Yolo_mark_2 file')
+	parser.add_argument('-d', '--data-file', default = processor.DATA_FILE, help = 'darknet *.data file. Defaults to the Yolo_mark_2 file')
+	parser.add_argument('-t', '--threshold', type = float, default = 0.5, help = 'detection threshold. The default is 0.5.')
+	parser.add_argument('-j', '--workers', type = int, default = WORKERS, help = 'number of worker processes, each with its own copy of the network. The default is %d.'%(WORKERS))
+	args = parser.parse_args()
+	log = loghelper.get_logger(__file__)
+	sources = find_sources(args.input, args.camera)
+	total = sum(source.frames for source in sources)
+	if total == 0:
+		raise SystemExit('No images or videos found in %s'%(args.input))
+	by_mtime = sum(1 for source in sources if source.timed_by == 'mtime')
+	if args.nmea is not None and by_mtime != 0 and args.time_offset is None:
+		raise SystemExit('%d files have no time in their name or sidecar, and copying them may have changed their modification ' \
+			'times. Give --time-offset (0 if the modification times are right) to position them anyway.'%(by_mtime))
+	for source in sources:
+		source.time += args.time_offset or 0.0
+	print('%d files, %d frames (%d timed by modification time)'%(len(sources), total, by_mtime))
+	log.info('Offline processing of %d frames from %s with %s', total, args.input, args.weights_file)
+	t0 = time.monotonic()
+	def progress(done):
+		elapsed = time.monotonic() - t0
+		print('\r%d/%d frames, %.1f frames/sec'%(done, total, done / elapsed if elapsed > 0 else 0.0), end = '', flush = True)
+	frames, failed = detect(sources, args.cfg_file, args.weights_file, args.data_file, args.threshold, args.workers, progress)
+	elapsed = time.monotonic() - t0
+	print('\nDetection: %d frames in %.1f s - %.2f frames/sec with %d workers'%(len(frames), elapsed, len(frames) / elapsed, args.workers))
+	if len(failed) != 0:
+		print('%d files could not be processed (see the log):'%(len(failed)))
+		for source in failed:
+			print('\t' + source.path)
+	detections_path = args.detections or 'detections-%s.jsonl'%(datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
+	write_detections(detections_path, frames)
+	print('Wrote detections to %s'%(detections_path))
+	if args.nmea is not None and len(frames) != 0:
+		path, count = write_record(frames, args.nmea)
+		print('Wrote %d of %d frames to record %s (the rest had no position or camera)'%(count, len(frames), path))
+		try:
+			catalogue.add(os.path.basename(path)[:-len(records.EXT)])
+		except Exception:
+			log.exception('Could not add %s to the catalogue', path)
+	log.info('Offline processing done: %d frames in %.1f s, %d files failed', len(frames), elapsed, len(failed))
@@ -2,19 +2,25 @@
 import time
 import os
 import datetime
-import shutil
 import signal
 import setproctitle
 import cv2
 
 from lib import records
 from lib import cameras
+from lib import camera_bus
 from lib import multivator
 from lib import speed_ctrl
 from lib import loghelper
 from lib import nmea
 from lib import darknet_wrapper
 from lib import plants
+from lib import positioning
+from lib import catalogue
+from lib import events
+from lib import profiler
+from lib import scheduler
+from lib import archiver
 
 log = loghelper.get_logger(__file__)
 CURRENT = os.path.join(records.DIR, records.CURRENT + records.EXT)
@@ -28,15 +34,48 @@ TURNING = 4
 # TODO: Adjust this to taste
 THRESHOLD = 0.15
 
+CFG_FILE = '/home/agbot/Yolo_mark_2/x64/Release/yolo-obj.cfg'
+WEIGHTS_FILE = '/home/agbot/Yolo_mark_2/x64/Release/backup/yolo-obj_final.weights'
+DATA_FILE = '/home/agbot/Yolo_mark_2/x64/Release/data/obj.data'
+
 net = 0
 meta = None
 cams = []
 cams_history = []
 sigint_received = False
-file = None
+writer = None
 mult = None
 speed_controller = None
 row_state = START_OF_ROW
+fixes = positioning.FixHistory()
+publisher = events.Publisher()
+# for the 'health' events read by the server's /api/health
+HEALTH_INTERVAL = 1.0 # seconds
+health_time = time.monotonic()
+loop_count = 0
+camera_frames = {} # camera id -> time.monotonic() of its last good frame
+camera_scheduler = None
+frame_archiver = None # saves sampled frames for retraining, if asked to
+# Whether to hold back the results for frames that missed their deadline (see scheduler.CameraScheduler.deadline()).
+# Off until TILLER_FORWARD_FT, CAMERA_OFFSETS and the scheduler's timings have been measured: until then, a late
+# result is still better than none, so misses are only counted.
+drop_late = False
+
+# Offset (forward_ft, right_ft) from the GPS antenna to the point on the toolbar's centerline that is level with each
+# camera's field of view. The camera's lateral placement is already accounted for by map_location() and records.ROW_DIST.
+# TODO: measure these on the BOT
+CAMERA_OFFSETS = {
+	'id0': (0.0, 0.0),
+	'id1': (0.0, 0.0),
+	'id2': (0.0, 0.0),
+	'id3': (0.0, 0.0),
+	'id4': (0.0, 0.0),
+	'id5': (0.0, 0.0),
+}
+# How far forward of the GPS antenna the tillers are (negative: behind it), so the ground a camera sees reaches them
+# CAMERA_OFFSETS[id][0] - TILLER_FORWARD_FT feet later
+# TODO: measure this on the BOT
+TILLER_FORWARD_FT = -6.0
 
 # TODO: update this as needed to more accurately match our camera layout.
 def map_location(camera_id, x, y):
@@ -81,27 +120,57 @@ plants_map = {
     'corn': plants.Plants.NONE # ignore non-nitrogen deficient corn
 }
 
-def start_processor(cfg_path, weights_path, data_path, ignore_multivator = False, ignore_speed_controller = False):
+def detections_to_rows(camera_id, detections):
+	"""Returns the Plants found in each row (see records.ROW_DIST), given the (class, confidence, (x, y, w, h))
+	detections in one frame from the given camera"""
+	rows = [plants.Plants.NONE] * len(records.ROW_DIST)
+	for cls, confidence, (x, y, w, h) in detections:
+		if cls in plants_map.keys():
+			rows[map_location(camera_id, x, y)] |= plants_map[cls]
+	return rows
+
+def _catalogue(path):
+	"""Adds a finished record to the catalogue. Failing to do so isn't fatal - the server adds missing records to the
+	catalogue when they're first asked for."""
+	try:
+		catalogue.add(os.path.basename(path)[:-len(records.EXT)])
+	except Exception:
+		log.exception('Could not add %s to the catalogue', path)
+
+def start_processor(cfg_path, weights_path, data_path, ignore_multivator = False, ignore_speed_controller = False, use_camera_bus = False, \
+		frame_archive = None):
 	global net
 	global meta
 	global cams
 	global cams_history
-	global file
+	global writer
 	global mult
 	global speed_controller
+	global camera_scheduler
+	global frame_archiver
 	log.info('Starting processor...')
-	if os.path.exists(os.path.join(records.DIR, CURRENT)):
-		log.error('CURRENT file %s already exists. Throwing exception...', CURRENT)
-		raise ValueError('Processor is already running. If you did not start processor, delete the file %s and try again'%(CURRENT))
-	else:
-		file = open(CURRENT, 'w+')
-		log.debug('Created %s', CURRENT)
+	if os.path.exists(CURRENT):
+		try:
+			path = records.recover(CURRENT)
+			log.warning('Recovered %s left over from a previous run to %s', CURRENT, path)
+			_catalogue(path)
+		except BlockingIOError:
+			log.error('CURRENT file %s is in use. Throwing exception...', CURRENT)
+			raise ValueError('Processor is already running. If you did not start processor, stop the process writing to %s and try again'%(CURRENT))
+	writer = records.RecordWriter(CURRENT)
+	log.debug('Created %s', CURRENT)
 	meta = darknet_wrapper.load_meta(data_path.encode('utf-8'))
 	net = darknet_wrapper.load_net(cfg_path.encode('utf-8'), weights_path.encode('utf-8'), 0)
 	log.debug('Loaded neural network and metadata. net = %d, meta.classes = %d', net, meta.classes)
-	cams = cameras.open_cameras('id*')
+	if use_camera_bus:
+		cams = camera_bus.open_cameras('id*')
+	else:
+		cams = cameras.open_cameras('id*')
 	cams_history = [True for cam in cams]
 	log.debug('Opened cameras - %d found', len(cams))
+	camera_scheduler = scheduler.CameraScheduler([camera.id for camera in cams], \
+		{ camera.id: map_location(camera.id, 0.5, 0.5) for camera in cams }, \
+		{ camera.id: CAMERA_OFFSETS.get(camera.id, (0.0, 0.0))[0] - TILLER_FORWARD_FT for camera in cams })
 	if not ignore_multivator:
 		mult = multivator.Multivator(initial_mode = multivator.Mode.processing)
 		mult.connect()
@@ -111,21 +180,62 @@ def start_processor(cfg_path, weights_path, data_path, ignore_multivator = False
 		speed_controller.connect()
 		speed_controller.start()
 		log.debug('Connected to speed controller')
+	frame_archiver = frame_archive
+	publisher.publish('state', processing = True)
+
+def _update_fixes():
+	global fixes
+	t, gga = nmea.read_timestamped(nmea.GGA)
+	if t is not None:
+		fixes.add_gga(t, gga)
+	try:
+		t, vtg = nmea.read_timestamped(nmea.VTG)
+		if t is not None:
+			fixes.add_vtg(t, vtg)
+	except ValueError:
+		pass # VTG data is only used to refine the estimate - we can do without it
+
+def _record_frame(camera_id, capture_time, results):
+	"""Writes a RecordLine for one camera frame, positioned where the BOT was at the moment the frame was captured.
+	Returns that (longitude, latitude), or None if it isn't known. The fixes are read once per pass over the cameras
+	(see process_detector()); each frame's position is interpolated (or briefly extrapolated) from them."""
+	global writer
+	global fixes
+	forward_ft, right_ft = CAMERA_OFFSETS.get(camera_id, (0.0, 0.0))
+	position = fixes.position(capture_time, forward_ft, right_ft)
+	if position is None:
+		log.debug('No GPS fix available for frame from camera %s - not recording it', camera_id)
+		return None
+	timestamp = datetime.datetime.now() - datetime.timedelta(seconds = time.monotonic() - capture_time)
+	writer.append(records.RecordLine(timestamp, position[0], position[1], results))
+	# line is its line number in the record, so the web page can tell whether it has already drawn it
+	publisher.publish('detection', time = timestamp.timestamp(), line = writer.count - 1, camera = camera_id, \
+		longitude = float(position[0]), latitude = float(position[1]), rows = [int(row) for row in results])
+	return position
 
 def process_detector(threshold, ignore_nmea = False, diagcam_id = None):
 	global net
 	global meta
 	global cams
 	global cams_history
-	global file
+	global writer
 	global mult
 	global speed_controller
-	i = -1
-	results = [plants.Plants.NONE] * 5
-	for camera in cams:
+	global camera_scheduler
+	global frame_archiver
+	speed = None
+	if not ignore_nmea:
+		# read the NMEA files once for the whole pass, not once per camera
+		_update_fixes()
+		speed = fixes.speed(time.monotonic())
+	indexes = { camera.id: i for i, camera in enumerate(cams) }
+	# the scheduler picks the order (most urgent first), and leaves out cameras we don't have time for
+	for camera_id in camera_scheduler.plan(time.monotonic(), speed):
+		i = indexes[camera_id]
+		camera = cams[i]
 		draw_bbox = camera.id == diagcam_id
-		i += 1 # increment i here just so we don't forget if we add a continue or something to the loop
 		ret, image = camera.read()
+		capture_time = camera.timestamp
 		if not ret: #ERROR - skip this camera
 			if cams_history[i]:
 				log.error('Could not read image from camera %s', camera.id)
@@ -133,28 +243,34 @@ def process_detector(threshold, ignore_nmea = False, diagcam_id = None):
 			continue # skip this camera
 		else:
 			cams_history[i] = True
-		#t0 = time.time()
-		results_temp = [plants.Plants.NONE] * len(results)
-		for (cls, confidence, (x, y, w, h)) in darknet_wrapper.detect_cv2(net, meta, image, thresh = threshold):
-			cls = cls.decode('latin-1')
-			#print('Found %s in %s'%(cls, camera.id))
-			if draw_bbox:
+			camera_frames[camera.id] = capture_time
+		started = time.monotonic()
+		original = image # archived at full resolution
+		# falling behind - shrink the frame before handing it to darknet. The boxes come back in pixels of the shrunk
+		# frame, but only their camera is used to place them (see map_location()), and the archiver scales them back up.
+		scale = camera_scheduler.scale
+		if scale != 1.0:
+			image = cv2.resize(image, None, fx = scale, fy = scale, interpolation = cv2.INTER_AREA)
+		detections = [(cls.decode('latin-1'), confidence, box) for cls, confidence, box in \
+			darknet_wrapper.detect_cv2(net, meta, image, thresh = threshold)]
+		if draw_bbox:
+			image = image.copy() # the original may still be waiting to be archived
+			for cls, confidence, (x, y, w, h) in detections:
 				_draw_bbox(image, cls, x, y, w, h)
-			if cls in plants_map.keys():
-				results_temp[map_location(camera.id, x, y)] |= plants_map[cls]
-		#print('ran detection in %fsec'%(time.time() - t0))
-		if mult is not None: # send the results for each camera individually, to make things more responsive
+		results_temp = detections_to_rows(camera.id, detections)
+		on_time = camera_scheduler.done(camera.id, capture_time, started, time.monotonic(), speed)
+		if not on_time and drop_late:
+			log.warning('Camera %s missed its deadline - not sending its results', camera.id)
+		elif mult is not None: # send the results for each camera individually, to make things more responsive
 			mult.send_process_message(results_temp);
-		# store results_temp to results
-		for i in range(len(results)):
-			results[i] |= results_temp[i]
+		position = None
+		if not ignore_nmea:
+			position = _record_frame(camera.id, capture_time, results_temp)
+		if frame_archiver is not None:
+			frame_archiver.offer(camera.id, original, capture_time, detections, position, scale)
 		if draw_bbox:
 			cv2.imshow(diagcam_id, image)
 			cv2.waitKey(1)
-	if not ignore_nmea:
-		gga = nmea.read_data(nmea.GGA)
-		record = records.RecordLine(datetime.datetime.now(), gga.longitude, gga.latitude, results)
-		print(str(record), file=file)
 
 def process_rowctrl():
 	global row_state
@@ -165,6 +281,9 @@ def process_rowctrl():
 		return
 	elif row_state == START_OF_ROW:
 		log.info('Entering row')
+		publisher.publish('row', state = 'enter')
+		if camera_scheduler is not None:
+			camera_scheduler.reset()
 		if mult is not None:
 			mult.process_lower_hitch()
 		if speed_controller is not None:
@@ -172,40 +291,51 @@ def process_rowctrl():
 		row_state = IN_ROW
 	elif row_state == END_OF_ROW:
 		log.info('End of row reached')
+		publisher.publish('row', state = 'exit')
 		if mult is not None:
 			mult.process_raise_hitch()
 		if speed_controller is not None:
 			speed_controller.exit_row()
 		row_state = TURNING
 
+def process_health():
+	"""Counts main loop iterations, and every HEALTH_INTERVAL publishes the loop rate, how long ago each camera last
+	delivered a frame, how well the camera scheduler is keeping up and how many frames have been archived"""
+	global health_time
+	global loop_count
+	loop_count += 1
+	now = time.monotonic()
+	if now - health_time < HEALTH_INTERVAL:
+		return
+	publisher.publish('health', loopRate = loop_count / (now - health_time), inRow = row_state == IN_ROW, \
+		cameras = { str(camera.id): now - camera_frames[camera.id] if camera.id in camera_frames else None for camera in cams }, \
+		scheduler = camera_scheduler.stats() if camera_scheduler is not None else None, \
+		archive = frame_archiver.stats() if frame_archiver is not None else None)
+	health_time = now
+	loop_count = 0
+
 def process(threshold, ignore_nmea = False, diagcam_id = None):
 	global row_state
 	process_rowctrl()
 	if row_state == IN_ROW:
 		process_detector(threshold, ignore_nmea, diagcam_id)
+	process_health()
 
 def stop_processor():
 	log.info('Shutting down processor...')
-	global file
+	global writer
 	global net
 	global meta
 	global cams
 	global mult
 	global speed_controller
-	if file is not None:
-		file.flush()
-		file.close()
-		file = None
-		
-		date = str(datetime.date.today())
-		files = [file for file in os.listdir(records.DIR) if file.startswith(date) and file.endswith(records.EXT)]
-		# trim the date and extension from the file names and parse the numbers
-		numbers = [int(file[len(date) + 1:-len(records.EXT)]) for file in files]
-		num = 0 if len(numbers) == 0 else max(numbers) + 1
-		path = records.DIR + '/' + date + '_' + str(num) + records.EXT
+	global frame_archiver
+	if writer is not None:
+		path = records.new_record_path()
 		log.debug('Moving %s to %s', CURRENT, path)
-		shutil.copy(CURRENT, path)
-		os.remove(CURRENT)
+		writer.finalize(path)
+		writer = None
+		_catalogue(path)
 	if net != 0:
 		log.debug('Resetting neural network %d', net)
 		darknet_wrapper.reset_rnn(net)
@@ -228,8 +358,13 @@ def stop_processor():
 		speed_controller.stop();
 		speed_controller.disconnect()
 		speed_controller = None
+	if frame_archiver is not None:
+		log.debug('Waiting for the archiver to save the frames it has queued')
+		frame_archiver.close()
+		frame_archiver = None
 	# close the NMEA data files
 	nmea.close()
+	publisher.publish('state', processing = False)
 	log.info('Processor successfully shut down - the program will now exit')
 
 # SIGUSR1 signifies start of row
@@ -251,8 +386,9 @@ def sigint_handler(sig, frame):
 	sigint_received = True
 	signal.signal(signal.SIGINT, sigint_handler)
 
-def main(cfg_path, weights_path, data_path, threshold, ignore_multivator = False, ignore_speed_controller = False, ignore_nmea = False, diagcam_id = None):
-	start_processor(cfg_path, weights_path, data_path, ignore_multivator, ignore_speed_controller)
+def main(cfg_path, weights_path, data_path, threshold, ignore_multivator = False, ignore_speed_controller = False, ignore_nmea = False, diagcam_id = None, use_camera_bus = False, \
+		frame_archive = None):
+	start_processor(cfg_path, weights_path, data_path, ignore_multivator, ignore_speed_controller, use_camera_bus, frame_archive)
 	try:
 		while not sigint_received:
 			process(threshold, ignore_nmea, diagcam_id)
@@ -270,15 +406,24 @@ if __name__ == '__main__':
 	setproctitle.setproctitle('processor.py')
 	
 	parser = argparse.ArgumentParser()
-	parser.add_argument('-c', '--cfg-file', default = '/home/agbot/Yolo_mark_2/x64/Release/yolo-obj.cfg', help='specify a *.cfg file for darknet. Defaults to the Yolo_mark_2 file')
-	parser.add_argument('-w', '--weights-file', default = '/home/agbot/Yolo_mark_2/x64/Release/backup/yolo-obj_final.weights', help='specify a *.weights file for darknet. Defaults to the Yolo_mark_2/.../yolo-obj-final.weights file')
-	parser.add_argument('-d', '--data-file', default = '/home/agbot/Yolo_mark_2/x64/Release/data/obj.data', help='specify a *.data file for darknet. Defaults to the Yolo_mark_2 file')
+	parser.add_argument('-c', '--cfg-file', default = CFG_FILE, help='specify a *.cfg file for darknet. Defaults to the Yolo_mark_2 file')
+	parser.add_argument('-w', '--weights-file', default = WEIGHTS_FILE, help='specify a *.weights file for darknet. Defaults to the Yolo_mark_2/.../yolo-obj-final.weights file')
+	parser.add_argument('-d', '--data-file', default = DATA_FILE, help='specify a *.data file for darknet. Defaults to the Yolo_mark_2 file')
 	parser.add_argument('-t', '--threshold', type=float, default = 0.5, help='specify the detection threshold. The default is 0.5.')
 	parser.add_argument('-v', '--diagcam-id', default = None)
 	parser.add_argument('-n', '--ignore-nmea', action = 'store_true', help='suppress listening for NMEA position data (also prevents writing results to CURRENT.rec).')
 	parser.add_argument('-m', '--ignore-multivator', action = 'store_true', help='suppress sending detection results to the multivator.')
 	parser.add_argument('-s', '--ignore-speed-controller', action = 'store_true', help='suppress sending start/stop/row commands to the speed controller.')
+	parser.add_argument('--drop-late', action = 'store_true', help='don\'t send the multivator results that missed their deadline. Only use once the camera offsets and timings are measured.')
+	parser.add_argument('-b', '--camera-bus', action = 'store_true', help='read the cameras from the camera bus (see lib/camera_bus.py) instead of opening them, so other programs can use them too.')
+	parser.add_argument('-a', '--archive', nargs = '?', const = archiver.DIR, default = None, help='save sampled frames and their detections for retraining, to the given directory (default: %s). Frames are kept as chosen by the --archive-* options; with none of them, every frame is.'%(archiver.DIR))
+	parser.add_argument('--archive-every', type = int, default = None, help='keep every Nth frame from each camera')
+	parser.add_argument('--archive-detections', action = 'store_true', help='keep frames in which anything was detected')
+	parser.add_argument('--archive-low-confidence', type = float, default = None, help='keep frames with a detection less confident than this')
+	parser.add_argument('--archive-interval', type = float, default = 0.0, help='keep at most one frame per camera this often (seconds)')
+	parser.add_argument('--archive-quota', type = float, default = archiver.QUOTA_BYTES / (1 << 30), help='stop archiving once the archive takes up this many GB. The default is %g.'%(archiver.QUOTA_BYTES / (1 << 30)))
 	args = parser.parse_args()
+	drop_late = args.drop_late
 	if args.threshold < 0 or args.threshold > 1.0:
 		log.error('Invalid detection threshold: %f. %s will now shut down', args.threshold, __file__)
 		raise ValueError('Invalid threshold: %f', args.threshold)
@@ -286,5 +431,12 @@ if __name__ == '__main__':
 	signal.signal(signal.SIGINT, sigint_handler)
 	signal.signal(signal.SIGUSR1, sigusr1_handler)
 	signal.signal(signal.SIGUSR2, sigusr2_handler)
-	main(args.cfg_file, args.weights_file, args.data_file, args.threshold, args.ignore_multivator, args.ignore_speed_controller, args.ignore_nmea, args.diagcam_id)
+	profiler.install('processor')
+	frame_archive = None
+	if args.archive is not None:
+		if args.archive_every is None and not args.archive_detections and args.archive_low_confidence is None:
+			args.archive_every = 1
+		frame_archive = archiver.Archiver(args.archive, archiver.SamplingPolicy(args.archive_every, args.archive_detections, \
+			args.archive_low_confidence, args.archive_interval), quota_bytes = int(args.archive_quota * (1 << 30)))
+	main(args.cfg_file, args.weights_file, args.data_file, args.threshold, args.ignore_multivator, args.ignore_speed_controller, args.ignore_nmea, args.diagcam_id, args.camera_bus, frame_archive)
 
@@ -2,21 +2,165 @@
 
 import cherrypy
 import os
-import cv2
 import subprocess
 import signal
 import datetime
+import time
+import json
+import threading
+import concurrent.futures
+import queue
+import cv2
 
 import estop
 from lib import records
+from lib import plants
+from lib import render_cache
+from lib import live_map
+from lib import catalogue
+from lib import query
+from lib import export
+from lib import heatmap
+from lib import workers
+from lib import events
+from lib import health
+from lib import profiler
+from lib import camera_bus
+from lib import cameras
+from lib import procs
+
+# rendered record images, kept in memory and (for finished records) on disk next to the records
+IMAGE_CACHE_BYTES = 32 * 1024 * 1024
+IMAGE_CACHE_DIR = os.path.join(records.DIR, '.cache')
+
+# the CURRENT record keeps growing while the processor runs, so instead of re-reading it from the start on every
+# request, we keep a reader around that only parses what has been appended since it last looked
+_current_tail = records.RecordTail(records.CURRENT)
+
+def _read_record(recordID):
+	if recordID == records.CURRENT:
+		return _current_tail.update()
+	return records.Record.read(recordID)
+
+_image_cache = render_cache.RenderCache(IMAGE_CACHE_BYTES, IMAGE_CACHE_DIR)
+
+# CURRENT is drawn incrementally onto a live map, which a background monitor keeps up to date so that the next
+# poll from the processing page finds a JPEG already encoded
+_live_map = live_map.LiveMap()
+LIVE_MAP_INTERVAL = 1.0 # seconds
+
+def _refresh_live_map():
+	try:
+		_live_map.update(_current_tail.update())
+	except FileNotFoundError:
+		pass # not processing right now
+
+# the catalogue is brought up to date with the record files (see catalogue.reconcile()) in a worker process: when
+# the server starts, whenever the processor finishes a record, and every CATALOGUE_INTERVAL in case records were
+# copied in or deleted by hand. Listing records is then only ever a read of the catalogue.
+CATALOGUE_INTERVAL = 60.0 # seconds
 
-def _processor_pid():
+def _keep_catalogue():
+	subscription, latest = _events.subscribe()
 	try:
-		# runs 'pidof processor.py' in a shell and returns the output (a list
-		# of PIDs), or raises a CalledProcessError upon a nonzero exit code.
-		return int(subprocess.check_output(['pidof', 'processor.py']).split()[0])
-	except subprocess.CalledProcessError:
-		return None
+		while True:
+			try:
+				_workers.run('catalogue', workers.reconcile_catalogue)
+			except Exception:
+				cherrypy.log('Could not bring the catalogue up to date', traceback = True)
+			while True:
+				try:
+					event = subscription.get(timeout = CATALOGUE_INTERVAL)
+				except queue.Empty:
+					break
+				if event is None:
+					return # server shutting down
+				if event.get('type') == 'state' and not event.get('processing'):
+					break # a record was just finished
+	finally:
+		_events.unsubscribe(subscription)
+
+def _start_catalogue():
+	threading.Thread(target = _keep_catalogue, name = 'Catalogue', daemon = True).start()
+
+def _record_version(recordID):
+	"""Returns a string that identifies the current contents of a record - it changes whenever the file does"""
+	stat = os.stat(records.get_path(recordID))
+	return '%s-%x-%x'%(os.path.basename(recordID), stat.st_size, stat.st_mtime_ns)
+
+# map tiles are small and cheap to redraw from the tile index, so they're only cached in memory
+TILE_CACHE_BYTES = 16 * 1024 * 1024
+_tile_cache = render_cache.RenderCache(TILE_CACHE_BYTES)
+QUERY_LIMIT = 1000 # lines per page of query results, unless asked for fewer
+
+# Parsing, rendering and encoding records happens in worker processes, so it doesn't hold the GIL while the server
+# has machine control requests (like estops) to answer. On top of that, no more than HEAVY_THREADS of the server's
+# threads (server.thread_pool in server.conf) are ever busy with record work; the rest are kept free for everything
+# else. A request that finds the heavy lane full is turned away with a 503 straight away - waiting for a place would
+# tie up one of the other threads.
+HEAVY_THREADS = 8
+HEAVY_RETRY_AFTER = 2 # seconds, suggested to clients that are turned away
+_heavy_lane = threading.BoundedSemaphore(HEAVY_THREADS)
+_workers = workers.WorkerPool()
+
+class _Unavailable(cherrypy.HTTPError):
+	"""A 503 that tells the client when to try again (HTTPError itself drops any Retry-After header)"""
+	def __init__(self, message, retry_after):
+		super().__init__(503, 'Service Unavailable - %s'%(message))
+		self.retry_after = retry_after
+	def set_response(self):
+		super().set_response()
+		cherrypy.serving.response.headers['Retry-After'] = str(self.retry_after)
+
+def _enter_heavy_lane():
+	if not _heavy_lane.acquire(blocking = False):
+		raise _Unavailable('too many record requests at once. Try again later.', HEAVY_RETRY_AFTER)
+
+class _heavy:
+	"""Context manager that runs a block of record work in the heavy lane, turning worker timeouts into a 503"""
+	def __enter__(self):
+		_enter_heavy_lane()
+	def __exit__(self, type, value, traceback):
+		_heavy_lane.release()
+		if type is not None and issubclass(type, concurrent.futures.TimeoutError):
+			raise cherrypy.HTTPError(503, 'Service Unavailable - timed out waiting for the record to be processed')
+		return False
+
+def _heavy_stream(stream):
+	"""Returns a streamed response that holds the heavy lane (already entered) until it has been sent or abandoned.
+	The lane is given back, and the stream closed (which stops its worker process), by an on_end_request hook: unlike
+	the stream's own finally, that also runs when the body is never read at all, as for a HEAD request."""
+	def end():
+		try:
+			stream.close()
+		finally:
+			_heavy_lane.release()
+	cherrypy.request.hooks.attach('on_end_request', end)
+	return stream
+
+# events from the processor are relayed to browsers over /api/events. Each open event stream ties up one of the
+# server's threads for as long as it is open, so only a few are allowed at once - and each is ended after
+# EVENT_MAX_SECONDS (the browser reconnects and catches up by itself), so an abandoned stream gives its thread back.
+EVENT_CLIENTS = 4
+EVENT_KEEPALIVE = 15.0 # seconds
+EVENT_MAX_SECONDS = 600
+_events = events.EventHub()
+_event_clients = threading.BoundedSemaphore(EVENT_CLIENTS)
+
+# however busy the heavy lane and the event streams are, at least this many threads are left for machine control
+CONTROL_THREADS = 4
+
+def reserve_control_threads():
+	"""Grows server.thread_pool, if need be, so it has CONTROL_THREADS more threads than the heavy lane and the event
+	streams can take up between them. Call after the configuration has been loaded."""
+	needed = HEAVY_THREADS + EVENT_CLIENTS + CONTROL_THREADS
+	if cherrypy.config.get('server.thread_pool', 10) < needed:
+		cherrypy.config.update({ 'server.thread_pool': needed })
+
+# /api/health is answered from a document that a background monitor refreshes every HEALTH_INTERVAL, so polling it
+# costs next to nothing and never waits on pidof, the NMEA files or the devices
+HEALTH_INTERVAL = 1.0 # seconds
+_health = health.HealthCollector(_events)
 
 class UI:
 	pass
@@ -29,7 +173,7 @@ class MachineState:
 	@cherrypy.expose
 	@cherrypy.tools.json_out()
 	def GET(self):
-		return { 'processing': _processor_pid() is not None }
+		return { 'processing': procs.processor_pid() is not None }
 	
 	@cherrypy.expose
 	@cherrypy.tools.accept(media = 'application/json')
@@ -40,16 +184,17 @@ class MachineState:
 			# try and estop. If it fails, return error code
 			try:
 				estop.estop(kill_processor = True, new_process = False)
+				_events.publish({ 'type': 'estop', 'time': time.time() })
 				cherrypy.response.status = '200 OK'
 			except estop.EstopError as ex:
 				cherrypy.response.status = '500 Internal Server Error'
 				return repr(ex)
 		elif 'processing' in json_properties and cherrypy.request.json['processing'] == True:
-			if _processor_pid() is None:
+			if procs.processor_pid() is None:
 				subprocess.Popen(['/home/agbot/agbot-srvr/processor.py', '-s'])
 			cherrypy.response.status = '200 OK'
 		elif 'processing' in json_properties and cherrypy.request.json['processing'] == False:
-			pid = _processor_pid()
+			pid = procs.processor_pid()
 			if pid is not None:
 				# send a SIGINT to processor.py. This more or less politely asks
 				# processor.py to shut down at its earliest convenience.
@@ -57,64 +202,405 @@ class MachineState:
 			cherrypy.response.status = '200 OK'
 
 
+# parameters that turn GET /api/records/<id> from a summary into a query
+_QUERY_PARAMS = ('start', 'end', 'bbox', 'plants', 'offset', 'limit')
+
+# maps the sort parameter of /api/records to catalogue columns
+_SORT_PARAMS = {
+	'recordID': 'record_id',
+	'name': 'name',
+	'startTime': 'start_time',
+	'endTime': 'end_time',
+	'lineCount': 'line_count',
+}
+
+def _summary_json(entry):
+	"""Converts a catalogue entry to the JSON returned by /api/records"""
+	now = datetime.datetime.now().isoformat()
+	return {
+		'recordID': entry['record_id'],
+		'name': entry['name'],
+		'startTime': entry['start_time'] if entry['start_time'] is not None else now,
+		'endTime': entry['end_time'] if entry['end_time'] is not None else now,
+		'longitude': entry['longitude'] if entry['longitude'] is not None else 0,
+		'latitude': entry['latitude'] if entry['latitude'] is not None else 0,
+		'lineCount': entry['line_count'],
+		'plants': catalogue.plant_counts(entry),
+		'bounds': None if entry['min_longitude'] is None else {
+			'minLongitude': entry['min_longitude'],
+			'minLatitude': entry['min_latitude'],
+			'maxLongitude': entry['max_longitude'],
+			'maxLatitude': entry['max_latitude'],
+		},
+	}
+
 @cherrypy.popargs('recordID')
 class Records:
 	exposed = True
 	def __init__(self):
 		self.image = RecordImage()
+		self.tiles = RecordTiles()
+		self.export = RecordExport()
 	@cherrypy.expose
 	@cherrypy.tools.response_headers(headers = [('Content-Type','application/json')])
 	@cherrypy.tools.json_out()
 	def GET(self, recordID = None, **params):
 		if recordID is None:
-			return [{'recordID':recordID, 'name':name} for (recordID, name) in records.get_records()]
+			try:
+				sort = _SORT_PARAMS[params.get('sort', 'startTime')]
+				offset = int(params.get('offset', 0))
+				limit = int(params['limit']) if 'limit' in params else None
+			except (KeyError, ValueError):
+				raise cherrypy.HTTPError(400, 'Bad Request - invalid sort or page parameters')
+			entries = catalogue.list_records(sort, params.get('order', 'asc') == 'desc', offset, limit)
+			return [_summary_json(entry) for entry in entries]
+		elif recordID == records.CURRENT and 'since' in params:
+			return self._since(params)
+		elif any(param in params for param in _QUERY_PARAMS):
+			return self._query(recordID, params)
 		else:
 			try:
-				record = records.Record.read(recordID)
-				if len(record) != 0:
-					summary = record.get_summary()
-					return {
-						'recordID': summary.record_id,
-						'name': summary.record_name,
-						'startTime': summary.start_time.isoformat(),
-						'endTime': summary.end_time.isoformat(),
-						'longitude': summary.longitude,
-						'latitude': summary.latitude
-					}
-				else:
-					return {
-						'recordID': record.record_id,
-						'name': record.name,
-						'startTime': datetime.datetime.now(),
-						'endTime': datetime.datetime.now(),
-						'longitude': 0,
-						'latitude': 0
-					}
+				if recordID == records.CURRENT:
+					record = _read_record(recordID)
+					if len(record) == 0:
+						return {
+							'recordID': record.record_id,
+							'name': record.name,
+							'startTime': datetime.datetime.now(),
+							'endTime': datetime.datetime.now(),
+							'longitude': 0,
+							'latitude': 0
+						}
+					return _summary_json(catalogue.summarize(record))
+				with _heavy():
+					return _summary_json(_workers.run('summary-' + _record_version(recordID), workers.record_summary, recordID))
 			except FileNotFoundError:
 				raise cherrypy.HTTPError(404, 'Not Found - record %s does not exist'%(recordID))
+	def _query(self, recordID, params):
+		"""Returns a page of the lines of a record that match the query parameters"""
+		try:
+			start = query.parse_when(params['start']) if 'start' in params else None
+			end = query.parse_when(params['end']) if 'end' in params else None
+			bbox = query.parse_bbox(params['bbox']) if 'bbox' in params else None
+			plant_types = query.parse_plants(params['plants']) if 'plants' in params else plants.Plants.NONE
+			offset = max(int(params.get('offset', 0)), 0)
+			limit = min(max(int(params.get('limit', QUERY_LIMIT)), 0), QUERY_LIMIT)
+		except (KeyError, ValueError) as ex:
+			raise cherrypy.HTTPError(400, 'Bad Request - invalid query parameters (%s)'%(ex))
+		try:
+			with _heavy():
+				version = _record_version(recordID)
+				total, lines = _workers.run('query-%s-%r'%(version, (start, end, bbox, int(plant_types), offset, limit)), \
+					workers.query_record, recordID, version, start, end, bbox, plant_types, offset, limit)
+		except FileNotFoundError:
+			raise cherrypy.HTTPError(404, 'Not Found - record %s does not exist'%(recordID))
+		return {
+			'recordID': recordID,
+			'total': total,
+			'offset': offset,
+			'limit': limit,
+			'lines': lines,
+		}
+
+	def _since(self, params):
+		"""Returns the lines of the current record from line number since on, as [longitude, latitude, [row bitmasks]],
+		all from one snapshot. This is how the processing page catches up: 'next' is the line number to ask for next
+		time, and the 'line' of each 'detection' event says whether the snapshot already had it. If 'generation'
+		changes, processing was restarted and the lines start again from 0."""
+		try:
+			since = max(int(params['since']), 0)
+		except ValueError:
+			raise cherrypy.HTTPError(400, 'Bad Request - invalid since parameter')
+		try:
+			record = _read_record(records.CURRENT)
+		except FileNotFoundError:
+			raise cherrypy.HTTPError(404, 'Not Found - record %s does not exist'%(records.CURRENT))
+		lines = []
+		if since < len(record):
+			array = record.array()[since:]
+			lines = [list(line) for line in zip(array['longitude'].tolist(), array['latitude'].tolist(), array['rows'].tolist())]
+		return {
+			'recordID': records.CURRENT,
+			'generation': record.generation,
+			'next': max(since, len(record)),
+			'lines': lines,
+		}
+
 class RecordImage:
 	exposed = True
 	@cherrypy.expose
-	@cherrypy.tools.response_headers(headers = [('Content-Type','image/jpeg')])
+	@cherrypy.tools.response_headers(headers = [('Content-Type','image/jpeg'), ('Cache-Control', 'no-cache')])
 	def GET(self, recordID, **params):
 		try:
-			image = records.Record.read(recordID).render()
-			retval, stream = cv2.imencode('.jpeg', image)
-			if not retval:
-				raise cherrypy.HTTPError(500, 'Internal Server Error - could not encode record %s as a JPEG image'%(recordID))
+			if recordID == records.CURRENT:
+				return self._live_image()
+			version = _record_version(recordID)
+			# if the browser already has this version, validate_etags() answers 304 Not Modified for us
+			cherrypy.response.headers['ETag'] = '"%s"'%(version)
+			cherrypy.lib.cptools.validate_etags()
+			stream = _image_cache.get(version)
+			if stream is None:
+				with _heavy():
+					stream = _workers.run(version, workers.render_record, recordID)
+				_image_cache.put(version, stream, group = os.path.basename(recordID))
 			return stream
 		except FileNotFoundError:
 			raise cherrypy.HTTPError(404, 'Not Found - record %s does not exist'%(recordID))
+	def _live_image(self):
+		_live_map.update(_current_tail.update()) # normally a no-op - the monitor has already drawn everything
+		cherrypy.response.headers['ETag'] = '"%s"'%(_live_map.version)
+		cherrypy.lib.cptools.validate_etags()
+		return _live_map.jpeg
+
+@cherrypy.popargs('z', 'x', 'y')
+class RecordTiles:
+	"""/api/records/<id>/tiles returns the layout of a record's map tiles as JSON, and
+	/api/records/<id>/tiles/<z>/<x>/<y> returns one tile as a JPEG image"""
+	exposed = True
+	@cherrypy.expose
+	@cherrypy.tools.response_headers(headers = [('Cache-Control', 'no-cache')])
+	def GET(self, recordID, z = None, x = None, y = None, **params):
+		try:
+			version = _record_version(recordID)
+			cherrypy.response.headers['ETag'] = '"%s"'%(version)
+			cherrypy.lib.cptools.validate_etags()
+			if z is None:
+				try:
+					with _heavy():
+						info = _workers.run('tiles-' + version, workers.tile_info, recordID, version)
+				except ValueError:
+					raise cherrypy.HTTPError(404, 'Not Found - record %s is empty'%(recordID))
+				cherrypy.response.headers['Content-Type'] = 'application/json'
+				return json.dumps(info).encode('utf-8')
+			try:
+				z, x, y = int(z), int(x), int(y)
+			except (TypeError, ValueError):
+				raise cherrypy.HTTPError(400, 'Bad Request - tile coordinates must be integers')
+			key = '%s-%d-%d-%d'%(version, z, x, y)
+			stream = _tile_cache.get(key)
+			if stream is None:
+				try:
+					with _heavy():
+						stream = _workers.run(key, workers.render_tile, recordID, version, z, x, y)
+				except ValueError as ex:
+					raise cherrypy.HTTPError(404, 'Not Found - %s'%(ex))
+				_tile_cache.put(key, stream)
+			cherrypy.response.headers['Content-Type'] = 'image/jpeg'
+			return stream
+		except FileNotFoundError:
+			raise cherrypy.HTTPError(404, 'Not Found - record %s does not exist'%(recordID))
+
+class RecordExport:
+	"""/api/records/<id>/export?format=geojson|csv streams every plant found in a record. The record is read and
+	converted a chunk at a time, in a process of its own, while the response is being sent, so memory use doesn't
+	depend on its size."""
+	exposed = True
+	@cherrypy.expose
+	@cherrypy.config(**{'response.stream': True})
+	def GET(self, recordID, format = 'geojson', **params):
+		if format not in export.FORMATS:
+			raise cherrypy.HTTPError(400, 'Bad Request - format must be one of %s'%(', '.join(export.FORMATS)))
+		try:
+			records.get_path(recordID)
+		except FileNotFoundError:
+			raise cherrypy.HTTPError(404, 'Not Found - record %s does not exist'%(recordID))
+		_enter_heavy_lane()
+		cherrypy.response.headers['Content-Type'] = export.CONTENT_TYPES[format]
+		cherrypy.response.headers['Content-Disposition'] = 'attachment; filename="%s.%s"'%(os.path.basename(recordID), format)
+		return _heavy_stream(_workers.stream(workers.export_record, recordID, format))
+
+class Heatmap:
+	"""/api/heatmap adds up the plants found in many records on a shared grid. Records are chosen with
+	records=<id>,<id>,... or with since=<date> and until=<date> (inclusive, YYYY-MM-DD); by default every finished
+	record is included. plants=<type>,<type>,... limits the image to some kinds of plant. format=json returns the
+	counts per cell, and format=image a JPEG heatmap."""
+	exposed = True
+	def _record_ids(self, params):
+		if 'records' in params:
+			return [record_id for record_id in params['records'].split(',') if record_id != '']
+		since, until = params.get('since'), params.get('until')
+		for date in (since, until):
+			if date is not None:
+				datetime.date.fromisoformat(date) # raises a ValueError if it isn't a date
+		# record IDs start with the date the record was started
+		return [entry['record_id'] for entry in catalogue.list_records() \
+			if (since is None or entry['record_id'][:10] >= since) and (until is None or entry['record_id'][:10] <= until)]
+	@cherrypy.expose
+	@cherrypy.tools.response_headers(headers = [('Cache-Control', 'no-cache')])
+	def GET(self, format = 'json', **params):
+		try:
+			record_ids = self._record_ids(params)
+			plant_types = query.parse_plants(params['plants']) if 'plants' in params else plants.Plants.NONE
+		except (KeyError, ValueError) as ex:
+			raise cherrypy.HTTPError(400, 'Bad Request - invalid records, dates or plants (%s)'%(ex))
+		if format not in ('json', 'image'):
+			raise cherrypy.HTTPError(400, 'Bad Request - format must be json or image')
+		version = heatmap.version(record_ids)
+		cherrypy.response.headers['ETag'] = '"heatmap-%s-%s-%d"'%(version, format, int(plant_types))
+		cherrypy.lib.cptools.validate_etags()
+		if format == 'json':
+			cherrypy.response.headers['Content-Type'] = 'application/json'
+			with _heavy():
+				result = _workers.run('heatmap-' + version, workers.heatmap_json, record_ids, version)
+			result['records'] = record_ids
+			return json.dumps(result).encode('utf-8')
+		key = 'heatmap-%s-%d'%(version, int(plant_types))
+		stream = _image_cache.get(key)
+		if stream is None:
+			with _heavy():
+				stream = _workers.run(key, workers.heatmap_image, record_ids, version, plant_types)
+			_image_cache.put(key, stream, persist = False)
+		cherrypy.response.headers['Content-Type'] = 'image/jpeg'
+		return stream
+
+def _sse(event):
+	return ('event: %s\ndata: %s\n\n'%(event.get('type', 'message'), json.dumps(event))).encode('utf-8')
+
+class Events:
+	"""/api/events is a Server-Sent Events stream of what the processor is doing: 'state' (processing started or
+	stopped), 'row' (entered or left a row), 'detection' (the position and plants found in each row for one camera
+	frame) and 'estop'. Each event's data is a JSON object with a 'type' and a 'time', plus the details."""
+	exposed = True
+	@cherrypy.expose
+	@cherrypy.config(**{'response.stream': True})
+	def GET(self, **params):
+		if not _event_clients.acquire(blocking = False):
+			raise cherrypy.HTTPError(503, 'Service Unavailable - too many event streams open')
+		cherrypy.response.headers['Content-Type'] = 'text/event-stream'
+		cherrypy.response.headers['Cache-Control'] = 'no-cache'
+		subscription, latest = _events.subscribe()
+		def end():
+			_events.unsubscribe(subscription)
+			_event_clients.release()
+		# (a hook rather than the stream's finally, which never runs if the stream isn't read at all, as for a HEAD)
+		cherrypy.request.hooks.attach('on_end_request', end)
+		def stream():
+			deadline = time.monotonic() + EVENT_MAX_SECONDS
+			yield b'retry: 2000\n\n'
+			# bring the client up to date before sending anything new
+			yield _sse({ 'type': 'state', 'time': time.time(), 'processing': procs.processor_pid() is not None })
+			for event in latest:
+				if event.get('type') != 'state':
+					yield _sse(event)
+			while time.monotonic() < deadline:
+				try:
+					event = subscription.get(timeout = EVENT_KEEPALIVE)
+				except queue.Empty:
+					yield b': keepalive\n\n' # also how we find out the client has gone away
+					continue
+				if event is None:
+					return # server shutting down
+				yield _sse(event)
+		return stream()
+
+class Health:
+	"""/api/health returns the latest health document: processor status and loop rate, the age of each camera's
+	last frame, the age and quality of the GPS fix, and whether the multivator and speed controller are reachable (and
+	how long connecting took). See health.HealthCollector."""
+	exposed = True
+	@cherrypy.expose
+	@cherrypy.tools.response_headers(headers = [('Cache-Control', 'no-cache')])
+	def GET(self, **params):
+		document = _health.get()
+		if document is None:
+			raise _Unavailable('health has not been checked yet', 1)
+		cherrypy.response.headers['Content-Type'] = 'application/json'
+		return document
+
+PREVIEW_TIMEOUT = 0.5 # seconds to wait for a frame from the camera bus
+
+@cherrypy.popargs('cameraID')
+class Cameras:
+	"""/api/cameras lists the cameras on the camera bus (see lib/camera_bus.py), and /api/cameras/<id> returns the newest
+	frame from one as a JPEG - without getting in the way of the processor, which reads the same frames"""
+	exposed = True
+	@cherrypy.expose
+	def GET(self, cameraID = None, **params):
+		cherrypy.response.headers['Cache-Control'] = 'no-cache'
+		if cameraID is None:
+			cherrypy.response.headers['Content-Type'] = 'application/json'
+			return json.dumps(camera_bus.camera_ids()).encode('utf-8')
+		if cameraID not in camera_bus.camera_ids():
+			raise cherrypy.HTTPError(404, 'Not Found - camera %s is not on the camera bus'%(cameraID))
+		try:
+			camera = camera_bus.BusCamera(cameraID)
+		except (FileNotFoundError, cameras.CameraException): # gone (or not set up yet) since we looked
+			raise cherrypy.HTTPError(503, 'Service Unavailable - camera %s is not delivering frames'%(cameraID))
+		try:
+			ret, image = camera.read(PREVIEW_TIMEOUT)
+		finally:
+			camera.release()
+		# (the newest frame is there even if the daemon has stopped, so make sure it's actually new)
+		if not ret or time.monotonic() - camera.timestamp > PREVIEW_TIMEOUT:
+			raise cherrypy.HTTPError(503, 'Service Unavailable - camera %s is not delivering frames'%(cameraID))
+		retval, stream = cv2.imencode('.jpeg', image)
+		cherrypy.response.headers['Content-Type'] = 'image/jpeg'
+		return stream.tobytes()
+
+PROFILE_PROCESSES = ('server', 'processor', 'nmea', 'camera_bus')
+
+@cherrypy.popargs('file')
+class Profile:
+	"""/api/profile lists the file names of the profiles taken so far (newest first), and /api/profile/<file> returns one
+	in collapsed-stack form. POST /api/profile?seconds=N&process=server|processor|nmea|camera_bus starts a new profile of that
+	process in the background (see lib/profiler.py) and returns the name of the file it will be written to."""
+	exposed = True
+	@cherrypy.expose
+	def GET(self, file = None, **params):
+		if file is None:
+			cherrypy.response.headers['Content-Type'] = 'application/json'
+			cherrypy.response.headers['Cache-Control'] = 'no-cache'
+			return json.dumps(profiler.list_profiles()).encode('utf-8')
+		if file not in profiler.list_profiles():
+			raise cherrypy.HTTPError(404, 'Not Found - no such profile')
+		return cherrypy.lib.static.serve_file(os.path.join(profiler.OUTPUT_DIR, file), 'text/plain')
+	@cherrypy.expose
+	@cherrypy.tools.json_out()
+	def POST(self, file = None, seconds = str(profiler.DEFAULT_SECONDS), process = 'server', **params):
+		try:
+			seconds = float(seconds)
+		except ValueError:
+			seconds = -1.0
+		if not 0 < seconds <= profiler.MAX_SECONDS:
+			raise cherrypy.HTTPError(400, 'Bad Request - seconds must be more than 0 and at most %g'%(profiler.MAX_SECONDS))
+		if process not in PROFILE_PROCESSES:
+			raise cherrypy.HTTPError(400, 'Bad Request - process must be one of %s'%(', '.join(PROFILE_PROCESSES)))
+		if process == 'server':
+			path = profiler.output_path(process)
+			if not profiler.start(seconds, path):
+				raise cherrypy.HTTPError(409, 'Conflict - the server is already being profiled')
+		else:
+			try:
+				path = profiler.request(process, seconds)
+			except ProcessLookupError as ex:
+				raise cherrypy.HTTPError(404, 'Not Found - %s'%(ex))
+			except PermissionError:
+				raise cherrypy.HTTPError(403, 'Forbidden - the server is not allowed to signal %s'%(process))
+		cherrypy.response.status = 202
+		return { 'process': process, 'seconds': seconds, 'file': os.path.basename(path) }
 
 class API:
 	def __init__(self):
 		self.machineState = MachineState()
 		self.records = Records()
+		self.heatmap = Heatmap()
+		self.events = Events()
+		self.health = Health()
+		self.profile = Profile()
+		self.cameras = Cameras()
 
 if __name__ == '__main__':
 	path = os.path.dirname(os.path.abspath(__file__))
 	cherrypy.config.update(path + '/server.conf')
+	reserve_control_threads()
 	cherrypy.tree.mount(UI(), '/', path + '/server.conf')
 	cherrypy.tree.mount(API(), '/api', path + '/api.conf')
+	cherrypy.process.plugins.Monitor(cherrypy.engine, _refresh_live_map, LIVE_MAP_INTERVAL, 'LiveMap').subscribe()
+	cherrypy.engine.subscribe('stop', _workers.shutdown)
+	cherrypy.engine.subscribe('start', _events.start)
+	cherrypy.engine.subscribe('start', _start_catalogue)
+	cherrypy.engine.subscribe('stop', _events.stop)
+	cherrypy.process.plugins.Monitor(cherrypy.engine, _health.refresh, HEALTH_INTERVAL, 'Health').subscribe()
+	profiler.install('server')
 	cherrypy.engine.start()
 	cherrypy.engine.block()
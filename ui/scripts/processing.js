@@ -8,6 +8,174 @@ function updateImage() {
     $('.record-img').attr('src', '../api/records/CURRENT/image?time='+new Date().getTime());
 }
 
+// Where the browser supports Server-Sent Events, the map of the current run is drawn here from the detections pushed
+// over /api/events, instead of re-downloading the whole image from the server every second.
+const EARTH_RADIUS = 20902464; // feet
+const ROW_DIST = [-26/12, -16/12, 0.0, 16/12, 26/12]; // feet right of the center of the BOT
+const PLANT_RADIUS = 2/12;
+const MAX_POINTS = 50000;
+// same colors as the server draws, in the same order: later ones are drawn over earlier ones
+const PLANT_COLORS = [[1, 'rgb(0, 255, 0)'], [2, 'rgb(246, 255, 0)'], [4, 'rgb(0, 0, 255)'], [8, 'rgb(255, 0, 0)']];
+
+function LiveMap(canvas) {
+    this.canvas = canvas;
+    this.context = canvas.getContext('2d');
+    this.reset();
+}
+
+LiveMap.prototype.reset = function () {
+    this.origin = null;
+    // once there are MAX_POINTS, each new point replaces the oldest, at index first
+    this.points = [];
+    this.first = 0;
+    this.last = null;
+    this.scale = this.canvas.width / 100; // pixels per foot - start out showing 100ft across
+    this.center = [0, 0];
+    this.redraw();
+};
+
+LiveMap.prototype.add = function (longitude, latitude, rows) {
+    if (this.origin === null) {
+        this.origin = [longitude, latitude, Math.cos(latitude * Math.PI / 180)];
+    }
+    var x = (longitude - this.origin[0]) * Math.PI / 180 * EARTH_RADIUS * this.origin[2];
+    var y = (latitude - this.origin[1]) * Math.PI / 180 * EARTH_RADIUS;
+    // rows are offset at right angles to the direction of travel since the last position
+    var normal = [0, 0];
+    if (this.last !== null) {
+        var dx = x - this.last[0], dy = y - this.last[1], length = Math.hypot(dx, dy);
+        if (length > 0) { normal = [dy / length, -dx / length]; }
+        else { normal = this.last[2]; }
+    }
+    this.last = [x, y, normal];
+    var point = { x: x, y: y, normal: normal, rows: rows };
+    if (this.points.length < MAX_POINTS) { this.points.push(point); }
+    else {
+        this.points[this.first] = point;
+        this.first = (this.first + 1) % MAX_POINTS;
+    }
+    if (!this.fits(x, y)) {
+        // zoom out (and recenter) until the new point is on the map, then draw everything again
+        while (Math.abs(x - this.center[0]) * this.scale * 2 > this.canvas.width - 20 ||
+               Math.abs(y - this.center[1]) * this.scale * 2 > this.canvas.height - 20) {
+            this.scale /= 2;
+        }
+        this.redraw();
+    }
+    else {
+        this.draw(point);
+    }
+};
+
+LiveMap.prototype.fits = function (x, y) {
+    var px = this.canvas.width / 2 + (x - this.center[0]) * this.scale;
+    var py = this.canvas.height / 2 - (y - this.center[1]) * this.scale;
+    return px >= 10 && px < this.canvas.width - 10 && py >= 10 && py < this.canvas.height - 10;
+};
+
+LiveMap.prototype.draw = function (point) {
+    var radius = Math.max(this.scale * PLANT_RADIUS, 1);
+    for (var i = 0; i < PLANT_COLORS.length; i++) {
+        this.context.fillStyle = PLANT_COLORS[i][1];
+        for (var row = 0; row < point.rows.length; row++) {
+            if ((point.rows[row] & PLANT_COLORS[i][0]) === 0) { continue; }
+            var x = point.x + point.normal[0] * ROW_DIST[row], y = point.y + point.normal[1] * ROW_DIST[row];
+            this.context.beginPath();
+            this.context.arc(this.canvas.width / 2 + (x - this.center[0]) * this.scale,
+                             this.canvas.height / 2 - (y - this.center[1]) * this.scale, radius, 0, 2 * Math.PI);
+            this.context.fill();
+        }
+    }
+};
+
+LiveMap.prototype.redraw = function () {
+    this.context.fillStyle = 'rgb(200, 200, 200)';
+    this.context.fillRect(0, 0, this.canvas.width, this.canvas.height);
+    var count = this.points.length;
+    for (var i = 0; i < count; i++) { this.draw(this.points[(this.first + i) % count]); }
+};
+
+var liveMap = null;
+var eventSource = null;
+// where the map is up to in the current record: its generation, and the number of the next line to draw
+var generation = null;
+var nextLine = 0;
+// detection events that arrive while catching up are held here, then drawn in order once it is done
+var pending = null;
+
+function addDetection(msg) {
+    if (msg.line < nextLine) { return; } // already drawn
+    liveMap.add(msg.longitude, msg.latitude, msg.rows);
+    nextLine = msg.line + 1;
+}
+
+function catchUp() {
+    // draw whatever was recorded that the map hasn't seen - the whole record when the page is first opened, or what
+    // was missed while the event stream was reconnecting - from one snapshot of the record
+    if (pending !== null) { return; } // already catching up
+    pending = [];
+    $.ajax({
+        url: '../api/records/CURRENT?since=' + nextLine,
+        type: 'GET',
+        success: function (msg) {
+            var from = nextLine;
+            if (msg.generation !== generation) {
+                // processing was restarted - this is a new record
+                if (generation !== null && from !== 0) {
+                    pending = null;
+                    liveMap.reset();
+                    generation = null;
+                    nextLine = 0;
+                    catchUp();
+                    return;
+                }
+                generation = msg.generation;
+            }
+            for (var i = 0; i < msg.lines.length; i++) {
+                liveMap.add(msg.lines[i][0], msg.lines[i][1], msg.lines[i][2]);
+            }
+            nextLine = msg.next;
+            var held = pending;
+            pending = null;
+            held.forEach(addDetection);
+        },
+        error: function (msg) {
+            console.log(msg);
+            var held = pending;
+            pending = null;
+            held.forEach(addDetection);
+        }
+    });
+}
+
+function startEvents() {
+    var canvas = $('<canvas class="record-img" width="700" height="500"></canvas>');
+    $('img.record-img').replaceWith(canvas);
+    liveMap = new LiveMap(canvas[0]);
+    eventSource = new EventSource('../api/events');
+    eventSource.addEventListener('state', function (e) {
+        var msg = JSON.parse(e.data);
+        if (msg.processing && !processing) {
+            liveMap.reset();
+            generation = null;
+            nextLine = 0;
+            catchUp();
+        }
+        else if (msg.processing) {
+            catchUp(); // the stream was reconnected - draw what was recorded in between
+        }
+        updateProcessingState(msg.processing);
+    });
+    eventSource.addEventListener('detection', function (e) {
+        var msg = JSON.parse(e.data);
+        if (pending !== null) { pending.push(msg); }
+        else { addDetection(msg); }
+    });
+    eventSource.addEventListener('estop', function (e) {
+        updateProcessingState(false);
+    });
+}
+
 var processingTimerID = null;
 
 function updateUI_processingStarted() {
@@ -16,6 +184,7 @@ function updateUI_processingStarted() {
     var btnStatus = $('#btnStatus a');
     btnStatus.css('background-color', processing_color);
     $('.record-img').css('visibility', 'visible');
+    if (eventSource !== null) { return; } // the map is drawn from the events as they come
     if (processingTimerID !== null) { clearInterval(processingTimerID); }
     processingTimerID = setInterval(updateImage, 1000);
 }
@@ -63,7 +232,13 @@ function updateProcessingState(newState) {
 }
 
 $(document).ready(function() {
-    updateProcessingState();
+    if (typeof(EventSource) !== 'undefined') {
+        // the first event tells us whether we're processing
+        startEvents();
+    }
+    else {
+        updateProcessingState();
+    }
     btnProcessing_Click = function() {
         var newState = !processing;
         $.ajax({
@@ -50,10 +50,115 @@ function updateRecordSummary(recordID) {
     });
 }
 
+// A pannable, zoomable map of the record, built from the tiles served by /api/records/<id>/tiles.
+// Drag to pan; use the mouse wheel or the +/- buttons to zoom.
+function TileMap(div, recordID, info) {
+    this.div = div;
+    this.layer = $('<div class="tile-layer"></div>').appendTo(div);
+    this.url = 'api/records/' + recordID + '/tiles/';
+    this.info = info;
+    this.tiles = {};
+    this.zoom = 0;
+    // world pixel (at this.zoom) shown at the top left corner of the viewport
+    this.left = 0;
+    this.top = 0;
+    var view = this;
+    var controls = $('<div class="tile-controls"><button>+</button><button>&minus;</button></div>').appendTo(div);
+    controls.children().eq(0).click(function () { view.zoomBy(1); });
+    controls.children().eq(1).click(function () { view.zoomBy(-1); });
+    div.on('wheel', function (e) {
+        e.preventDefault();
+        var offset = div.offset();
+        view.zoomBy(e.originalEvent.deltaY < 0 ? 1 : -1, e.pageX - offset.left, e.pageY - offset.top);
+    });
+    div.on('mousedown', function (e) {
+        var x = e.pageX, y = e.pageY;
+        $(document).on('mousemove.tilemap', function (e) {
+            view.panBy(x - e.pageX, y - e.pageY);
+            x = e.pageX;
+            y = e.pageY;
+        });
+        $(document).on('mouseup.tilemap', function () { $(document).off('.tilemap'); });
+        e.preventDefault();
+    });
+    // start zoomed to fit the whole record
+    this.left = (info.tileSize - div.width()) / 2;
+    this.top = (info.tileSize - div.height()) / 2;
+    this.update();
+}
+
+TileMap.prototype.zoomBy = function (step, x, y) {
+    var zoom = Math.min(Math.max(this.zoom + step, 0), this.info.maxZoom);
+    if (zoom === this.zoom) { return; }
+    if (x === undefined) { x = this.div.width() / 2; }
+    if (y === undefined) { y = this.div.height() / 2; }
+    // keep the point under (x, y) where it is
+    var factor = Math.pow(2, zoom - this.zoom);
+    this.left = (this.left + x) * factor - x;
+    this.top = (this.top + y) * factor - y;
+    this.zoom = zoom;
+    this.layer.empty();
+    this.tiles = {};
+    this.update();
+};
+
+TileMap.prototype.panBy = function (dx, dy) {
+    this.left += dx;
+    this.top += dy;
+    this.update();
+};
+
+TileMap.prototype.update = function () {
+    var size = this.info.tileSize;
+    var count = Math.pow(2, this.zoom);
+    var first_x = Math.max(Math.floor(this.left / size), 0);
+    var last_x = Math.min(Math.floor((this.left + this.div.width()) / size), count - 1);
+    var first_y = Math.max(Math.floor(this.top / size), 0);
+    var last_y = Math.min(Math.floor((this.top + this.div.height()) / size), count - 1);
+    this.layer.css({ left: -this.left + 'px', top: -this.top + 'px' });
+    // only the tiles in view are loaded; ones that scroll out of view are dropped again
+    var wanted = {};
+    for (var y = first_y; y <= last_y; y++) {
+        for (var x = first_x; x <= last_x; x++) {
+            var key = this.zoom + '/' + x + '/' + y;
+            wanted[key] = true;
+            if (!(key in this.tiles)) {
+                this.tiles[key] = $('<img class="tile" draggable="false">')
+                    .attr('src', this.url + key)
+                    .css({ left: x * size + 'px', top: y * size + 'px' })
+                    .appendTo(this.layer);
+            }
+        }
+    }
+    for (var key in this.tiles) {
+        if (!(key in wanted)) {
+            this.tiles[key].remove();
+            delete this.tiles[key];
+        }
+    }
+};
+
+function showRecordMap(recordID) {
+    $.ajax({
+        url: '../api/records/'+recordID+'/tiles',
+        type: 'GET',
+        success: function (info) {
+            var div = $('<div class="record-img record-map"></div>');
+            $('#record_info').after(div);
+            new TileMap(div, recordID, info);
+        },
+        error: function (msg) {
+            // no tiles (e.g. the record is empty) - fall back to the single image
+            console.log('Error getting record tiles: '+JSON.stringify(msg));
+            $('#record_info').after('<img class="record-img" src="api/records/'+recordID+'/image"></img>');
+        }
+    });
+}
+
 $(document).ready(function (){
     var recordID = getRecordID();
     if (recordID !== null) {
-        $('#record_info').after('<img class="record-img" src="api/records/'+recordID+'/image"></img>')
+        showRecordMap(recordID);
         updateRecordSummary(recordID);
     }
 });
\ No newline at end of file